@@ -0,0 +1,6 @@
+#!/bin/bash
+
+# Save output file to pwd, runs every registered strategy for a sweep of sizes
+HERE="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+ROOT=$(dirname ${HERE})
+python manage.py run_benchmarks "$ROOT/data/genes.json"  "${HERE}/run_benchmarks.csv"
@@ -0,0 +1,8 @@
+#!/bin/bash
+
+# Save output file to pwd, reads against whatever similarities are loaded
+# (run one of the create tests first), without and with a concurrent load
+HERE="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+for threads in 1 8 32; do
+    python manage.py run_read_benchmarks "${HERE}/run_read_benchmarks_${threads}.csv" --threads ${threads} --duration 30
+done
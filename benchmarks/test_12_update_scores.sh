@@ -0,0 +1,5 @@
+#!/bin/bash
+
+# Save output file to pwd, this needs a matrix loaded by one of the create tests
+HERE="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+python manage.py test_12_update_scores "${HERE}/test_12_update_scores.csv"
@@ -0,0 +1,13 @@
+#!/bin/bash
+
+# Save output file to pwd
+HERE="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+ROOT=$(dirname ${HERE})
+
+# Partition the similarities once, then load (and replace) the metric with
+# one COPY per hash partition, for 4, 8 and 16 partitions
+python manage.py partition_similarities
+for partitions in 4 8 16; do
+    python manage.py test_13_partitioned_copy "$ROOT/data/genes.json" "${HERE}/test_13_partitioned_copy_${partitions}.csv" --partitions ${partitions} --replace
+done
+python manage.py partition_similarities --revert
@@ -0,0 +1,6 @@
+#!/bin/bash
+
+# Save output file to pwd
+HERE="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+ROOT=$(dirname ${HERE})
+python manage.py test_6_streaming_copy "$ROOT/data/genes.json"  "${HERE}/test_6_streaming_copy.csv"
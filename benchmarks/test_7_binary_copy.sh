@@ -0,0 +1,9 @@
+#!/bin/bash
+
+# Save output file to pwd
+HERE="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+ROOT=$(dirname ${HERE})
+
+# The same streaming pipeline, once with binary and once with text COPY
+python manage.py test_7_binary_copy "$ROOT/data/genes.json"  "${HERE}/test_7_binary_copy.csv" --format binary
+python manage.py test_7_binary_copy "$ROOT/data/genes.json"  "${HERE}/test_7_text_copy.csv" --format text
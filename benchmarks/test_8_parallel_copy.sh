@@ -0,0 +1,10 @@
+#!/bin/bash
+
+# Save output file to pwd
+HERE="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+ROOT=$(dirname ${HERE})
+
+# One output file per number of workers, to see how throughput scales
+for workers in 1 2 4 8 16; do
+    python manage.py test_8_parallel_copy "$ROOT/data/genes.json"  "${HERE}/test_8_parallel_copy_${workers}.csv" --workers ${workers}
+done
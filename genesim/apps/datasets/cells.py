@@ -0,0 +1,173 @@
+from __future__ import unicode_literals
+
+from contextlib import closing
+import csv
+from io import StringIO
+
+from django.db import connection
+
+from genesim.apps.datasets.models import Gene, GeneSimilarity, LoadGeneration
+
+# The loops of tests 1 to 4, shared with their load strategies. They look up
+# both genes of every cell with a query, the way a naive loader would, which
+# is what those tests measure. Creating genes bumps the load generation, so
+# the GeneIndex of every process (see index.py) reads them.
+
+SIMILARITY_COLUMNS = ("gene1_id", "gene2_id", "metric", "score")
+
+
+def get_gene(name):
+    return Gene.objects.get(systematic_name=name)
+
+
+def get_or_create_gene(name):
+    gene, _ = Gene.objects.get_or_create(systematic_name=name)
+    return gene
+
+
+def get_or_create_genes(names):
+    """get_or_create each gene (test 1)"""
+    for name in names:
+        get_or_create_gene(name)
+    LoadGeneration.bump(LoadGeneration.GENES)
+
+
+def bulk_create_genes(names):
+    """Create the genes with one bulk_create (test 2)"""
+    Gene.objects.bulk_create([Gene(systematic_name=name) for name in names])
+    LoadGeneration.bump(LoadGeneration.GENES)
+
+
+def iter_cells(names, matrix, get_gene=get_gene, symmetric=False):
+    """Yield a list of (gene1, gene2, score) for each row of the matrix. For
+       row i we take the columns j where name i sorts before name j, and the
+       pair is written both ways with the score at [i, j] (the same rows as
+       matrix.iter_pair_blocks), or if symmetric once, with gene1 the gene
+       with the smaller id.
+    """
+    for i, name1 in enumerate(names):
+        gene1 = get_gene(name1)
+        cells = []
+        for j, name2 in enumerate(names):
+            gene2 = get_gene(name2)
+
+            # Only process when genes sort in order (the diagonal is separate)
+            if name1 >= name2:
+                continue
+
+            score = round(float(matrix[i, j]), 3)
+            if symmetric:
+                first, second = sorted((gene1, gene2), key=lambda gene: gene.id)
+                cells.append((first, second, score))
+            else:
+                cells += [(gene1, gene2, score), (gene2, gene1, score)]
+        yield cells
+
+
+def get_or_create_diagonal(names, metric="cosine"):
+    """get_or_create the similarity of each gene to itself (test 1)"""
+    for name in names:
+        gene = get_or_create_gene(name)
+        GeneSimilarity.objects.get_or_create(
+            gene1=gene, gene2=gene, score=1.0, metric=metric
+        )
+    return len(names)
+
+
+def get_or_create_similarities(names, matrix, metric="cosine", symmetric=False):
+    """get_or_create every similarity (test 1), yielding the number of rows
+       written for each row of the matrix.
+    """
+    for cells in iter_cells(names, matrix, get_or_create_gene, symmetric):
+        for gene1, gene2, score in cells:
+            GeneSimilarity.objects.get_or_create(
+                gene1=gene1, gene2=gene2, score=score, metric=metric
+            )
+        yield len(cells)
+
+
+def bulk_create_diagonal(names, metric="cosine"):
+    """bulk_create the similarity of each gene to itself (test 2)"""
+    listing = []
+    for name in names:
+        gene = get_gene(name)
+        listing.append(GeneSimilarity(gene1=gene, gene2=gene, score=1.0, metric=metric))
+    GeneSimilarity.objects.bulk_create(listing)
+    return len(listing)
+
+
+def bulk_create_similarities(names, matrix, metric="cosine", symmetric=False):
+    """bulk_create the similarities of each row of the matrix (test 2),
+       yielding the number of rows written for each.
+    """
+    for cells in iter_cells(names, matrix, get_gene, symmetric):
+        GeneSimilarity.objects.bulk_create(
+            [
+                GeneSimilarity(gene1=gene1, gene2=gene2, score=score, metric=metric)
+                for gene1, gene2, score in cells
+            ]
+        )
+        yield len(cells)
+
+
+def copy_rows(rows, table="datasets_genesimilarity", columns=SIMILARITY_COLUMNS):
+    """COPY rows from a tab separated StringIO, returning the bytes sent"""
+    stream = StringIO()
+    writer = csv.writer(stream, delimiter="\t")
+    writer.writerows(rows)
+    stream.seek(0)
+    with closing(connection.cursor()) as cursor:
+        cursor.copy_from(file=stream, table=table, sep="\t", columns=columns)
+    return len(stream.getvalue())
+
+
+def copy_genes(names):
+    """Create genes with a single COPY of their names"""
+    bytes_sent = copy_rows(
+        [(name, name) for name in names],
+        table="datasets_gene",
+        columns=("systematic_name", "common_name"),
+    )
+    LoadGeneration.bump(LoadGeneration.GENES)
+    return bytes_sent
+
+
+def copy_diagonal(names, metric="cosine"):
+    """COPY the similarity of each gene to itself (tests 3 and 4), returning
+       the rows and bytes sent.
+    """
+    rows = []
+    for name in names:
+        gene = get_gene(name)
+        rows.append([gene.id, gene.id, metric, 1.0])
+    return len(rows), copy_rows(rows)
+
+
+def copy_similarities(names, matrix, metric="cosine", symmetric=False):
+    """COPY the similarities of each row of the matrix (test 3), yielding the
+       rows and bytes sent for each.
+    """
+    for cells in iter_cells(names, matrix, get_gene, symmetric):
+        rows = [[gene1.id, gene2.id, metric, score] for gene1, gene2, score in cells]
+        yield len(rows), copy_rows(rows)
+
+
+def write_similarities(path, names, matrix, metric="cosine", symmetric=False):
+    """Write every similarity (but the diagonal) to a tab separated file for
+       COPY (test 4), returning the number of rows.
+    """
+    count = 0
+    with open(path, "w") as csv_file:
+        writer = csv.writer(csv_file, delimiter="\t")
+        for cells in iter_cells(names, matrix, get_gene, symmetric):
+            for gene1, gene2, score in cells:
+                writer.writerow([gene1.id, gene2.id, metric, score])
+            count += len(cells)
+    return count
+
+
+def copy_file(path, table="datasets_genesimilarity", columns=SIMILARITY_COLUMNS):
+    """COPY a tab separated file into a table"""
+    with open(path, "r") as stream:
+        with closing(connection.cursor()) as cursor:
+            cursor.copy_from(file=stream, table=table, sep="\t", columns=columns)
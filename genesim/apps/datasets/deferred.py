@@ -0,0 +1,117 @@
+from __future__ import unicode_literals
+
+from contextlib import closing
+import time
+
+from django.db import connection, transaction
+
+from genesim.apps.datasets.models import LoadGeneration
+from genesim.apps.datasets.stream import stream_copy
+
+
+def get_constraints(table, types=("f", "u")):
+    """Return (name, definition) for the foreign key and unique constraints
+       (or other types, e.g., "p" for the primary key) of a table, so that
+       they can be dropped and added back after a load.
+    """
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            """SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+               WHERE conrelid = %s::regclass AND contype = ANY(%s)
+               ORDER BY contype DESC, conname""",
+            [table, list(types)],
+        )
+        return cursor.fetchall()
+
+
+def get_indexes(table):
+    """Return (name, definition) for the indexes of a table that don't back
+       a constraint (e.g., the foreign key indexes that Django creates).
+    """
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            """SELECT i.relname, pg_get_indexdef(i.oid) FROM pg_index x
+               JOIN pg_class i ON i.oid = x.indexrelid
+               WHERE x.indrelid = %s::regclass AND NOT EXISTS (
+                   SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid
+               ) ORDER BY i.relname""",
+            [table],
+        )
+        return cursor.fetchall()
+
+
+def deferred_copy(chunks, table, columns, binary=True, maintenance_workers=None):
+    """Load chunks into a table with its indexes and constraints deferred:
+
+       1. COPY into an UNLOGGED staging table without any constraints
+       2. drop the foreign key and unique constraints, and other indexes
+       3. move the rows over with a single INSERT ... SELECT
+       4. create each index and add back each constraint
+
+       Steps 2-4 run in one transaction, so a failure leaves the table as
+       it was. Returns a list of (phase, seconds) so the cost of each index
+       can be compared.
+    """
+    quote_name = connection.ops.quote_name
+    staging = "%s_staging" % table
+    column_list = ", ".join(columns)
+    timings = []
+
+    with closing(connection.cursor()) as cursor:
+        start = time.time()
+        cursor.execute("DROP TABLE IF EXISTS %s" % staging)
+        cursor.execute(
+            "CREATE UNLOGGED TABLE %s AS SELECT %s FROM %s WITH NO DATA"
+            % (staging, column_list, table)
+        )
+        stream_copy(chunks, table=staging, columns=columns, binary=binary)
+        timings.append(("staging_copy", time.time() - start))
+
+        try:
+            with transaction.atomic():
+                start = time.time()
+                constraints = get_constraints(table)
+                # an index on a partitioned table is defined ON ONLY the parent,
+                # which would leave the partitions without it
+                indexes = [
+                    (name, definition.replace(" ON ONLY ", " ON "))
+                    for name, definition in get_indexes(table)
+                ]
+                for name, _ in constraints:
+                    cursor.execute(
+                        "ALTER TABLE %s DROP CONSTRAINT %s" % (table, quote_name(name))
+                    )
+                for name, _ in indexes:
+                    cursor.execute("DROP INDEX %s" % quote_name(name))
+                timings.append(("drop_constraints", time.time() - start))
+
+                start = time.time()
+                cursor.execute(
+                    "INSERT INTO %s (%s) SELECT %s FROM %s"
+                    % (table, column_list, column_list, staging)
+                )
+                timings.append(("insert_select", time.time() - start))
+
+                if maintenance_workers is not None:
+                    cursor.execute(
+                        "SET LOCAL max_parallel_maintenance_workers = %s",
+                        [maintenance_workers],
+                    )
+
+                for name, definition in indexes:
+                    start = time.time()
+                    cursor.execute(definition)
+                    timings.append(("rebuild_%s" % name, time.time() - start))
+
+                for name, definition in constraints:
+                    start = time.time()
+                    cursor.execute(
+                        "ALTER TABLE %s ADD CONSTRAINT %s %s"
+                        % (table, quote_name(name), definition)
+                    )
+                    timings.append(("rebuild_%s" % name, time.time() - start))
+                LoadGeneration.bump()
+        finally:
+            cursor.execute("DROP TABLE IF EXISTS %s" % staging)
+
+    return timings
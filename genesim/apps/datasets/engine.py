@@ -0,0 +1,129 @@
+from __future__ import unicode_literals
+
+import json
+import os
+
+import numpy
+import pandas
+import tables
+
+# Each metric is a dot product of rows, after they are transformed once:
+# cosine scales each row to unit length, pearson centers it first, and
+# spearman replaces the values with their ranks before pearson
+METRICS = ("cosine", "pearson", "spearman")
+
+
+def normalize(expression, metric="cosine", dtype=numpy.float32):
+    """Return the gene x sample expression matrix with each row transformed
+       for a metric (see METRICS), so the similarity of two genes is the dot
+       product of their rows. A row without any variation (or all zeros)
+       has no direction and becomes zeros, a similarity of 0 to all genes.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"{metric} isn't one of {', '.join(METRICS)}.")
+
+    features = numpy.array(expression, dtype=numpy.float64)
+    if features.ndim != 2:
+        raise ValueError("The expression matrix must have a row for each gene.")
+    if not numpy.isfinite(features).all():
+        raise ValueError("The expression matrix has missing (or infinite) values.")
+
+    if metric == "spearman":
+        features = numpy.array(pandas.DataFrame(features).rank(axis=1), numpy.float64)
+    if metric in ("pearson", "spearman"):
+        features -= features.mean(axis=1, keepdims=True)
+
+    norms = numpy.linalg.norm(features, axis=1, keepdims=True)
+    numpy.divide(features, norms, out=features, where=norms > 0)
+    features[norms[:, 0] == 0] = 0
+    return features.astype(dtype)
+
+
+class SimilarityEngine(object):
+    """Compute a similarity matrix from expression data as it's read. It's
+       sliced like a matrix (and a source.MatrixSource): each block of rows
+       is the matmul of the normalized rows with the normalized matrix, a
+       tile of tile_size columns at a time, so a loader computes and loads
+       the similarities in one pass without the genes x genes matrix ever
+       being in memory.
+
+       Like a matrix on disk, the similarities are symmetric, with exactly
+       1.0 on the diagonal, except for genes without any variation, which
+       are 0 to every gene including themselves (see normalize). The loaders
+       read the diagonal with get_diagonal.
+    """
+
+    symmetric = True
+
+    def __init__(self, expression, metric="cosine", tile_size=2048, dtype=None):
+        dtype = numpy.float32 if dtype is None else dtype
+        self.metric = metric
+        self.tile_size = tile_size
+        self.features = normalize(expression, metric=metric, dtype=dtype)
+        self.shape = (len(self.features), len(self.features))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            row = range(len(self))[key]
+            return self[row : row + 1][0]
+        first, last, step = key.indices(len(self))
+        if step != 1:
+            raise IndexError("Only contiguous blocks of rows can be computed.")
+
+        rows = self.features[first:last]
+        block = numpy.empty((len(rows), len(self)), dtype=self.features.dtype)
+        for column in range(0, len(self), self.tile_size):
+            columns = self.features[column : column + self.tile_size]
+            block[:, column : column + len(columns)] = rows @ columns.T
+
+        # Rounding can take a score just past 1 (or -1)
+        numpy.clip(block, -1.0, 1.0, out=block)
+        varied = numpy.flatnonzero(rows.any(axis=1))
+        block[varied, first + varied] = 1.0
+        return block
+
+    def get_diagonal(self, first=0, last=None):
+        """Return the score of each gene with itself for rows first to last,
+           1.0 unless the gene has no variation.
+        """
+        return self.features[first:last].any(axis=1).astype(numpy.float64)
+
+    def iter_blocks(self, block_size=250, start=0, stop=None):
+        """Yield (first, block) for blocks of rows of the matrix"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for first in range(start, stop, block_size):
+            yield first, self[first : min(first + block_size, stop)]
+
+
+def read_expression(path):
+    """Read a gene x sample expression matrix, returning (names, matrix):
+
+        - a .npy, with the gene names in <path>.genes.json
+        - the "expression" dataset of an HDF5 file (.h5 or .hdf5), and the
+          gene names in its "genes" array
+        - a text file (.csv, or tab separated otherwise) with a header row,
+          and the gene name in the first column
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} does not exist.")
+
+    if path.endswith(".npy"):
+        names_json = f"{path}.genes.json"
+        if not os.path.exists(names_json):
+            raise ValueError(f"{names_json} with the gene names is required.")
+        with open(names_json, "r") as fd:
+            return json.loads(fd.read()), numpy.load(path)
+
+    if path.endswith((".h5", ".hdf5")):
+        with tables.open_file(path, mode="r") as h5:
+            if "expression" not in h5.root or "genes" not in h5.root:
+                raise ValueError(f"{path} needs an expression and a genes array.")
+            names = [name.decode("utf-8") for name in h5.root.genes.read()]
+            return names, h5.root.expression.read()
+
+    sep = "," if path.endswith(".csv") else "\t"
+    df = pandas.read_csv(path, sep=sep, index_col=0)
+    return [str(name) for name in df.index], df.values
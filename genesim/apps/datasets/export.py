@@ -0,0 +1,189 @@
+from __future__ import unicode_literals
+
+from contextlib import closing
+import io
+
+from django.db import connection
+
+import numpy
+import tables
+
+# One exported (gene1_id, gene2_id, score::float8) tuple in the binary COPY
+# format, every field has a fixed width so a buffer decodes as one array
+EXPORT_DTYPE = numpy.dtype(
+    [
+        ("nfields", ">i2"),
+        ("gene1_length", ">i4"),
+        ("gene1", ">i4"),
+        ("gene2_length", ">i4"),
+        ("gene2", ">i4"),
+        ("score_length", ">i4"),
+        ("score", ">f8"),
+    ]
+)
+
+# Signature, flags field and (empty) header extension, and the -1 trailer
+HEADER_SIZE = 19
+TRAILER_SIZE = 2
+
+
+def get_positions(ids):
+    """Return an array to look up the position of gene ids in the matrix,
+       with -1 for genes that aren't exported.
+    """
+    positions = numpy.full(int(ids.max()) + 1 if len(ids) else 0, -1, numpy.int64)
+    positions[ids] = numpy.arange(len(ids))
+    return positions
+
+
+def get_export_query(cursor, metric="cosine", ids=None, binary=True):
+    """The COPY ... TO STDOUT query for the similarities of a metric, only
+       between the gene ids if given. COPY doesn't take parameters, so the
+       query is rendered by psycopg2 first.
+    """
+    query = (
+        "SELECT gene1_id, gene2_id, score::float8 FROM datasets_genesimilarity"
+        " WHERE metric = %s"
+    )
+    params = [metric]
+    if ids is not None:
+        query += " AND gene1_id = ANY(%s) AND gene2_id = ANY(%s)"
+        params += [ids.tolist(), ids.tolist()]
+    query = cursor.mogrify(query, params).decode("utf-8")
+    return "COPY (%s) TO STDOUT%s" % (query, " WITH (FORMAT binary)" if binary else "")
+
+
+class MatrixScatter(io.RawIOBase):
+    """A write only file-like object for cursor.copy_expert, that decodes
+       the similarities it receives a buffer at a time and scatters them into
+       a (memory mapped) matrix by the position of each gene. With symmetric,
+       each score is also written to the mirrored cell.
+    """
+
+    def __init__(self, matrix, positions, binary=True, symmetric=False, size=1 << 22):
+        self.matrix = matrix
+        self.positions = positions
+        self.binary = binary
+        self.symmetric = symmetric
+        self.size = size
+        self.chunks = []
+        self.buffered = 0
+        self.bytes_written = 0
+        self.rows = 0
+        self.header = binary
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.buffered += len(data)
+        self.bytes_written += len(data)
+        if self.buffered >= self.size:
+            self.flush_rows()
+        return len(data)
+
+    def flush_rows(self, final=False):
+        """Decode all complete rows that are buffered and scatter them,
+           keeping a partial row (or the trailer) for the next write.
+        """
+        data = b"".join(self.chunks)
+        if self.header:
+            data = data[HEADER_SIZE:]
+            self.header = False
+
+        if self.binary:
+            end = len(data) - TRAILER_SIZE if final else len(data)
+            count = max(end, 0) // EXPORT_DTYPE.itemsize
+            rows = numpy.frombuffer(data, EXPORT_DTYPE, count)
+            rest = data[count * EXPORT_DTYPE.itemsize :]
+            gene1, gene2, scores = rows["gene1"], rows["gene2"], rows["score"]
+        else:
+            end = data.rfind(b"\n") + 1
+            values = numpy.array(data[:end].split(), dtype=numpy.float64)
+            values = values.reshape(-1, 3)
+            rest = data[end:]
+            gene1 = values[:, 0].astype(numpy.int64)
+            gene2 = values[:, 1].astype(numpy.int64)
+            scores = values[:, 2]
+
+        self.chunks = [rest]
+        self.buffered = len(rest)
+
+        # Similarities with a gene that isn't exported are dropped
+        rows, cols = self.get_positions(gene1), self.get_positions(gene2)
+        exported = (rows >= 0) & (cols >= 0)
+        self.scatter(rows[exported], cols[exported], scores[exported])
+
+    def get_positions(self, ids):
+        """The position of each gene id in the matrix, or -1"""
+        positions = numpy.full(len(ids), -1, numpy.int64)
+        known = ids < len(self.positions)
+        positions[known] = self.positions[ids[known]]
+        return positions
+
+    def scatter(self, rows, cols, scores):
+        self.matrix[rows, cols] = scores
+        if self.symmetric:
+            self.matrix[cols, rows] = scores
+        self.rows += len(scores)
+
+    def close(self):
+        if not self.closed and self.chunks:
+            self.flush_rows(final=True)
+        super().close()
+
+
+def export_similarities(
+    matrix, ids, metric="cosine", binary=True, symmetric=False, subset=False
+):
+    """Stream the similarities of a metric with COPY ... TO STDOUT into a
+       matrix (usually memory mapped) with rows and columns in the order of
+       ids. With subset, only the similarities between these genes are
+       selected. Returns the number of similarities and bytes received.
+    """
+    scatter = MatrixScatter(
+        matrix, get_positions(ids), binary=binary, symmetric=symmetric
+    )
+    with closing(connection.cursor()) as cursor:
+        query = get_export_query(cursor, metric, ids if subset else None, binary)
+        cursor.copy_expert(query, scatter)
+    scatter.close()
+    return scatter.rows, scatter.bytes_written
+
+
+def create_npy(path, total, dtype=numpy.float32):
+    """Create a memory mapped .npy file for a total x total matrix, with
+       missing similarities as NaN.
+    """
+    matrix = numpy.lib.format.open_memmap(
+        path, mode="w+", dtype=dtype, shape=(total, total)
+    )
+    matrix[:] = numpy.nan
+    return matrix
+
+
+def create_hdf5(h5, names, dtype=numpy.float32):
+    """Create the "similarities" dataset for the genes in an open HDF5 file,
+       with one chunk for each row so blocks of rows can be read back, and
+       the gene names as "genes".
+    """
+    h5.create_array(h5.root, "genes", numpy.array(names, dtype=numpy.bytes_))
+    return h5.create_carray(
+        h5.root,
+        "similarities",
+        atom=tables.Atom.from_dtype(numpy.dtype(dtype)),
+        shape=(len(names), len(names)),
+        chunkshape=(1, max(len(names), 1)),
+    )
+
+
+def write_hdf5(path, matrix, names, block_size=250):
+    """Copy a (memory mapped) matrix to the "similarities" dataset of an HDF5
+       file a block of rows at a time.
+    """
+    with tables.open_file(path, mode="w") as h5:
+        dataset = create_hdf5(h5, names, dtype=matrix.dtype)
+        for start in range(0, matrix.shape[0], block_size):
+            dataset[start : start + block_size] = matrix[start : start + block_size]
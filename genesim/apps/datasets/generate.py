@@ -0,0 +1,77 @@
+from __future__ import unicode_literals
+
+import itertools
+import json
+
+import numpy
+import tables
+
+from genesim.apps.datasets.engine import SimilarityEngine
+from genesim.apps.datasets.export import create_hdf5
+
+# Yeast style systematic names, e.g., YAL001C: chromosome (A to P), arm,
+# position and strand. This is a fixed list, so names don't depend on size.
+CHROMOSOMES = "ABCDEFGHIJKLMNOP"
+SYSTEMATIC_NAMES = [
+    f"Y{chromosome}{arm}{position:03d}{strand}"
+    for chromosome, arm, position, strand in itertools.product(
+        CHROMOSOMES, "LR", range(1, 1000), "WC"
+    )
+]
+MAX_GENES = len(SYSTEMATIC_NAMES)
+
+
+def generate_names(size, seed=0):
+    """Return size gene names in a random (seeded) order. The names are a
+       prefix of the same permutation for any size, so the genes of a
+       smaller dataset are the first genes of a larger one.
+    """
+    if size > MAX_GENES:
+        raise ValueError(f"At most {MAX_GENES} genes can be generated.")
+    order = numpy.random.RandomState([seed, 0]).permutation(MAX_GENES)
+    return [SYSTEMATIC_NAMES[i] for i in order[:size]]
+
+
+def generate_features(size, seed=0, dimensions=32, dtype=numpy.float32):
+    """Return a unit length (seeded) random feature vector for each gene,
+       so the similarity matrix is their cosine similarity. Like the names,
+       the features of a smaller dataset are the first rows of a larger one.
+    """
+    features = numpy.random.RandomState([seed, 1]).randn(size, dimensions)
+    features /= numpy.linalg.norm(features, axis=1, keepdims=True)
+    return features.astype(dtype)
+
+
+def iter_similarity_blocks(features, block_size=250):
+    """Yield (first, block) for blocks of rows of the cosine similarity
+       matrix of the features (see engine.SimilarityEngine), so only
+       block_size rows are in memory. The matrix is symmetric, with exactly
+       1.0 on the diagonal.
+    """
+    engine = SimilarityEngine(features, metric="cosine", dtype=features.dtype)
+    return engine.iter_blocks(block_size)
+
+
+def write_dataset(path, names, features, block_size=250):
+    """Write the similarity matrix for the features to a memory mapped .npy
+       (with the names in <path>.genes.json), or the "similarities" dataset of
+       an HDF5 file, a block of rows at a time. The layout is the one written
+       by export_similarities and read by source.MatrixSource.
+    """
+    shape = (len(names), len(names))
+    if path.endswith(".npy"):
+        matrix = numpy.lib.format.open_memmap(
+            path, mode="w+", dtype=features.dtype, shape=shape
+        )
+        for first, block in iter_similarity_blocks(features, block_size):
+            matrix[first : first + len(block)] = block
+        matrix.flush()
+        del matrix
+        with open(f"{path}.genes.json", "w") as fd:
+            fd.write(json.dumps(names))
+        return
+
+    with tables.open_file(path, mode="w") as h5:
+        dataset = create_hdf5(h5, names, dtype=features.dtype)
+        for first, block in iter_similarity_blocks(features, block_size):
+            dataset[first : first + len(block)] = block
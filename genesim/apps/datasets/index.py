@@ -0,0 +1,128 @@
+from __future__ import unicode_literals
+
+import threading
+
+import numpy
+
+from genesim.apps.datasets.models import Gene, LoadGeneration
+
+
+class GeneIndex(object):
+    """Every gene's id and systematic name, read with one query, so loaders,
+       exporters and views translate names and ids without a query per gene.
+       Ids are kept sorted (for names_for), along with the names sorted (for
+       ids_for), so a list of names or ids is looked up with searchsorted,
+       and a dict is kept for single names.
+
+       An index is never changed, get_gene_index returns a new one after the
+       generation of the genes changes.
+    """
+
+    def __init__(self, ids, names, generation=None):
+        self.generation = generation
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        order = numpy.argsort(ids, kind="stable")
+        self.ids = ids[order]
+        self.names = numpy.array(names, dtype=object).reshape(-1)[order]
+
+        # Genes without a systematic name can't be looked up by name
+        named = numpy.array([name is not None for name in self.names], dtype=bool)
+        keys = numpy.array(self.names[named].tolist(), dtype=str)
+        order = numpy.argsort(keys, kind="stable")
+        self.sorted_names = keys[order]
+        self.sorted_ids = self.ids[named][order]
+        self.lookup = dict(zip(self.sorted_names.tolist(), self.sorted_ids.tolist()))
+
+    @classmethod
+    def load(cls, generation=None):
+        """Read the index from the genes table"""
+        genes = list(Gene.objects.order_by("id").values_list("id", "systematic_name"))
+        return cls(
+            [gene_id for gene_id, _ in genes], [name for _, name in genes], generation
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, name):
+        return name in self.lookup
+
+    def id_for(self, name, default=None):
+        return self.lookup.get(name, default)
+
+    def ids_for(self, names):
+        """Return a numpy array with the id of each name, in the same order,
+           raising KeyError if any name isn't a gene.
+        """
+        names = numpy.array(names, dtype=str).reshape(-1)
+        if not len(self.sorted_names):
+            positions = numpy.zeros(len(names), dtype=numpy.int64)
+            found = numpy.zeros(len(names), dtype=bool)
+        else:
+            positions = numpy.searchsorted(self.sorted_names, names)
+            positions = numpy.minimum(positions, len(self.sorted_names) - 1)
+            found = self.sorted_names[positions] == names
+        if not found.all():
+            missing = names[~found].tolist()
+            raise KeyError(f"{len(missing)} genes are missing: {missing[:5]}")
+        return self.sorted_ids[positions]
+
+    def names_for(self, ids):
+        """Return a list with the systematic name of each id, in the same
+           order, raising KeyError if any id isn't a gene.
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64).reshape(-1)
+        if not len(self.ids):
+            positions = numpy.zeros(len(ids), dtype=numpy.int64)
+            found = numpy.zeros(len(ids), dtype=bool)
+        else:
+            positions = numpy.searchsorted(self.ids, ids)
+            positions = numpy.minimum(positions, len(self.ids) - 1)
+            found = self.ids[positions] == ids
+        if not found.all():
+            missing = ids[~found].tolist()
+            raise KeyError(f"{len(missing)} gene ids are missing: {missing[:5]}")
+        return self.names[positions].tolist()
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_gene_index(refresh=False):
+    """Return the GeneIndex of this process, shared by every thread. It's
+       read again (lazily) when the generation of the genes changed since it
+       was read (see LoadGeneration), or with refresh, e.g., after genes were
+       added without a new generation. Like the cached ranked similarities,
+       the generation is read at most every LOAD_GENERATION_MAX_AGE seconds.
+    """
+    global _index
+    generation = LoadGeneration.get_recent_generation(LoadGeneration.GENES)
+    with _lock:
+        if refresh or _index is None or _index.generation != generation:
+            _index = GeneIndex.load(generation)
+        return _index
+
+
+def get_gene_index_for(names):
+    """Return the GeneIndex of this process, read again if it's missing any
+       of the names that are genes (e.g., created without a new generation).
+       Names that aren't genes cost one query to check, instead of reading
+       the entire index again.
+    """
+    index = get_gene_index()
+    missing = {name for name in names if name not in index}
+    if missing and Gene.objects.filter(systematic_name__in=missing).exists():
+        index = get_gene_index(refresh=True)
+    return index
+
+
+def get_gene_names(ids):
+    """Given gene ids, return a list of their systematic names in the same
+       order, from the GeneIndex of this process. Like matrix.get_gene_ids,
+       it's read again once if any of the ids is missing.
+    """
+    try:
+        return get_gene_index().names_for(ids)
+    except KeyError:
+        return get_gene_index(refresh=True).names_for(ids)
@@ -0,0 +1,144 @@
+from __future__ import unicode_literals
+
+import resource
+import sys
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.db import connection
+
+# Columns added to benchmark output after metric,seconds,count
+INSTRUMENT_COLUMNS = (
+    "queries",
+    "db_seconds",
+    "bytes_sent",
+    "peak_rss_bytes",
+    "peak_traced_bytes",
+)
+INSTRUMENT_HEADER = "metric,seconds,count,%s\n" % ",".join(INSTRUMENT_COLUMNS)
+
+
+def get_peak_rss(reset=False):
+    """Return the peak resident memory of this process in bytes. On Linux the
+       peak (VmHWM) can be reset from /proc, so each phase gets its own peak,
+       elsewhere it's the peak since the process started.
+    """
+    try:
+        if reset:
+            with open("/proc/self/clear_refs", "w") as fd:
+                fd.write("5")
+        with open("/proc/self/status", "r") as fd:
+            for line in fd:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Phase(object):
+    """Counters for one named phase of a load"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.seconds = None
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.bytes_sent = None
+        self.peak_rss = 0
+        self.peak_traced = None
+
+    def columns(self):
+        values = [
+            self.queries,
+            self.db_seconds,
+            self.bytes_sent,
+            self.peak_rss,
+            self.peak_traced,
+        ]
+        return ["" if value is None else str(value) for value in values]
+
+
+class Instrument(object):
+    """Named phase timers for a load command, that also count the queries
+       (and the time spent in them) sent through Django while a phase runs,
+       the bytes sent to COPY (COPY isn't a query) and the peak resident and
+       Python memory of the phase. Phases can be nested.
+
+       Queries and memory are counted for this process only, so the workers
+       of a parallel load aren't included. Tracing Python allocations
+       (tracemalloc) slows down Python heavy phases, so it's only on with
+       BENCHMARK_TRACEMALLOC=true.
+    """
+
+    def __init__(self, trace_memory=None):
+        if trace_memory is None:
+            trace_memory = getattr(settings, "BENCHMARK_TRACEMALLOC", False)
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self.active = []
+
+    def __call__(self, execute, sql, params, many, context):
+        """Installed with connection.execute_wrappers while phases run"""
+        start = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.time() - start
+            for phase in self.active:
+                phase.queries += 1
+                phase.db_seconds += seconds
+
+    def __getitem__(self, name):
+        return self.phases[name]
+
+    def record_peaks(self):
+        """Update the peaks of the running phases, before they're reset"""
+        for phase in self.active:
+            phase.peak_rss = max(phase.peak_rss, get_peak_rss())
+            if self.trace_memory:
+                traced = tracemalloc.get_traced_memory()[1]
+                phase.peak_traced = max(phase.peak_traced or 0, traced)
+
+    def start(self, name):
+        """Start timing (and counting for) a phase"""
+        self.record_peaks()
+        if not self.active:
+            connection.execute_wrappers.append(self)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+            # Python < 3.9 can only report the peak since tracing started
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        get_peak_rss(reset=True)
+
+        phase = self.phases[name] = Phase(name)
+        self.active.append(phase)
+        phase.start = time.time()
+
+    def stop(self, name, bytes_sent=None):
+        """Stop a phase, returning the seconds it took"""
+        phase = self.phases[name]
+        phase.seconds = time.time() - phase.start
+        phase.bytes_sent = bytes_sent
+        self.record_peaks()
+
+        self.active.remove(phase)
+        if not self.active:
+            connection.execute_wrappers.remove(self)
+        return phase.seconds
+
+    def columns(self, name=None):
+        """The extra output columns for a phase (empty for other metrics),
+           starting with a comma to follow metric,seconds,count
+        """
+        if name is None:
+            return "," * len(INSTRUMENT_COLUMNS)
+        return "," + ",".join(self.phases[name].columns())
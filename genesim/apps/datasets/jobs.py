@@ -0,0 +1,233 @@
+from __future__ import unicode_literals
+
+from contextlib import closing
+import json
+import os
+import socket
+import time
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from genesim.apps.datasets.matrix import get_gene_ids, get_name_ranks
+from genesim.apps.datasets.models import (
+    Gene,
+    LoadGeneration,
+    SimilarityLoadBlock,
+    SimilarityLoadJob,
+    is_symmetric,
+)
+from genesim.apps.datasets.pgcopy import iter_binary_chunks
+from genesim.apps.datasets.source import get_matrix
+from genesim.apps.datasets.stream import stream_copy
+from genesim.apps.datasets.topk import clear_top_similar
+
+PENDING = SimilarityLoadJob.PENDING
+DONE = SimilarityLoadJob.DONE
+FAILED = SimilarityLoadJob.FAILED
+
+
+def get_worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def read_genes(genes_json):
+    with open(genes_json, "r") as fd:
+        return json.loads(fd.read())
+
+
+def get_job_matrix(job, names):
+    """The matrix on disk of a job, or the engine computing it from expression"""
+    if job.expression:
+        return get_matrix(names, expression=job.source, metric=job.metric)
+    return get_matrix(names, job.source)
+
+
+def open_job(job):
+    """Return (matrix, ids, ranks) for the genes and matrix of a job. The
+       matrix is read (or computed from expression) a block at a time, so
+       a worker opens each job once. A job is only loaded with the storage
+       layout reads use (SYMMETRIC_SIMILARITY).
+    """
+    if job.symmetric != is_symmetric():
+        raise ValueError(
+            f"Job {job.id} is for symmetric={job.symmetric}, but reads use "
+            f"SYMMETRIC_SIMILARITY={is_symmetric()}."
+        )
+    names = read_genes(job.genes_json)
+    matrix = get_job_matrix(job, names)
+    return matrix, get_gene_ids(names), get_name_ranks(names)
+
+
+def create_job(
+    genes_json,
+    source,
+    metric="cosine",
+    expression=False,
+    symmetric=False,
+    block_size=250,
+):
+    """Create a job with a pending block for every block_size matrix rows.
+       The matrix is opened once to check it matches the genes, and genes
+       that don't exist yet are created, so workers only look them up.
+    """
+    job = SimilarityLoadJob(
+        genes_json=os.path.abspath(genes_json),
+        source=os.path.abspath(source),
+        expression=expression,
+        metric=metric,
+        symmetric=symmetric,
+        block_size=block_size,
+    )
+    names = read_genes(job.genes_json)
+    get_job_matrix(job, names)
+
+    with transaction.atomic():
+        Gene.objects.bulk_create(
+            [Gene(systematic_name=name, common_name=name) for name in names],
+            ignore_conflicts=True,
+        )
+        job.save()
+        SimilarityLoadBlock.objects.bulk_create(
+            [
+                SimilarityLoadBlock(
+                    job=job, first=first, last=min(first + block_size, len(names))
+                )
+                for first in range(0, len(names), block_size)
+            ]
+        )
+    LoadGeneration.bump(LoadGeneration.GENES)
+    return job
+
+
+def claim_block(job=None):
+    """Lock the first pending block (of a job, or of the oldest pending job)
+       that no other worker has locked, or return None if there is none.
+       Blocks that failed before are retried after the fresh blocks of the
+       job, so a failing block isn't claimed again straight away. This has
+       to run in a transaction, which holds the lock until the block is
+       checkpointed. If a worker dies its transaction is rolled back, and
+       the block is pending for the next worker.
+    """
+    blocks = SimilarityLoadBlock.objects.select_for_update(
+        skip_locked=True, of=("self",)
+    ).filter(status=PENDING, job__status=PENDING)
+    if job is not None:
+        blocks = blocks.filter(job=job)
+    return blocks.select_related("job").order_by("job_id", "attempts", "first").first()
+
+
+def load_block(block, matrix, ids, ranks, worker=None):
+    """Load the similarities for the rows of a block, and checkpoint it. The
+       rows are sent to a temporary table with binary COPY, and upserted with
+       INSERT ... ON CONFLICT, so loading a block again (or over an earlier
+       load) is harmless. Run in the transaction that claimed the block, so
+       the rows and the checkpoint are committed together. The load
+       generation and top similar genes are only touched once that commits
+       (see invalidate_metric), so workers don't wait on each other's locks.
+    """
+    job = block.job
+    start = time.time()
+    chunks = iter_binary_chunks(
+        matrix,
+        ids,
+        ranks,
+        metric=job.metric,
+        block_size=job.block_size,
+        start=block.first,
+        stop=block.last,
+        symmetric=job.symmetric,
+    )
+    columns = ("gene1_id", "gene2_id", "metric", "score")
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            """CREATE TEMPORARY TABLE similarity_load_block
+               (gene1_id integer, gene2_id integer, metric varchar(50),
+               score numeric(10, 3)) ON COMMIT DROP"""
+        )
+        stream_copy(
+            chunks,
+            table="similarity_load_block",
+            columns=columns,
+            binary=True,
+            bump=False,
+        )
+        cursor.execute(
+            """INSERT INTO datasets_genesimilarity (gene1_id, gene2_id, metric, score)
+               SELECT gene1_id, gene2_id, metric, score FROM similarity_load_block
+               ON CONFLICT (gene1_id, gene2_id, metric)
+               DO UPDATE SET score = EXCLUDED.score"""
+        )
+        rows = cursor.rowcount
+
+    block.status = DONE
+    block.attempts += 1
+    block.worker = worker
+    block.rows = rows
+    block.seconds = time.time() - start
+    block.error = None
+    block.completed = timezone.now()
+    block.save()
+    transaction.on_commit(lambda: invalidate_metric(job.metric))
+    return block
+
+
+def invalidate_metric(metric):
+    """After a block is committed, clear the top similar genes of its metric
+       (like the score updates, reads fall back to the similarity table) and
+       bump the load generation, each in its own short transaction.
+    """
+    clear_top_similar(metric)
+    LoadGeneration.bump()
+
+
+def finish_jobs():
+    """Mark pending jobs without any pending blocks as done (or failed, if a
+       block ran out of attempts). A block another worker is still loading
+       is pending, so that worker finishes the job.
+    """
+    pending = SimilarityLoadJob.objects.filter(status=PENDING).exclude(
+        blocks__status=PENDING
+    )
+    now = timezone.now()
+    failed = pending.filter(blocks__status=FAILED).distinct()
+    failed.update(status=FAILED, finished=now)
+    pending.update(status=DONE, finished=now)
+
+
+def run_worker(job=None, worker=None, max_blocks=None, max_attempts=3):
+    """Claim and load blocks (of a job, or of any pending job) until there
+       are none left, or max_blocks were claimed. A block that fails is
+       rolled back to its savepoint and released with the error, and after
+       max_attempts it's failed, along with its job right away, so no more
+       of its blocks are claimed. Yields each block.
+    """
+    worker = worker or get_worker_name()
+    opened = {}
+    claimed = 0
+    while max_blocks is None or claimed < max_blocks:
+        with transaction.atomic():
+            block = claim_block(job)
+            if block is None:
+                break
+            try:
+                with transaction.atomic():
+                    if block.job_id not in opened:
+                        opened[block.job_id] = open_job(block.job)
+                    matrix, ids, ranks = opened[block.job_id]
+                    load_block(block, matrix, ids, ranks, worker=worker)
+            except Exception as exc:
+                block.attempts += 1
+                block.worker = worker
+                block.error = f"{type(exc).__name__}: {exc}"
+                block.status = FAILED if block.attempts >= max_attempts else PENDING
+                block.save()
+                if block.status == FAILED:
+                    SimilarityLoadJob.objects.filter(id=block.job_id).update(
+                        status=FAILED, finished=timezone.now()
+                    )
+        claimed += 1
+        yield block
+
+    with transaction.atomic():
+        finish_jobs()
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+import sys
+
+from genesim.apps.datasets.engine import METRICS
+from genesim.apps.datasets.jobs import create_job
+from genesim.apps.datasets.models import is_symmetric
+
+
+class Command(BaseCommand):
+    help = "Create a resumable similarity load job, to be drained by load_worker"
+
+    def add_arguments(self, parser):
+        parser.add_argument("genes_json", type=str)
+        parser.add_argument(
+            "source", type=str, help="similarity matrix (.npy or HDF5) to load"
+        )
+        parser.add_argument(
+            "--expression",
+            action="store_true",
+            default=False,
+            help="the source is expression data to compute --metric from",
+        )
+        parser.add_argument("--metric", type=str, default="cosine")
+        parser.add_argument(
+            "--symmetric",
+            action="store_true",
+            default=False,
+            help="require symmetric storage (SYMMETRIC_SIMILARITY=true), gene1 <= gene2",
+        )
+        parser.add_argument(
+            "--block-size",
+            type=int,
+            default=250,
+            help="number of matrix rows in each block a worker claims",
+        )
+
+    def handle(self, *args, **options):
+
+        expression = options.get("expression")
+        metric = options.get("metric")
+        if expression and metric not in METRICS:
+            sys.exit(f"--metric must be one of {', '.join(METRICS)} with --expression.")
+
+        # Reads follow SYMMETRIC_SIMILARITY, so a load can't choose the layout
+        symmetric = is_symmetric()
+        if options.get("symmetric") and not symmetric:
+            sys.exit("--symmetric needs SYMMETRIC_SIMILARITY=true, reads follow it.")
+
+        try:
+            job = create_job(
+                options.get("genes_json"),
+                options.get("source"),
+                metric=metric,
+                expression=expression,
+                symmetric=symmetric,
+                block_size=options.get("block_size"),
+            )
+        except (OSError, ValueError) as exc:
+            sys.exit(str(exc))
+
+        print(f"Created job {job.id} with {job.blocks.count()} blocks.")
@@ -0,0 +1,112 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+import os
+import sys
+
+import json
+import tempfile
+import time
+
+from genesim.apps.datasets.index import get_gene_index
+from genesim.apps.datasets.models import is_symmetric
+from genesim.apps.datasets.export import create_npy, export_similarities, write_hdf5
+
+
+class Command(BaseCommand):
+    """Export the similarity matrix for a metric to a memory mapped .npy, or
+       an HDF5 file (.h5 or .hdf5), with COPY ... TO STDOUT. Rows and columns
+       are in the order of the genes (by id, or as listed in --genes).
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", type=str)
+        parser.add_argument("--metric", type=str, default="cosine")
+        parser.add_argument(
+            "--genes",
+            type=str,
+            default=None,
+            help="genes.json with the subset of genes (and order) to export",
+        )
+        parser.add_argument(
+            "--format",
+            choices=["binary", "text"],
+            default="binary",
+            help="COPY format to stream similarities with",
+        )
+        parser.add_argument(
+            "--dtype", choices=["float32", "float64"], default="float32"
+        )
+        parser.add_argument(
+            "--block-size",
+            type=int,
+            default=250,
+            help="number of matrix rows written to HDF5 at once",
+        )
+
+    def handle(self, *args, **options):
+
+        output = options.get("output")
+        genes_json = options.get("genes")
+        metric = options.get("metric")
+        binary = options.get("format") == "binary"
+        hdf5 = output.endswith((".h5", ".hdf5"))
+
+        if not hdf5 and not output.endswith(".npy"):
+            sys.exit("The output must be a .npy, .h5 or .hdf5 file.")
+
+        # The similarities are streamed with COPY ... TO STDOUT
+        if connection.vendor != "postgresql":
+            sys.exit("Exporting similarities is only available with PostgreSQL.")
+
+        # The gene order, from the database or the subset
+        index = get_gene_index()
+        if genes_json:
+            if not os.path.exists(genes_json):
+                sys.exit(f"{genes_json} does not exist.")
+            with open(genes_json, "r") as fd:
+                names = json.loads(fd.read())
+            missing = [name for name in names if name not in index]
+            if missing:
+                sys.exit(f"{len(missing)} genes are not in the database: {missing[:5]}")
+        else:
+            names = [name for name in index.names.tolist() if name is not None]
+        ids = index.ids_for(names)
+
+        # HDF5 is written from a temporary memory map, scattering is random access
+        path = output
+        if hdf5:
+            fd, path = tempfile.mkstemp(suffix=".npy")
+            os.close(fd)
+        matrix = create_npy(path, len(ids), dtype=options.get("dtype"))
+
+        print(f"Exporting {metric} similarities for {len(ids)} genes...")
+        start = time.time()
+        rows, bytes_received = export_similarities(
+            matrix,
+            ids,
+            metric=metric,
+            binary=binary,
+            symmetric=is_symmetric(),
+            subset=genes_json is not None,
+        )
+        copy_time = time.time() - start
+
+        start = time.time()
+        if hdf5:
+            write_hdf5(output, matrix, names, block_size=options.get("block_size"))
+            del matrix
+            os.remove(path)
+        else:
+            matrix.flush()
+            with open(f"{output}.genes.json", "w") as fd:
+                fd.write(json.dumps(names))
+        write_time = time.time() - start
+
+        seconds = copy_time + write_time
+        print(f"Received {rows} similarities ({bytes_received} bytes).")
+        print(f"Exported with COPY in {copy_time} seconds.")
+        print(f"Wrote {output} in {write_time} seconds.")
+        print(
+            f"Throughput: {rows / seconds:.0f} similarities/second, "
+            f"{bytes_received / seconds / 1e6:.1f} MB/second."
+        )
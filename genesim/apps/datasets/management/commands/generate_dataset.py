@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand
+import os
+import sys
+
+import json
+import time
+
+from genesim.apps.datasets.generate import (
+    MAX_GENES,
+    generate_features,
+    generate_names,
+    write_dataset,
+)
+
+
+class Command(BaseCommand):
+    """Generate a reproducible dataset from a seed: a genes.json, and the
+       similarity matrix for the genes as a memory mapped .npy or an HDF5
+       file (.h5 or .hdf5), written a block of rows at a time. Load it with
+       --matrix so every test loads the same genes and scores.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("genes_json", type=str)
+        parser.add_argument("output", type=str)
+        parser.add_argument(
+            "--size", type=int, default=6500, help=f"number of genes (max {MAX_GENES})"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--dimensions",
+            type=int,
+            default=32,
+            help="length of the random feature vector of each gene",
+        )
+        parser.add_argument(
+            "--dtype", choices=["float32", "float64"], default="float32"
+        )
+        parser.add_argument(
+            "--block-size",
+            type=int,
+            default=250,
+            help="number of matrix rows generated and written at once",
+        )
+
+    def handle(self, *args, **options):
+
+        genes_json = options.get("genes_json")
+        output = options.get("output")
+        size = options.get("size")
+        seed = options.get("seed")
+
+        if not output.endswith((".npy", ".h5", ".hdf5")):
+            sys.exit("The output must be a .npy, .h5 or .hdf5 file.")
+
+        try:
+            names = generate_names(size, seed=seed)
+        except ValueError as exc:
+            sys.exit(str(exc))
+
+        with open(genes_json, "w") as fd:
+            fd.write(json.dumps(names))
+
+        print(f"Generating similarities for {size} genes with seed {seed}...")
+        start = time.time()
+        features = generate_features(
+            size,
+            seed=seed,
+            dimensions=options.get("dimensions"),
+            dtype=options.get("dtype"),
+        )
+        write_dataset(output, names, features, block_size=options.get("block_size"))
+        seconds = time.time() - start
+
+        print(f"Wrote {len(names)} genes to {genes_json}.")
+        print(f"Wrote {output} ({os.path.getsize(output)} bytes) in {seconds} seconds.")
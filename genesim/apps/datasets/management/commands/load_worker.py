@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+import sys
+
+from genesim.apps.datasets.jobs import FAILED, get_worker_name, run_worker
+from genesim.apps.datasets.models import SimilarityLoadJob
+
+
+class Command(BaseCommand):
+    help = "Claim and load blocks of similarity load jobs until none are left"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--job",
+            type=int,
+            default=None,
+            help="only load blocks of this job (default: any pending job)",
+        )
+        parser.add_argument(
+            "--max-blocks",
+            type=int,
+            default=None,
+            help="stop after claiming this many blocks",
+        )
+        parser.add_argument(
+            "--max-attempts",
+            type=int,
+            default=3,
+            help="attempts before a block (and its job) is failed",
+        )
+        parser.add_argument("--name", type=str, default=None, help="worker name")
+
+    def handle(self, *args, **options):
+
+        # Blocks are claimed with SKIP LOCKED, and loaded with binary COPY
+        if connection.vendor != "postgresql":
+            sys.exit("Load jobs are only available with PostgreSQL.")
+
+        job = None
+        if options.get("job") is not None:
+            job = SimilarityLoadJob.objects.filter(id=options.get("job")).first()
+            if job is None:
+                sys.exit(f"There is no job {options.get('job')}.")
+
+        worker = options.get("name") or get_worker_name()
+        blocks = run_worker(
+            job=job,
+            worker=worker,
+            max_blocks=options.get("max_blocks"),
+            max_attempts=options.get("max_attempts"),
+        )
+
+        total = 0
+        for block in blocks:
+            rows = f"{block.first} to {block.last}"
+            if block.error and block.status != SimilarityLoadJob.DONE:
+                failed = " (failed)" if block.status == FAILED else ""
+                print(f"Job {block.job_id} rows {rows}{failed}: {block.error}")
+                continue
+            total += block.rows
+            print(
+                f"Job {block.job_id} rows {rows}: {block.rows} similarities in {block.seconds} seconds."
+            )
+        print(f"Worker {worker} loaded {total} similarities.")
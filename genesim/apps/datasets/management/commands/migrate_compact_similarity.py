@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+import time
+
+from genesim.apps.datasets.models import CompactGeneSimilarity
+
+from contextlib import closing
+
+from django.db import connection, transaction
+
+
+class Command(BaseCommand):
+    help = "Copy GeneSimilarity rows to the compact CompactGeneSimilarity table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--metric", type=str, default=None, help="only copy rows for this metric"
+        )
+        parser.add_argument(
+            "--delete",
+            action="store_true",
+            default=False,
+            help="delete the copied rows from GeneSimilarity afterwards",
+        )
+
+    def handle(self, *args, **options):
+
+        metric = options.get("metric")
+        where = "WHERE s.metric = %s" if metric else ""
+        params = [metric] if metric else []
+        start = time.time()
+
+        # Set based, the metric names are looked up once, not per row
+        with transaction.atomic(), closing(connection.cursor()) as cursor:
+            cursor.execute(
+                f"""INSERT INTO datasets_metric (name)
+                    SELECT DISTINCT s.metric FROM datasets_genesimilarity s {where}
+                    ON CONFLICT (name) DO NOTHING""",
+                params,
+            )
+            cursor.execute(
+                f"""INSERT INTO datasets_compactgenesimilarity
+                    (gene1_id, gene2_id, metric_id, scaled_score)
+                    SELECT s.gene1_id, s.gene2_id, m.id, round(s.score * %s)::integer
+                    FROM datasets_genesimilarity s
+                    JOIN datasets_metric m ON m.name = s.metric {where}
+                    ON CONFLICT (gene1_id, gene2_id, metric_id) DO UPDATE
+                    SET scaled_score = EXCLUDED.scaled_score""",
+                [CompactGeneSimilarity.SCORE_SCALE] + params,
+            )
+            total = cursor.rowcount
+
+            if options.get("delete"):
+                cursor.execute(f"DELETE FROM datasets_genesimilarity s {where}", params)
+
+        print(f"Copied {total} similarities in {time.time() - start} seconds.")
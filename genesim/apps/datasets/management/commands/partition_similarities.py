@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+import sys
+import time
+
+from genesim.apps.datasets.partition import (
+    is_partitioned,
+    partition_table,
+    unpartition_table,
+)
+
+from django.db import connection
+
+
+class Command(BaseCommand):
+    help = "Partition datasets_genesimilarity by LIST (metric), then HASH (gene1_id)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--partitions",
+            type=int,
+            default=8,
+            help="number of hash partitions on gene1_id for each metric",
+        )
+        parser.add_argument(
+            "--metrics",
+            nargs="+",
+            default=["cosine"],
+            help="metrics to create partitions for (in addition to those loaded)",
+        )
+        parser.add_argument(
+            "--revert",
+            action="store_true",
+            default=False,
+            help="convert the partitioned table back to a single table",
+        )
+
+    def handle(self, *args, **options):
+
+        if connection.vendor != "postgresql":
+            sys.exit("Partitioning is only available with PostgreSQL.")
+
+        start = time.time()
+        if options.get("revert"):
+            if not is_partitioned():
+                sys.exit("datasets_genesimilarity isn't partitioned.")
+            unpartition_table()
+            print(f"Unpartitioned similarities in {time.time() - start} seconds.")
+            return
+
+        if is_partitioned():
+            sys.exit("datasets_genesimilarity is already partitioned.")
+        try:
+            partition_table(
+                partitions=options.get("partitions"), metrics=options.get("metrics")
+            )
+        except ValueError as exc:
+            sys.exit(str(exc))
+        print(f"Partitioned similarities in {time.time() - start} seconds.")
@@ -0,0 +1,203 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from importlib import import_module
+import os
+import sys
+
+import json
+import numpy
+
+from genesim.apps.datasets.instrument import Instrument
+from genesim.apps.datasets.models import LoadGeneration
+from genesim.apps.datasets.reset import reset_genes
+from genesim.apps.datasets.source import MatrixSource
+from genesim.apps.datasets.strategies import STRATEGIES
+
+
+def summarize(strategy, genes, phase, runs, rows):
+    """One tidy record for the repetitions (instrumented phases) of a phase
+       of a strategy, with the median queries and the largest peak memory.
+    """
+    seconds = [run.seconds for run in runs]
+    median = float(numpy.median(seconds))
+    bytes_sent = [run.bytes_sent for run in runs if run.bytes_sent is not None]
+    traced = [run.peak_traced for run in runs if run.peak_traced is not None]
+    return {
+        "strategy": strategy,
+        "genes": genes,
+        "phase": phase,
+        "repetitions": len(seconds),
+        "median_seconds": median,
+        "p95_seconds": float(numpy.percentile(seconds, 95)),
+        "min_seconds": float(numpy.min(seconds)),
+        "rows": rows,
+        "rows_per_second": rows / median if median else None,
+        "queries": float(numpy.median([run.queries for run in runs])),
+        "db_seconds": float(numpy.median([run.db_seconds for run in runs])),
+        "bytes_sent": max(bytes_sent) if bytes_sent else None,
+        "peak_rss_bytes": max(run.peak_rss for run in runs),
+        "peak_traced_bytes": max(traced) if traced else None,
+        "seconds": seconds,
+    }
+
+
+class Command(BaseCommand):
+    """Run load strategies (see strategies.py) for a sweep of gene counts,
+       with warmup runs and repetitions, and write the median and 95th
+       percentile of each phase to one tidy .csv or .json file.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("genes_json", type=str)
+        parser.add_argument("output_file", type=str)
+        parser.add_argument(
+            "--strategies",
+            nargs="+",
+            default=None,
+            help="strategies to run (all registered strategies by default)",
+        )
+        parser.add_argument(
+            "--sizes",
+            nargs="+",
+            type=int,
+            default=[100, 500, 2000, 6500],
+            help="numbers of genes (the first of genes_json) to load",
+        )
+        parser.add_argument("--warmup", type=int, default=1)
+        parser.add_argument("--repetitions", type=int, default=3)
+        parser.add_argument(
+            "--seed", type=int, default=0, help="seed for the random scores"
+        )
+        parser.add_argument(
+            "--matrix",
+            type=str,
+            default=None,
+            help="similarity matrix (.npy or HDF5) for the genes of genes_json, "
+            "sliced to each size instead of random scores",
+        )
+        parser.add_argument("--metric", type=str, default="cosine")
+        parser.add_argument("--block-size", type=int, default=250)
+        parser.add_argument(
+            "--workers", type=int, default=4, help="workers for parallel strategies"
+        )
+
+    def handle(self, *args, **options):
+
+        output_file = options.get("output_file")
+        genes_json = options.get("genes_json")
+        sizes = options.get("sizes")
+        warmup = options.get("warmup")
+        repetitions = options.get("repetitions")
+
+        # Strategies from other modules register themselves when imported
+        for module in getattr(settings, "BENCHMARK_STRATEGY_MODULES", []):
+            import_module(module)
+
+        # By default, the strategies that run on this database
+        supported = [
+            name
+            for name, strategy in STRATEGIES.items()
+            if strategy.vendors is None or connection.vendor in strategy.vendors
+        ]
+        names = options.get("strategies") or supported
+        unknown = [name for name in names if name not in STRATEGIES]
+        if unknown:
+            sys.exit(f"Unknown strategies {unknown}, choices are {list(STRATEGIES)}")
+        unsupported = [name for name in names if name not in supported]
+        if unsupported:
+            sys.exit(f"Strategies {unsupported} don't run on {connection.vendor}.")
+
+        if not output_file.endswith((".csv", ".json")):
+            sys.exit("The output_file must be a .csv or .json file.")
+
+        if repetitions < 1:
+            sys.exit("At least one repetition is required.")
+
+        # Similarity scores are required
+        if not os.path.exists(genes_json):
+            sys.exit("genes.json is required.")
+
+        with open(genes_json, "r") as fd:
+            genes = json.loads(fd.read())
+
+        if max(sizes) > len(genes):
+            sys.exit(f"There are only {len(genes)} genes in {genes_json}.")
+
+        # The scores of the first genes of a real matrix, if there is one
+        source = None
+        if options.get("matrix"):
+            source = MatrixSource(options.get("matrix"))
+            if max(sizes) > len(source):
+                sys.exit(f"There are only {len(source)} genes in {source.path}.")
+            gene_names = (source.get_names() or genes)[: max(sizes)]
+            if gene_names != genes[: max(sizes)]:
+                sys.exit(
+                    f"The genes of {source.path} are not the genes of {genes_json}."
+                )
+
+        results = []
+        for name in names:
+            strategy = STRATEGIES[name](
+                metric=options.get("metric"),
+                block_size=options.get("block_size"),
+                workers=options.get("workers"),
+            )
+            for size in sizes:
+
+                # Every strategy loads the same genes and scores for a size
+                subset = genes[:size]
+                if source is not None:
+                    matrix = source[:size, :size]
+                else:
+                    random = numpy.random.RandomState(options.get("seed"))
+                    matrix = random.randn(size, size)
+
+                runs = {"create_genes": [], "create_sims": [], "total": []}
+                for run in range(warmup + repetitions):
+                    reset_genes()
+
+                    instrument = Instrument()
+                    instrument.start("total")
+                    instrument.start("create_genes")
+                    strategy.create_genes(subset)
+                    create_genes_time = instrument.stop("create_genes")
+
+                    strategy.bytes_sent = None
+                    instrument.start("create_sims")
+                    rows = strategy.create_similarities(subset, matrix)
+                    create_sims_time = instrument.stop(
+                        "create_sims", bytes_sent=strategy.bytes_sent
+                    )
+                    instrument.stop("total", bytes_sent=strategy.bytes_sent)
+                    LoadGeneration.bump()
+
+                    kind = "warmup" if run < warmup else "run"
+                    print(
+                        f"{name} {size} genes {kind} {run + 1}: "
+                        f"{create_genes_time} + {create_sims_time} seconds."
+                    )
+                    if run < warmup:
+                        continue
+                    for phase in runs:
+                        runs[phase].append(instrument[phase])
+
+                counts = {"create_genes": size, "create_sims": rows, "total": rows}
+                for phase, phases in runs.items():
+                    results.append(summarize(name, size, phase, phases, counts[phase]))
+
+        # Save to output file, one row per strategy, size and phase
+        with open(output_file, "w") as fd:
+            if output_file.endswith(".json"):
+                fd.write(json.dumps(results, indent=4))
+            else:
+                columns = [column for column in results[0] if column != "seconds"]
+                fd.writelines(",".join(columns) + "\n")
+                for result in results:
+                    fd.writelines(
+                        ",".join(
+                            "" if result[column] is None else str(result[column])
+                            for column in columns
+                        )
+                        + "\n"
+                    )
@@ -0,0 +1,177 @@
+from django.core.management.base import BaseCommand
+import sys
+
+import json
+
+from genesim.apps.datasets.index import get_gene_index
+from genesim.apps.datasets.models import GeneSimilarity, GeneTopSimilar
+from genesim.apps.datasets.reads import (
+    SHAPES,
+    ConcurrentLoad,
+    ReadWorkload,
+    run_reads,
+    summarize_reads,
+)
+
+from django.db import connection
+
+
+def parse_mix(values):
+    """Parse shape=weight pairs, e.g., ranked=1 top_k=8 pairs=1"""
+    mix = {}
+    for value in values:
+        shape, _, weight = value.partition("=")
+        mix[shape] = float(weight or 1)
+    return mix
+
+
+class Command(BaseCommand):
+    """Measure the reads the app serves against the loaded similarities: a
+       mix of ranked, top k and pair queries from a pool of threads, first
+       on an idle database and then while another process loads a matrix
+       with COPY. The QPS and p50, p95 and p99 latency of each query shape
+       are written to a .csv or .json file.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("output_file", type=str)
+        parser.add_argument(
+            "--mix",
+            nargs="+",
+            default=["ranked=1", "top_k=8", "pairs=1"],
+            help=f"weights of the query shapes ({', '.join(SHAPES)})",
+        )
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument(
+            "--duration", type=float, default=10, help="seconds of reads to record"
+        )
+        parser.add_argument(
+            "--warmup", type=float, default=2, help="seconds of reads before recording"
+        )
+        parser.add_argument("--metric", type=str, default="cosine")
+        parser.add_argument("--top-k", type=int, default=10)
+        parser.add_argument(
+            "--pair-batch", type=int, default=100, help="pairs in each pair lookup"
+        )
+        parser.add_argument(
+            "--load",
+            choices=["none", "concurrent", "both"],
+            default="both",
+            help="run the reads without, with, or both without and with a load",
+        )
+        parser.add_argument(
+            "--load-metric",
+            type=str,
+            default="benchmark_load",
+            help="metric the concurrent load writes (and removes afterwards)",
+        )
+        parser.add_argument("--block-size", type=int, default=250)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+
+        output_file = options.get("output_file")
+        metric = options.get("metric")
+        threads = options.get("threads")
+
+        if not output_file.endswith((".csv", ".json")):
+            sys.exit("The output_file must be a .csv or .json file.")
+        if options.get("load_metric") == metric:
+            sys.exit("The concurrent load must write another metric than the reads.")
+        if connection.vendor == "sqlite" and options.get("load") != "none":
+            sys.exit("SQLite allows one writer at a time, use --load none.")
+
+        # Reads need a loaded database (any of the create tests)
+        gene_ids = get_gene_index().ids
+        if not GeneSimilarity.objects.filter(metric=metric).exists():
+            sys.exit(f"There are no {metric} similarities, load some first.")
+
+        try:
+            workload = ReadWorkload(
+                gene_ids,
+                parse_mix(options.get("mix")),
+                metric=metric,
+                top_k=options.get("top_k"),
+                pair_batch=options.get("pair_batch"),
+            )
+        except ValueError as exc:
+            sys.exit(str(exc))
+
+        # Top k reads measure GeneTopSimilar, not a ranked query with a LIMIT
+        top_k = options.get("top_k")
+        loaded = GeneTopSimilar.objects.filter(metric=metric, rank=top_k - 1)
+        if "top_k" in workload.shapes and not loaded.exists():
+            sys.exit(f"Load the top {top_k} {metric} similar genes first (--top-k).")
+
+        loads = ["none", "concurrent"]
+        if options.get("load") != "both":
+            loads = [options.get("load")]
+
+        results = []
+        for load in loads:
+            print(f"Reading with {threads} threads ({load} load)...")
+            load_rows = None
+            if load == "none":
+                timings, errors, first_error, seconds = run_reads(
+                    workload,
+                    threads=threads,
+                    duration=options.get("duration"),
+                    warmup=options.get("warmup"),
+                    seed=options.get("seed"),
+                )
+            else:
+                with ConcurrentLoad(
+                    options.get("load_metric"),
+                    block_size=options.get("block_size"),
+                    seed=options.get("seed"),
+                ) as concurrent:
+                    timings, errors, first_error, seconds = run_reads(
+                        workload,
+                        threads=threads,
+                        duration=options.get("duration"),
+                        warmup=options.get("warmup"),
+                        seed=options.get("seed"),
+                    )
+                load_rows = concurrent.rows
+
+            # A shape that never succeeded would be missing from the results
+            if first_error is not None:
+                print(f"Errors {errors}, the first was:\n{first_error}")
+            recorded = {shape for shape, _, _ in timings}
+            failed = [shape for shape in errors if shape not in recorded]
+            if failed:
+                sys.exit(f"Every {', '.join(failed)} read failed ({load} load).")
+
+            summary = summarize_reads(
+                timings,
+                seconds,
+                errors,
+                load=load,
+                threads=threads,
+                load_rows=load_rows,
+            )
+            for result in summary:
+                print(
+                    f"{result['shape']}: {result['qps']} qps, p50 {result['p50_ms']} ms,"
+                    f" p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms"
+                )
+            results.extend(summary)
+
+        if not results:
+            sys.exit("No reads were recorded.")
+
+        # Save to output file, one row per load and query shape
+        with open(output_file, "w") as fd:
+            if output_file.endswith(".json"):
+                fd.write(json.dumps(results, indent=4))
+            else:
+                columns = list(results[0])
+                fd.writelines(",".join(columns) + "\n")
+                for result in results:
+                    fd.writelines(
+                        ",".join(
+                            "" if result[column] is None else str(result[column])
+                            for column in columns
+                        )
+                        + "\n"
+                    )
@@ -0,0 +1,169 @@
+from django.core.management.base import BaseCommand
+import os
+import sys
+
+import json
+import numpy
+
+from genesim.apps.datasets.index import get_gene_index
+from genesim.apps.datasets.instrument import INSTRUMENT_HEADER, Instrument
+from genesim.apps.datasets.models import LoadGeneration, is_symmetric
+from genesim.apps.datasets.matrix import get_name_ranks
+from genesim.apps.datasets.pgcopy import iter_added_binary_chunks
+from genesim.apps.datasets.stream import stream_copy
+from genesim.apps.datasets.reset import DERIVED_TABLES, delete_genes, reset_genes
+
+from contextlib import closing
+import csv
+from io import StringIO
+
+from django.db import connection
+
+
+class Command(BaseCommand):
+    """Update the genes (and their similarities) to match a genes.json,
+       only writing similarities for added genes and deleting those of
+       removed genes, instead of reloading the entire matrix. The vectors,
+       compact scores and top similar genes of the metric are cleared, they
+       are reloaded with tests 10, 11 and 7.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("genes_json", type=str)
+        parser.add_argument("output_file", type=str)
+        parser.add_argument("--metric", type=str, default="cosine")
+        parser.add_argument(
+            "--seed", type=int, default=None, help="seed for the new random scores"
+        )
+        parser.add_argument(
+            "--symmetric",
+            action="store_true",
+            default=False,
+            help="require symmetric storage (SYMMETRIC_SIMILARITY=true), gene1 <= gene2",
+        )
+        parser.add_argument(
+            "--block-size",
+            type=int,
+            default=250,
+            help="number of added genes in each chunk sent to COPY",
+        )
+
+    def handle(self, *args, **options):
+
+        output_file = options.get("output_file")
+        genes_json = options.get("genes_json")
+        metric = options.get("metric")
+
+        # Genes are deleted with = ANY(%s), and similarities created with COPY
+        if connection.vendor != "postgresql":
+            sys.exit("Syncing genes is only available with PostgreSQL.")
+
+        # Reads follow SYMMETRIC_SIMILARITY, so a load can't choose the layout
+        symmetric = is_symmetric()
+        if options.get("symmetric") and not symmetric:
+            sys.exit("--symmetric needs SYMMETRIC_SIMILARITY=true, reads follow it.")
+
+        # Similarity scores are required
+        if not os.path.exists(genes_json):
+            sys.exit("genes.json is required.")
+
+        with open(genes_json, "r") as fd:
+            genes = json.loads(fd.read())
+
+        # Diff the incoming genes against the table
+        instrument = Instrument()
+        instrument.start("diff_genes")
+        existing = get_gene_index().lookup
+        incoming = set(genes)
+        added = [name for name in genes if name not in existing]
+        removed = [
+            gene_id for name, gene_id in existing.items() if name not in incoming
+        ]
+        diff_time = instrument.stop("diff_genes")
+        print(f"Found {len(added)} added and {len(removed)} removed genes.")
+
+        # Related rows are deleted in bulk by gene id, without the collector
+        instrument.start("delete_genes")
+        deleted_sims = delete_genes(removed)
+        delete_time = instrument.stop("delete_genes")
+        print(f"Deleted {deleted_sims} similarities in {delete_time} seconds.")
+
+        instrument.start("create_genes")
+        stream = StringIO()
+        writer = csv.writer(stream, delimiter="\t")
+        for gene in added:
+            writer.writerow([gene, gene])
+        stream.seek(0)
+
+        # Write genes from csv stream
+        with closing(connection.cursor()) as cursor:
+            cursor.copy_from(
+                file=stream,
+                table="datasets_gene",
+                sep="\t",
+                columns=("systematic_name", "common_name"),
+            )
+        LoadGeneration.bump(LoadGeneration.GENES)
+        create_genes_time = instrument.stop("create_genes")
+
+        # Only the rows (and columns) of added genes are new
+        instrument.start("create_sims")
+        bytes_sent = 0
+        index = get_gene_index(refresh=True)
+        names = index.names.tolist()
+        ids = index.ids
+        ranks = get_name_ranks(names)
+        positions = {name: i for i, name in enumerate(names)}
+        added_positions = numpy.array(
+            [positions[name] for name in added], dtype=numpy.int64
+        )
+        random = numpy.random.RandomState(options.get("seed"))
+        matrix = random.randn(len(added), len(names))
+
+        chunks = iter_added_binary_chunks(
+            matrix,
+            ids,
+            ranks,
+            added_positions,
+            metric=metric,
+            block_size=options.get("block_size"),
+            symmetric=symmetric,
+        )
+        if added:
+            bytes_sent = stream_copy(
+                chunks,
+                table="datasets_genesimilarity",
+                columns=("gene1_id", "gene2_id", "metric", "score"),
+                binary=True,
+            )
+
+        # Pairs with existing genes, pairs among added genes, and the diagonal
+        pairs = len(added) * (len(names) - len(added))
+        pairs += len(added) * (len(added) - 1) // 2
+        created_sims = len(added) + (pairs if symmetric else 2 * pairs)
+        create_sims_time = instrument.stop("create_sims", bytes_sent=bytes_sent)
+        print(f"Created {created_sims} similarities in {create_sims_time} seconds.")
+
+        # Rows derived from the matrix of the metric are stale, reads of the
+        # top similar genes fall back to the similarities until reloaded
+        if added or removed:
+            reset_genes(metric=metric, tables=DERIVED_TABLES)
+
+        # Save to output file
+        with open(output_file, "w") as fd:
+            fd.writelines(INSTRUMENT_HEADER)
+            fd.writelines(
+                f"sync_diff_genes,{diff_time},{len(genes)}{instrument.columns('diff_genes')}\n"
+            )
+            fd.writelines(
+                f"sync_delete_genes,{delete_time},{len(removed)}{instrument.columns('delete_genes')}\n"
+            )
+            fd.writelines(
+                f"sync_delete_sims,{delete_time},{deleted_sims}{instrument.columns()}\n"
+            )
+            fd.writelines(
+                f"sync_create_genes,{create_genes_time},{len(added)}{instrument.columns('create_genes')}\n"
+            )
+            fd.writelines(
+                f"sync_create_sims,{create_sims_time},{created_sims}{instrument.columns('create_sims')}\n"
+            )
@@ -0,0 +1,209 @@
+from django.core.management.base import BaseCommand
+import os
+import sys
+
+import json
+import pandas
+import numpy
+
+from genesim.apps.datasets.models import (
+    CompactGeneSimilarity,
+    Gene,
+    GeneSimilarity,
+    Metric,
+    is_symmetric,
+)
+from genesim.apps.datasets.matrix import get_gene_ids, get_name_ranks
+from genesim.apps.datasets.pgcopy import iter_binary_chunks, iter_compact_chunks
+from genesim.apps.datasets.stats import get_table_sizes
+from genesim.apps.datasets.stream import stream_copy
+from genesim.apps.datasets.instrument import INSTRUMENT_HEADER, Instrument
+from genesim.apps.datasets.reset import reset_genes
+from genesim.apps.datasets.source import get_matrix
+
+from contextlib import closing
+import csv
+from io import StringIO
+
+from django.db import connection
+
+
+def create_sims(genes):
+    """Create a random matrix of values, they aren't actually similarity values
+    """
+    # Create a random valued matrix
+    matrix = numpy.random.randn(len(genes), len(genes))
+
+    # Create a pandas data frame for fake similarity scores
+    df = pandas.DataFrame(matrix)
+
+    # Add labels - these of course are wrong because they should mirror
+    df.index = genes
+    df.columns = genes
+    return df
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("genes_json", type=str)
+        parser.add_argument("output_file", type=str)
+        parser.add_argument(
+            "--matrix",
+            type=str,
+            default=None,
+            help="similarity matrix (.npy or HDF5) to load instead of random scores",
+        )
+        parser.add_argument(
+            "--block-size",
+            type=int,
+            default=250,
+            help="number of matrix rows in each chunk sent to COPY",
+        )
+        parser.add_argument(
+            "--queue-size",
+            type=int,
+            default=8,
+            help="maximum number of chunks waiting to be sent to COPY",
+        )
+
+    def handle(self, *args, **options):
+
+        output_file = options.get("output_file")
+        genes_json = options.get("genes_json")
+        block_size = options.get("block_size")
+        queue_size = options.get("queue_size")
+
+        # Start fresh, truncate all genes (also truncates both kinds of similarities)
+        instrument = Instrument()
+        instrument.start("reset")
+        reset_genes()
+        reset_time = instrument.stop("reset")
+        print(f"Reset genes in {reset_time} seconds.")
+
+        # All three inputs are required
+        if not output_file or not genes_json:
+            sys.exit("genes_json, and output_file are required")
+
+        # Similarity scores are required
+        if not os.path.exists(genes_json):
+            sys.exit("genes.json is required.")
+
+        with open(genes_json, "r") as fd:
+            genes = json.loads(fd.read())
+
+        print(f"Creating {len(genes)} genes...")
+        instrument.start("create_genes")
+
+        # Create stream (to write names)
+        stream = StringIO()
+        writer = csv.writer(stream, delimiter="\t")
+        for gene in genes:
+            writer.writerow([gene, gene])
+        stream.seek(0)
+
+        # Write genes from csv stream
+        with closing(connection.cursor()) as cursor:
+            cursor.copy_from(
+                file=stream,
+                table="datasets_gene",
+                sep="\t",
+                columns=("systematic_name", "common_name"),
+            )
+
+        # metric 1: time to create genes in seconds
+        create_genes_time = instrument.stop("create_genes")
+        total = Gene.objects.count()
+
+        print(f"Created {total} genes in {create_genes_time} seconds.")
+
+        # Random scores, or a matrix on disk that is read a block of rows at a time
+        try:
+            matrix = get_matrix(genes, options.get("matrix"), create_sims)
+        except (OSError, ValueError) as exc:
+            sys.exit(str(exc))
+
+        # One query for the name -> id lookup, and name ordering as ranks
+        names = genes
+        ids = get_gene_ids(names)
+        ranks = get_name_ranks(names)
+        metric, _ = Metric.objects.get_or_create(name="cosine")
+        symmetric = is_symmetric()
+
+        # The same matrix is loaded into the current and the compact schema
+        schemas = [
+            (
+                "current",
+                GeneSimilarity,
+                iter_binary_chunks(
+                    matrix, ids, ranks, block_size=block_size, symmetric=symmetric
+                ),
+                ("gene1_id", "gene2_id", "metric", "score"),
+            ),
+            (
+                "compact",
+                CompactGeneSimilarity,
+                iter_compact_chunks(
+                    matrix,
+                    ids,
+                    ranks,
+                    metric.id,
+                    block_size=block_size,
+                    symmetric=symmetric,
+                ),
+                ("gene1_id", "gene2_id", "metric_id", "scaled_score"),
+            ),
+        ]
+
+        results = []
+        for schema, model, chunks, columns in schemas:
+            print(f"Streaming similarities to the {schema} schema...")
+            instrument.start(f"{schema}_create_sims")
+            bytes_sent = stream_copy(
+                chunks,
+                table=model._meta.db_table,
+                columns=columns,
+                maxsize=queue_size,
+                binary=True,
+            )
+            create_sims_time = instrument.stop(
+                f"{schema}_create_sims", bytes_sent=bytes_sent
+            )
+            total_sims = model.objects.count()
+            table_size, index_size = get_table_sizes(model._meta.db_table)
+            print(
+                f"Created {total_sims} genes similarities in {create_sims_time} seconds."
+            )
+            results.append(
+                (
+                    schema,
+                    create_sims_time,
+                    total_sims,
+                    table_size,
+                    index_size,
+                    bytes_sent,
+                )
+            )
+
+        total_genes = Gene.objects.count()
+
+        # Save to output file, sizes are in bytes
+        with open(output_file, "w") as fd:
+            fd.writelines(INSTRUMENT_HEADER)
+            fd.writelines(f"compact_reset,{reset_time},{instrument.columns('reset')}\n")
+            fd.writelines(
+                f"compact_create_genes,{create_genes_time},{total_genes}{instrument.columns('create_genes')}\n"
+            )
+            for schema, seconds, total, table_size, index_size, bytes_sent in results:
+                fd.writelines(
+                    f"{schema}_create_sims,{seconds},{total}"
+                    f"{instrument.columns(f'{schema}_create_sims')}\n"
+                )
+                fd.writelines(
+                    f"{schema}_table_bytes,,{table_size}{instrument.columns()}\n"
+                )
+                fd.writelines(
+                    f"{schema}_index_bytes,,{index_size}{instrument.columns()}\n"
+                )
+                fd.writelines(
+                    f"{schema}_bytes_sent,{seconds},{bytes_sent}{instrument.columns()}\n"
+                )
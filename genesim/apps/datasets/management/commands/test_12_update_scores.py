@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+import sys
+
+import numpy
+
+from genesim.apps.datasets.instrument import INSTRUMENT_HEADER, Instrument
+from genesim.apps.datasets.models import GeneSimilarity
+from genesim.apps.datasets.update import (
+    bulk_update_scores,
+    copy_update_scores,
+    sample_similarities,
+    upsert_scores,
+)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("output_file", type=str)
+        parser.add_argument(
+            "--fraction",
+            type=float,
+            default=0.01,
+            help="fraction of the similarity pairs to give a new score",
+        )
+        parser.add_argument("--metric", type=str, default="cosine")
+        parser.add_argument(
+            "--seed", type=int, default=0, help="seed to sample pairs and scores"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="rows per statement for bulk_update and the upsert",
+        )
+
+    def handle(self, *args, **options):
+
+        output_file = options.get("output_file")
+        fraction = options.get("fraction")
+        metric = options.get("metric")
+        batch_size = options.get("batch_size")
+
+        # Pairs are sampled with TABLESAMPLE, and updated with COPY and unnest
+        if connection.vendor != "postgresql":
+            sys.exit("Updating scores is only available with PostgreSQL.")
+
+        # Updates are done on an existing matrix, so we don't start fresh
+        if not GeneSimilarity.objects.filter(metric=metric).exists():
+            sys.exit(f"Load a matrix with metric {metric} first, e.g., with test 7.")
+
+        print(f"Sampling {fraction} of the pairs for {metric}...")
+        ids, gene1, gene2, pairs = sample_similarities(
+            fraction, metric=metric, seed=options.get("seed")
+        )
+        print(f"Updating {len(ids)} similarities with each strategy...")
+
+        # Each strategy gets new scores, the same for both ways of a pair
+        random = numpy.random.RandomState(options.get("seed"))
+        strategies = [
+            (
+                "update_bulk_update",
+                lambda scores: bulk_update_scores(
+                    ids, scores, metric=metric, batch_size=batch_size
+                ),
+            ),
+            (
+                "update_copy_from",
+                lambda scores: copy_update_scores(gene1, gene2, scores, metric=metric),
+            ),
+            (
+                "update_upsert",
+                lambda scores: upsert_scores(
+                    gene1, gene2, scores, metric=metric, page_size=batch_size
+                ),
+            ),
+        ]
+
+        instrument = Instrument()
+        results = []
+        for name, update in strategies:
+            scores = random.randn(pairs.max() + 1 if len(pairs) else 0)[pairs]
+            instrument.start(name)
+            total = update(scores)
+            seconds = instrument.stop(name)
+            print(f"{name}: updated {total} similarities in {seconds} seconds.")
+            results.append((name, seconds, total))
+
+        # Save to output file
+        with open(output_file, "w") as fd:
+            fd.writelines(INSTRUMENT_HEADER)
+            for name, seconds, total in results:
+                fd.writelines(f"{name},{seconds},{total}{instrument.columns(name)}\n")
@@ -0,0 +1,258 @@
+from django.core.management.base import BaseCommand
+import os
+import sys
+
+import json
+import pandas
+import numpy
+
+from genesim.apps.datasets.models import Gene, GeneSimilarity, is_symmetric
+from genesim.apps.datasets.matrix import (
+    get_gene_ids,
+    get_name_ranks,
+)
+from genesim.apps.datasets.partition import is_partitioned, partition_copy
+from genesim.apps.datasets.instrument import INSTRUMENT_HEADER, Instrument
+from genesim.apps.datasets.reset import reset_genes
+from genesim.apps.datasets.topk import TopSimilar
+from genesim.apps.datasets.source import get_matrix
+
+from contextlib import closing
+import csv
+from io import StringIO
+
+from django.db import connection
+
+
+def create_sims(genes):
+    """Create a random matrix of values, they aren't actually similarity values
+    """
+    # Create a random valued matrix
+    matrix = numpy.random.randn(len(genes), len(genes))
+
+    # Create a pandas data frame for fake similarity scores
+    df = pandas.DataFrame(matrix)
+
+    # Add labels - these of course are wrong because they should mirror
+    df.index = genes
+    df.columns = genes
+    return df
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("genes_json", type=str)
+        parser.add_argument("output_file", type=str)
+        parser.add_argument(
+            "--metric",
+            type=str,
+            default="cosine",
+            help="metric (partition) to load the similarities into",
+        )
+        parser.add_argument(
+            "--partitions",
+            type=int,
+            default=8,
+            help="number of hash partitions on gene1_id, each loaded by its own COPY",
+        )
+        parser.add_argument(
+            "--replace",
+            action="store_true",
+            default=False,
+            help="load the metric a second time, replacing the loaded partition",
+        )
+        parser.add_argument(
+            "--symmetric",
+            action="store_true",
+            default=False,
+            help="require symmetric storage (SYMMETRIC_SIMILARITY=true), gene1 <= gene2",
+        )
+        parser.add_argument(
+            "--top-k",
+            type=int,
+            default=None,
+            help="similar genes to precompute per gene (TOP_SIMILAR_K, 0 to skip)",
+        )
+        parser.add_argument(
+            "--matrix",
+            type=str,
+            default=None,
+            help="similarity matrix (.npy or HDF5) to load instead of random scores",
+        )
+        parser.add_argument(
+            "--expression",
+            type=str,
+            default=None,
+            help="gene x sample expression (.npy, HDF5 or text) to compute --metric from",
+        )
+        parser.add_argument(
+            "--block-size",
+            type=int,
+            default=250,
+            help="number of matrix rows split between the partitions at once",
+        )
+        parser.add_argument(
+            "--queue-size",
+            type=int,
+            default=8,
+            help="maximum number of chunks waiting to be sent to each COPY",
+        )
+
+    def handle(self, *args, **options):
+
+        output_file = options.get("output_file")
+        genes_json = options.get("genes_json")
+        block_size = options.get("block_size")
+        top_k = options.get("top_k")
+        metric = options.get("metric")
+        partitions = options.get("partitions")
+
+        # Reads follow SYMMETRIC_SIMILARITY, so a load can't choose the layout
+        symmetric = is_symmetric()
+        if options.get("symmetric") and not symmetric:
+            sys.exit("--symmetric needs SYMMETRIC_SIMILARITY=true, reads follow it.")
+
+        # The table is partitioned once, with partition_similarities
+        if connection.vendor != "postgresql" or not is_partitioned():
+            sys.exit("Run partition_similarities first to partition the table.")
+
+        # Start fresh, truncate all genes (also truncates similarities)
+        instrument = Instrument()
+        instrument.start("reset")
+        reset_genes()
+        reset_time = instrument.stop("reset")
+        print(f"Reset genes in {reset_time} seconds.")
+
+        # All three inputs are required
+        if not output_file or not genes_json:
+            sys.exit("genes_json, and output_file are required")
+
+        # Similarity scores are required
+        if not os.path.exists(genes_json):
+            sys.exit("genes.json is required.")
+
+        with open(genes_json, "r") as fd:
+            genes = json.loads(fd.read())
+
+        print(f"Creating {len(genes)} genes...")
+        instrument.start("create_genes")
+
+        # Create stream (to write names)
+        stream = StringIO()
+        writer = csv.writer(stream, delimiter="\t")
+        for gene in genes:
+            writer.writerow([gene, gene])
+        stream.seek(0)
+
+        # Write genes from csv stream
+        with closing(connection.cursor()) as cursor:
+            cursor.copy_from(
+                file=stream,
+                table="datasets_gene",
+                sep="\t",
+                columns=("systematic_name", "common_name"),
+            )
+
+        # metric 1: time to create genes in seconds
+        create_genes_time = instrument.stop("create_genes")
+        total = Gene.objects.count()
+
+        print(f"Created {total} genes in {create_genes_time} seconds.")
+
+        # Random scores, or a matrix on disk that is read a block of rows at a time
+        try:
+            matrix = get_matrix(
+                genes,
+                options.get("matrix"),
+                create_sims,
+                expression=options.get("expression"),
+                metric=metric,
+            )
+        except (OSError, ValueError) as exc:
+            sys.exit(str(exc))
+
+        # One query for the name -> id lookup, and name ordering as ranks
+        names = genes
+        ids = get_gene_ids(names)
+        ranks = get_name_ranks(names)
+
+        # Each hash partition is loaded (and indexed) by its own COPY, and
+        # with --replace the loaded partition is swapped out a second time
+        phases = (
+            ["create_sims", "replace_sims"]
+            if options.get("replace")
+            else ["create_sims"]
+        )
+        results = {}
+        for phase in phases:
+            print(f"Loading similarities into {partitions} partitions ({phase})...")
+            instrument.start(phase)
+
+            # The top similar genes are selected from the rows the load reads
+            top = TopSimilar(ids, k=top_k, metric=metric) if top_k != 0 else None
+            try:
+                results[phase] = partition_copy(
+                    matrix,
+                    ids,
+                    ranks,
+                    metric=metric,
+                    partitions=partitions,
+                    block_size=block_size,
+                    maxsize=options.get("queue_size"),
+                    symmetric=symmetric,
+                    top=top,
+                )
+            except ValueError as exc:
+                sys.exit(str(exc))
+            bytes_sent = sum(result["bytes"] for result in results[phase][0])
+            seconds = instrument.stop(phase, bytes_sent=bytes_sent)
+            print(
+                f"Loaded {phase} in {seconds} seconds, attached in {results[phase][1]}."
+            )
+
+        create_sims_time = instrument["create_sims"].seconds
+        total_sims = GeneSimilarity.objects.count()
+        total_genes = Gene.objects.count()
+        print(f"Created {total_sims} genes similarities in {create_sims_time} seconds.")
+
+        # The top (and bottom) similar genes, collected while loading
+        instrument.start("create_top_similar")
+        total_top = 0
+        if top is not None:
+            total_top = top.save()
+        create_top_time = instrument.stop("create_top_similar")
+        print(f"Created {total_top} top similar genes in {create_top_time} seconds.")
+
+        # Symmetric results are labeled separately
+        label = "partitioned"
+        if symmetric:
+            label = f"{label}_symmetric"
+
+        # Save to output file
+        with open(output_file, "w") as fd:
+            fd.writelines(INSTRUMENT_HEADER)
+            fd.writelines(f"{label}_reset,{reset_time},{instrument.columns('reset')}\n")
+            fd.writelines(
+                f"{label}_create_genes,{create_genes_time},{total_genes}{instrument.columns('create_genes')}\n"
+            )
+            for phase in phases:
+                fd.writelines(
+                    f"{label}_{phase},{instrument[phase].seconds},{total_sims}{instrument.columns(phase)}\n"
+                )
+
+                # One row for the COPY and the indexes of each partition
+                partition_results, attach_seconds = results[phase]
+                for result in partition_results:
+                    name = result["partition"]
+                    fd.writelines(
+                        f"{label}_{phase}_{name}_copy,{result['copy_seconds']},{result['rows']}{instrument.columns()}\n"
+                    )
+                    fd.writelines(
+                        f"{label}_{phase}_{name}_indexes,{result['index_seconds']},{result['rows']}{instrument.columns()}\n"
+                    )
+                fd.writelines(
+                    f"{label}_{phase}_attach,{attach_seconds},{len(partition_results)}{instrument.columns()}\n"
+                )
+            fd.writelines(
+                f"{label}_create_top_similar,{create_top_time},{total_top}{instrument.columns('create_top_similar')}\n"
+            )
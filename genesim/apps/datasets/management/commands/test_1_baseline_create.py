@@ -3,11 +3,22 @@ import os
 import sys
 
 import json
-import time
 import pandas
 import numpy
 
-from genesim.apps.datasets.models import Gene, GeneSimilarity
+from genesim.apps.datasets.cells import (
+    get_or_create_diagonal,
+    get_or_create_genes,
+    get_or_create_similarities,
+)
+from genesim.apps.datasets.models import (
+    Gene,
+    GeneSimilarity,
+    LoadGeneration,
+    is_symmetric,
+)
+from genesim.apps.datasets.instrument import INSTRUMENT_HEADER, Instrument
+from genesim.apps.datasets.reset import reset_genes
 
 
 def create_sims(genes):
@@ -42,8 +53,12 @@ class Command(BaseCommand):
         output_file = options.get("output_file")
         genes_json = options.get("genes_json")
 
-        # Start fresh, delete all genes (also deletes similarities)
-        Gene.objects.all().delete()
+        # Start fresh, truncate all genes (also truncates similarities)
+        instrument = Instrument()
+        instrument.start("reset")
+        reset_genes()
+        reset_time = instrument.stop("reset")
+        print(f"Reset genes in {reset_time} seconds.")
 
         # All three inputs are required
         if not output_file or not genes_json:
@@ -57,17 +72,14 @@ class Command(BaseCommand):
             genes = json.loads(fd.read())
 
         print(f"Creating {len(genes)} genes...")
-        start = time.time()
+        instrument.start("create_genes")
 
         # Done in groups with update so we don't need to loop through millions
         # of datasets! It will still take some time.
-        for name in genes:
-            gene, created = Gene.objects.get_or_create(systematic_name=name)
-        end = time.time()
-        total = Gene.objects.count()
-
+        get_or_create_genes(genes)
         # metric 1: time to create genes in seconds
-        create_genes_time = end - start
+        create_genes_time = instrument.stop("create_genes")
+        total = Gene.objects.count()
 
         print(f"Created {total} genes in {create_genes_time} seconds.")
 
@@ -78,48 +90,41 @@ class Command(BaseCommand):
         # as efficient as just doing a create. We do this because we are going
         # over all cells in the matrix, and will need to geta value if already
         # exists. This is the likely approach that a naive user would take.
-        start = time.time()
+        instrument.start("create_sims")
 
         # Create diagonals first
         print("Creating diagonals...")
-        for i, name1 in enumerate(data.index.tolist()):
-            gene1, _ = Gene.objects.get_or_create(systematic_name=name1)
-            GeneSimilarity.objects.get_or_create(
-                gene1=gene1, gene2=gene1, score=1.0, metric="cosine"
-            )
+        get_or_create_diagonal(genes, metric="cosine")
 
+        # Save diagonal both ways (this is artifically done for the test)
+        # We want to test filling in an entire matrix, even if redundant
         print("Filling matrix...")
-        for i, name1 in enumerate(data.index.tolist()):
-
+        for i, _ in enumerate(
+            get_or_create_similarities(
+                genes, data.values, metric="cosine", symmetric=is_symmetric()
+            )
+        ):
             print(f"Parsing gene {i} of {total}...")
-            gene1, _ = Gene.objects.get_or_create(systematic_name=name1)
-            for name2 in data.index.tolist():
-                gene2, _ = Gene.objects.get_or_create(systematic_name=name2)
-
-                # Only process when genes equal (similarity 1) or sorted order
-                if gene1.systematic_name > gene2.systematic_name or gene1 == gene2:
-                    continue
-
-                # Grab the pvalue and score
-                score = round(float(data.loc[name1, name2]), 3)
-
-                # Save diagonal both ways (this is artifically done for the test)
-                # We want to test filling in an entire matrix, even if redundant
-                GeneSimilarity.objects.get_or_create(
-                    gene1=gene1, gene2=gene2, score=score, metric="cosine"
-                )
-                GeneSimilarity.objects.get_or_create(
-                    gene1=gene2, gene2=gene1, score=score, metric="cosine",
-                )
-
-        end = time.time()
+
+        create_sims_time = instrument.stop("create_sims")
         total_sims = GeneSimilarity.objects.count()
         total_genes = Gene.objects.count()
-        create_sims_time = end - start
+
+        # Cached ranked similarities from before the load are now stale
+        LoadGeneration.bump()
         print(f"Created {total_sims} genes similarities in {create_sims_time} seconds.")
 
         # Save to output file
         with open(output_file, "w") as fd:
-            fd.writelines("metric,seconds,count\n")
-            fd.writelines(f"baseline_create_genes,{create_genes_time},{total_genes}\n")
-            fd.writelines(f"baseline_create_sims,{create_sims_time},{total_sims}\n")
+            fd.writelines(INSTRUMENT_HEADER)
+            fd.writelines(
+                f"baseline_reset,{reset_time},{instrument.columns('reset')}\n"
+            )
+            fd.writelines(
+                f"baseline_create_genes,{create_genes_time},{total_genes}"
+                f"{instrument.columns('create_genes')}\n"
+            )
+            fd.writelines(
+                f"baseline_create_sims,{create_sims_time},{total_sims}"
+                f"{instrument.columns('create_sims')}\n"
+            )
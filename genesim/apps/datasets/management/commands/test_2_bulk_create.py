@@ -3,11 +3,22 @@ import os
 import sys
 
 import json
-import time
 import pandas
 import numpy
 
-from genesim.apps.datasets.models import Gene, GeneSimilarity
+from genesim.apps.datasets.cells import (
+    bulk_create_diagonal,
+    bulk_create_genes,
+    bulk_create_similarities,
+)
+from genesim.apps.datasets.models import (
+    Gene,
+    GeneSimilarity,
+    LoadGeneration,
+    is_symmetric,
+)
+from genesim.apps.datasets.instrument import INSTRUMENT_HEADER, Instrument
+from genesim.apps.datasets.reset import reset_genes
 
 
 def create_sims(genes):
@@ -35,8 +46,12 @@ class Command(BaseCommand):
         output_file = options.get("output_file")
         genes_json = options.get("genes_json")
 
-        # Start fresh, delete all genes (also deletes similarities)
-        Gene.objects.all().delete()
+        # Start fresh, truncate all genes (also truncates similarities)
+        instrument = Instrument()
+        instrument.start("reset")
+        reset_genes()
+        reset_time = instrument.stop("reset")
+        print(f"Reset genes in {reset_time} seconds.")
 
         # All three inputs are required
         if not output_file or not genes_json:
@@ -50,73 +65,50 @@ class Command(BaseCommand):
             genes = json.loads(fd.read())
 
         print(f"Creating {len(genes)} genes...")
-        start = time.time()
+        instrument.start("create_genes")
 
         # Done in groups with update so we don't need to loop through millions
         # of datasets! It will still take some time.
-        listing = [Gene(systematic_name=name) for name in genes]
-        Gene.objects.bulk_create(listing)
-        end = time.time()
-        total = Gene.objects.count()
-
+        bulk_create_genes(genes)
         # metric 1: time to create genes in seconds
-        create_genes_time = end - start
+        create_genes_time = instrument.stop("create_genes")
+        total = Gene.objects.count()
 
         print(f"Created {total} genes in {create_genes_time} seconds.")
 
         data = create_sims(genes)
-        start = time.time()
+        instrument.start("create_sims")
 
         # Create diagonals first
         print("Creating diagonals...")
-        listing = []
-        for i, name1 in enumerate(data.index.tolist()):
-            gene1 = Gene.objects.get(systematic_name=name1)
-            listing.append(
-                GeneSimilarity(gene1=gene1, gene2=gene1, score=1.0, metric="cosine")
-            )
-        GeneSimilarity.objects.bulk_create(listing)
+        bulk_create_diagonal(genes, metric="cosine")
 
+        # Here we will do bulk create on the level of the gene
         print("Creating similarties...")
-        for i, name1 in enumerate(data.index.tolist()):
-
-            # Here we will do bulk create on the level of the gene
+        for i, _ in enumerate(
+            bulk_create_similarities(
+                genes, data.values, metric="cosine", symmetric=is_symmetric()
+            )
+        ):
             print(f"Parsing gene {i} of {total}...")
-            gene1 = Gene.objects.get(systematic_name=name1)
-            listing = []
-
-            for name2 in data.index.tolist():
-                gene2 = Gene.objects.get(systematic_name=name2)
-
-                # Only process when genes equal (similarity 1) or sorted order
-                if gene1.systematic_name > gene2.systematic_name or gene1 == gene2:
-                    continue
-
-                # Grab the pvalue and score
-                score = round(float(data.loc[name1, name2]), 3)
-
-                # Save diagonal both ways (this is artifically done for the test)
-                # We want to test filling in an entire matrix, even if redundant
-                listing += [
-                    GeneSimilarity(
-                        gene1=gene1, gene2=gene2, score=score, metric="costine"
-                    ),
-                    GeneSimilarity(
-                        gene1=gene2, gene2=gene1, score=score, metric="costine"
-                    ),
-                ]
-
-            # Bulk create for the row
-            GeneSimilarity.objects.bulk_create(listing)
-
-        end = time.time()
+
+        create_sims_time = instrument.stop("create_sims")
         total_sims = GeneSimilarity.objects.count()
         total_genes = Gene.objects.count()
-        create_sims_time = end - start
+
+        # Cached ranked similarities from before the load are now stale
+        LoadGeneration.bump()
         print(f"Created {total_sims} genes similarities in {create_sims_time} seconds.")
 
         # Save to output file
         with open(output_file, "w") as fd:
-            fd.writelines("metric,seconds,count\n")
-            fd.writelines(f"bulk_create_genes,{create_genes_time},{total_genes}\n")
-            fd.writelines(f"bulk_create_sims,{create_sims_time},{total_sims}\n")
+            fd.writelines(INSTRUMENT_HEADER)
+            fd.writelines(f"bulk_reset,{reset_time},{instrument.columns('reset')}\n")
+            fd.writelines(
+                f"bulk_create_genes,{create_genes_time},{total_genes}"
+                f"{instrument.columns('create_genes')}\n"
+            )
+            fd.writelines(
+                f"bulk_create_sims,{create_sims_time},{total_sims}"
+                f"{instrument.columns('create_sims')}\n"
+            )
@@ -1,20 +1,26 @@
 from django.core.management.base import BaseCommand
 import os
 import sys
+import tempfile
 
 import json
-import time
 import pandas
 import numpy
 
-from genesim.apps.datasets.models import Gene, GeneSimilarity
-
-from contextlib import closing
-import csv
-from io import StringIO
-
-from django.db import connection
-from django.utils import timezone
+from genesim.apps.datasets.cells import (
+    copy_diagonal,
+    copy_file,
+    copy_genes,
+    write_similarities,
+)
+from genesim.apps.datasets.models import (
+    Gene,
+    GeneSimilarity,
+    LoadGeneration,
+    is_symmetric,
+)
+from genesim.apps.datasets.instrument import INSTRUMENT_HEADER, Instrument
+from genesim.apps.datasets.reset import reset_genes
 
 
 def create_sims(genes):
@@ -42,11 +48,12 @@ class Command(BaseCommand):
         output_file = options.get("output_file")
         genes_json = options.get("genes_json")
 
-        # Start fresh, delete all genes (also deletes similarities)
-        Gene.objects.all().delete()
-
-        import IPython
-        IPython.embed()
+        # Start fresh, truncate all genes (also truncates similarities)
+        instrument = Instrument()
+        instrument.start("reset")
+        reset_genes()
+        reset_time = instrument.stop("reset")
+        print(f"Reset genes in {reset_time} seconds.")
 
         # All three inputs are required
         if not output_file or not genes_json:
@@ -60,103 +67,72 @@ class Command(BaseCommand):
             genes = json.loads(fd.read())
 
         print(f"Creating {len(genes)} genes...")
-        start = time.time()
-
-        # Create stream (to write names)
-        stream = StringIO()
-        writer = csv.writer(stream, delimiter='\t')
-        for i, gene in enumerate(genes):
-            writer.writerow([gene, gene])
-        stream.seek(0)
+        instrument.start("create_genes")
 
         # Write genes from csv stream
-        with closing(connection.cursor()) as cursor:
-            cursor.copy_from(
-                file=stream,
-                table='datasets_gene',
-                sep='\t',
-                columns=('systematic_name', 'common_name'),
-            )
-        end = time.time()
-        total = Gene.objects.count()
+        copy_genes(genes)
 
         # metric 1: time to create genes in seconds
-        create_genes_time = end - start
+        create_genes_time = instrument.stop("create_genes")
+        total = Gene.objects.count()
 
         print(f"Created {total} genes in {create_genes_time} seconds.")
 
         data = create_sims(genes)
-        start_diagonal_genes = time.time()
+        instrument.start("create_diagonal_sims")
 
         # Create diagonals first
         print("Creating diagonals...")
+        _, diagonal_bytes = copy_diagonal(genes, metric="cosine")
 
-        stream = StringIO()
-        writer = csv.writer(stream, delimiter='\t')
-        for i, name1 in enumerate(data.index.tolist()):
-            gene1 = Gene.objects.get(systematic_name=name1)
-            writer.writerow([gene1.id, gene1.id, 'cosine', 1.0])
-        stream.seek(0)
-
-        # Write genes from csv stream
-        with closing(connection.cursor()) as cursor:
-            cursor.copy_from(
-                file=stream,
-                table='datasets_genesimilarity',
-                sep='\t',
-                columns=('gene1_id', 'gene2_id', 'metric', 'score'),
-            )
-
-        end_diagonal_genes = time.time()
-        time_diagonal_genes = end_diagonal_genes - start_diagonal_genes
+        time_diagonal_genes = instrument.stop(
+            "create_diagonal_sims", bytes_sent=diagonal_bytes
+        )
+        diagonal_sims = GeneSimilarity.objects.count()
 
         print("Writing to file...")
-        start_write = time.time()
+        instrument.start("write_genes_file")
         _, tmpfile = tempfile.mkstemp()
 
-        with open(tmpfile, "w") as csv_file:
-            writer = csv.writer(csv_file, delimiter='\t')
-            for i, name1 in enumerate(data.index.tolist()):
-                gene1 = Gene.objects.get(systematic_name=name1)
-                for name2 in data.index.tolist():
-                    gene2 = Gene.objects.get(systematic_name=name2)
-
-                    # Only process when genes equal (similarity 1) or sorted order
-                    if gene1.systematic_name > gene2.systematic_name or gene1 == gene2:
-                        continue
-
-                    # Grab the pvalue and score
-                    score = round(float(data.loc[name1, name2]), 3)
-                    writer.writerow([gene1.id, gene2.id, 'cosine', score])
-                    writer.writerow([gene2.id, gene1.id, 'cosine', score])
-
-        end_write = time.time()
-        time_write = end_write - start_write
+        # Genes minus diagonal sims
+        other_genes = write_similarities(
+            tmpfile, genes, data.values, metric="cosine", symmetric=is_symmetric()
+        )
+        time_write = instrument.stop("write_genes_file")
 
         print("Creating similarties...")
-        create_start = time.time()
-        with open(tmpfile, 'r') as stream:        
-            with closing(connection.cursor()) as cursor:
-                cursor.copy_from(
-                    file=stream,
-                    table='datasets_genesimilarity',
-                    sep='\t',
-                    columns=('gene1_id', 'gene2_id', 'metric', 'score'),
-                )
-
-        create_end = time.time()
+        instrument.start("create_sims")
+        copy_file(tmpfile)
+
+        create_sims_time = instrument.stop(
+            "create_sims", bytes_sent=os.path.getsize(tmpfile)
+        )
         total_sims = GeneSimilarity.objects.count()
         total_genes = Gene.objects.count()
-        create_sims_time = create_end - create_start
-        print(f"Created {total_sims} genes similarities in {create_sims_time} seconds.")
 
-        # Genes minus diagonal sims
-        other_genes = (total_genes * total_genes) - diagonal_sims
+        # Cached ranked similarities from before the load are now stale
+        LoadGeneration.bump()
+        print(f"Created {total_sims} genes similarities in {create_sims_time} seconds.")
 
         # Save to output file
         with open(output_file, "w") as fd:
-            fd.writelines("metric,seconds,count\n")
-            fd.writelines(f"copyfromfile_create_diagonal_sims,{time_diagonal_genes},{diagonal_sims}\n")
-            fd.writelines(f"copyfromfile_write_genes_file,{time_write},{other_genes}\n")
-            fd.writelines(f"copyfromfile_create_genes,{create_genes_time},{total_genes}\n")
-            fd.writelines(f"copyfromfile_create_sims,{create_sims_time},{total_sims}\n")
+            fd.writelines(INSTRUMENT_HEADER)
+            fd.writelines(
+                f"copyfromfile_reset,{reset_time},{instrument.columns('reset')}\n"
+            )
+            fd.writelines(
+                f"copyfromfile_create_diagonal_sims,{time_diagonal_genes},"
+                f"{diagonal_sims}{instrument.columns('create_diagonal_sims')}\n"
+            )
+            fd.writelines(
+                f"copyfromfile_write_genes_file,{time_write},{other_genes}"
+                f"{instrument.columns('write_genes_file')}\n"
+            )
+            fd.writelines(
+                f"copyfromfile_create_genes,{create_genes_time},{total_genes}"
+                f"{instrument.columns('create_genes')}\n"
+            )
+            fd.writelines(
+                f"copyfromfile_create_sims,{create_sims_time},{total_sims}"
+                f"{instrument.columns('create_sims')}\n"
+            )
@@ -0,0 +1,176 @@
+from django.core.management.base import BaseCommand
+import os
+import sys
+
+import json
+import tempfile
+import pandas
+import numpy
+
+from genesim.apps.datasets.models import Gene, GeneSimilarity, is_symmetric
+from genesim.apps.datasets.matrix import (
+    format_rows,
+    get_diagonal,
+    get_gene_ids,
+    get_name_ranks,
+    iter_pair_blocks,
+)
+from genesim.apps.datasets.instrument import INSTRUMENT_HEADER, Instrument
+from genesim.apps.datasets.reset import reset_genes
+from genesim.apps.datasets.source import get_matrix
+
+from contextlib import closing
+import csv
+from io import StringIO
+
+from django.db import connection
+
+
+def create_sims(genes):
+    """Create a random matrix of values, they aren't actually similarity values
+    """
+    # Create a random valued matrix
+    matrix = numpy.random.randn(len(genes), len(genes))
+
+    # Create a pandas data frame for fake similarity scores
+    df = pandas.DataFrame(matrix)
+
+    # Add labels - these of course are wrong because they should mirror
+    df.index = genes
+    df.columns = genes
+    return df
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("genes_json", type=str)
+        parser.add_argument("output_file", type=str)
+        parser.add_argument(
+            "--matrix",
+            type=str,
+            default=None,
+            help="similarity matrix (.npy or HDF5) to load instead of random scores",
+        )
+        parser.add_argument(
+            "--block-size",
+            type=int,
+            default=250,
+            help="number of matrix rows to format and write at once",
+        )
+
+    def handle(self, *args, **options):
+
+        output_file = options.get("output_file")
+        genes_json = options.get("genes_json")
+        block_size = options.get("block_size")
+
+        # Start fresh, truncate all genes (also truncates similarities)
+        instrument = Instrument()
+        instrument.start("reset")
+        reset_genes()
+        reset_time = instrument.stop("reset")
+        print(f"Reset genes in {reset_time} seconds.")
+
+        # All three inputs are required
+        if not output_file or not genes_json:
+            sys.exit("genes_json, and output_file are required")
+
+        # Similarity scores are required
+        if not os.path.exists(genes_json):
+            sys.exit("genes.json is required.")
+
+        with open(genes_json, "r") as fd:
+            genes = json.loads(fd.read())
+
+        print(f"Creating {len(genes)} genes...")
+        instrument.start("create_genes")
+
+        # Create stream (to write names)
+        stream = StringIO()
+        writer = csv.writer(stream, delimiter="\t")
+        for gene in genes:
+            writer.writerow([gene, gene])
+        stream.seek(0)
+
+        # Write genes from csv stream
+        with closing(connection.cursor()) as cursor:
+            cursor.copy_from(
+                file=stream,
+                table="datasets_gene",
+                sep="\t",
+                columns=("systematic_name", "common_name"),
+            )
+
+        # metric 1: time to create genes in seconds
+        create_genes_time = instrument.stop("create_genes")
+        total = Gene.objects.count()
+
+        print(f"Created {total} genes in {create_genes_time} seconds.")
+
+        # Random scores, or a matrix on disk that is read a block of rows at a time
+        try:
+            matrix = get_matrix(genes, options.get("matrix"), create_sims)
+        except (OSError, ValueError) as exc:
+            sys.exit(str(exc))
+
+        print("Writing to file...")
+        instrument.start("write_genes_file")
+
+        # One query for the name -> id lookup, and name ordering as ranks
+        names = genes
+        ids = get_gene_ids(names)
+        ranks = get_name_ranks(names)
+
+        _, tmpfile = tempfile.mkstemp()
+        written = 0
+        with open(tmpfile, "w") as csv_file:
+
+            # Diagonals first
+            diagonal = get_diagonal(matrix, 0, len(ids))
+            csv_file.write(format_rows(ids, ids, diagonal))
+            written += len(ids)
+
+            for gene1, gene2, scores in iter_pair_blocks(
+                matrix, ids, ranks, block_size=block_size, symmetric=is_symmetric()
+            ):
+                csv_file.write(format_rows(gene1, gene2, scores))
+                written += len(scores)
+
+        time_write = instrument.stop(
+            "write_genes_file", bytes_sent=os.path.getsize(tmpfile)
+        )
+        print(f"Wrote {written} similarities in {time_write} seconds.")
+
+        print("Creating similarties...")
+        instrument.start("create_sims")
+        with open(tmpfile, "r") as stream:
+            with closing(connection.cursor()) as cursor:
+                cursor.copy_from(
+                    file=stream,
+                    table="datasets_genesimilarity",
+                    sep="\t",
+                    columns=("gene1_id", "gene2_id", "metric", "score"),
+                )
+        bytes_sent = os.path.getsize(tmpfile)
+        os.remove(tmpfile)
+
+        create_sims_time = instrument.stop("create_sims", bytes_sent=bytes_sent)
+        total_sims = GeneSimilarity.objects.count()
+        total_genes = Gene.objects.count()
+        print(f"Created {total_sims} genes similarities in {create_sims_time} seconds.")
+
+        # Save to output file
+        with open(output_file, "w") as fd:
+            fd.writelines(INSTRUMENT_HEADER)
+            fd.writelines(
+                f"vectorized_reset,{reset_time},{instrument.columns('reset')}\n"
+            )
+            fd.writelines(
+                f"vectorized_create_genes,{create_genes_time},{total_genes}{instrument.columns('create_genes')}\n"
+            )
+            fd.writelines(
+                f"vectorized_write_genes_file,{time_write},{written}{instrument.columns('write_genes_file')}\n"
+            )
+            fd.writelines(
+                f"vectorized_create_sims,{create_sims_time},{total_sims}{instrument.columns('create_sims')}\n"
+            )
@@ -0,0 +1,222 @@
+from django.core.management.base import BaseCommand
+import os
+import sys
+
+import json
+import pandas
+import numpy
+
+from genesim.apps.datasets.models import Gene, GeneSimilarity, is_symmetric
+from genesim.apps.datasets.matrix import get_gene_ids, get_name_ranks
+from genesim.apps.datasets.parallel import parallel_copy, summarize_workers
+from genesim.apps.datasets.stats import get_table_sizes
+from genesim.apps.datasets.instrument import INSTRUMENT_HEADER, Instrument
+from genesim.apps.datasets.reset import reset_genes
+from genesim.apps.datasets.topk import TopSimilar
+from genesim.apps.datasets.source import get_matrix
+
+from contextlib import closing
+import csv
+from io import StringIO
+
+from django.db import connection
+
+
+def create_sims(genes):
+    """Create a random matrix of values, they aren't actually similarity values
+    """
+    # Create a random valued matrix
+    matrix = numpy.random.randn(len(genes), len(genes))
+
+    # Create a pandas data frame for fake similarity scores
+    df = pandas.DataFrame(matrix)
+
+    # Add labels - these of course are wrong because they should mirror
+    df.index = genes
+    df.columns = genes
+    return df
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("genes_json", type=str)
+        parser.add_argument("output_file", type=str)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="number of worker processes (and connections) running COPY",
+        )
+        parser.add_argument(
+            "--format",
+            choices=["binary", "text"],
+            default="binary",
+            help="COPY format to stream similarities with",
+        )
+        parser.add_argument(
+            "--symmetric",
+            action="store_true",
+            default=False,
+            help="require symmetric storage (SYMMETRIC_SIMILARITY=true), gene1 <= gene2",
+        )
+        parser.add_argument(
+            "--top-k",
+            type=int,
+            default=None,
+            help="similar genes to precompute per gene (TOP_SIMILAR_K, 0 to skip)",
+        )
+        parser.add_argument(
+            "--matrix",
+            type=str,
+            default=None,
+            help="similarity matrix (.npy or HDF5) to load instead of random scores",
+        )
+        parser.add_argument(
+            "--block-size",
+            type=int,
+            default=250,
+            help="number of matrix rows in each chunk sent to COPY",
+        )
+        parser.add_argument(
+            "--tasks-per-worker",
+            type=int,
+            default=4,
+            help="number of row ranges for each worker, to balance uneven work",
+        )
+
+    def handle(self, *args, **options):
+
+        output_file = options.get("output_file")
+        genes_json = options.get("genes_json")
+        block_size = options.get("block_size")
+        top_k = options.get("top_k")
+        workers = options.get("workers")
+        tasks_per_worker = options.get("tasks_per_worker")
+        copy_format = options.get("format")
+
+        # Reads follow SYMMETRIC_SIMILARITY, so a load can't choose the layout
+        symmetric = is_symmetric()
+        if options.get("symmetric") and not symmetric:
+            sys.exit("--symmetric needs SYMMETRIC_SIMILARITY=true, reads follow it.")
+
+        # Start fresh, truncate all genes (also truncates similarities)
+        instrument = Instrument()
+        instrument.start("reset")
+        reset_genes()
+        reset_time = instrument.stop("reset")
+        print(f"Reset genes in {reset_time} seconds.")
+
+        # All three inputs are required
+        if not output_file or not genes_json:
+            sys.exit("genes_json, and output_file are required")
+
+        # Similarity scores are required
+        if not os.path.exists(genes_json):
+            sys.exit("genes.json is required.")
+
+        with open(genes_json, "r") as fd:
+            genes = json.loads(fd.read())
+
+        print(f"Creating {len(genes)} genes...")
+        instrument.start("create_genes")
+
+        # Create stream (to write names)
+        stream = StringIO()
+        writer = csv.writer(stream, delimiter="\t")
+        for gene in genes:
+            writer.writerow([gene, gene])
+        stream.seek(0)
+
+        # Write genes from csv stream
+        with closing(connection.cursor()) as cursor:
+            cursor.copy_from(
+                file=stream,
+                table="datasets_gene",
+                sep="\t",
+                columns=("systematic_name", "common_name"),
+            )
+
+        # metric 1: time to create genes in seconds
+        create_genes_time = instrument.stop("create_genes")
+        total = Gene.objects.count()
+
+        print(f"Created {total} genes in {create_genes_time} seconds.")
+
+        # Random scores, or a matrix on disk that is read a block of rows at a time
+        try:
+            matrix = get_matrix(genes, options.get("matrix"), create_sims)
+        except (OSError, ValueError) as exc:
+            sys.exit(str(exc))
+
+        print(f"Loading similarities with {workers} workers...")
+        instrument.start("create_sims")
+
+        # One query for the name -> id lookup, and name ordering as ranks
+        names = genes
+        ids = get_gene_ids(names)
+        ranks = get_name_ranks(names)
+
+        # Each worker loads ranges of matrix rows over its own connection
+        try:
+            results = parallel_copy(
+                matrix,
+                ids,
+                ranks,
+                workers=workers,
+                tasks_per_worker=tasks_per_worker,
+                block_size=block_size,
+                symmetric=symmetric,
+                binary=copy_format == "binary",
+                top_k=top_k,
+            )
+        except Exception as exc:
+            sys.exit(f"A worker failed to load similarities: {exc}")
+        bytes_sent = sum(result["bytes"] for result in results)
+
+        create_sims_time = instrument.stop("create_sims", bytes_sent=bytes_sent)
+        total_sims = GeneSimilarity.objects.count()
+        total_genes = Gene.objects.count()
+        print(f"Created {total_sims} genes similarities in {create_sims_time} seconds.")
+        table_size, index_size = get_table_sizes("datasets_genesimilarity")
+        print(f"Streamed {bytes_sent} bytes to COPY.")
+
+        # The top (and bottom) similar genes, collected by the workers
+        instrument.start("create_top_similar")
+        total_top = 0
+        if top_k != 0:
+            top = TopSimilar(ids, k=top_k)
+            for result in results:
+                top.blocks += result["top"]
+            total_top = top.save()
+        create_top_time = instrument.stop("create_top_similar")
+        print(f"Created {total_top} top similar genes in {create_top_time} seconds.")
+
+        # Symmetric results are labeled separately, and sizes are in bytes
+        label = "parallel"
+        if symmetric:
+            label = f"{label}_symmetric"
+
+        # Save to output file
+        with open(output_file, "w") as fd:
+            fd.writelines(INSTRUMENT_HEADER)
+            fd.writelines(f"{label}_reset,{reset_time},{instrument.columns('reset')}\n")
+            fd.writelines(
+                f"{label}_create_genes,{create_genes_time},{total_genes}{instrument.columns('create_genes')}\n"
+            )
+            fd.writelines(
+                f"{label}_create_sims,{create_sims_time},{total_sims}{instrument.columns('create_sims')}\n"
+            )
+            fd.writelines(
+                f"{label}_create_top_similar,{create_top_time},{total_top}{instrument.columns('create_top_similar')}\n"
+            )
+            fd.writelines(f"{label}_table_bytes,,{table_size}{instrument.columns()}\n")
+            fd.writelines(f"{label}_index_bytes,,{index_size}{instrument.columns()}\n")
+            fd.writelines(
+                f"{label}_bytes_sent,{create_sims_time},{bytes_sent}{instrument.columns()}\n"
+            )
+
+            # Time each worker spent in COPY, and the similarities it loaded
+            for i, worker in enumerate(summarize_workers(results)):
+                fd.writelines(
+                    f"{label}_worker_{i}_sims,{worker['seconds']},{worker['count']}{instrument.columns()}\n"
+                )
@@ -0,0 +1,183 @@
+from __future__ import unicode_literals
+
+import numpy
+
+from genesim.apps.datasets.index import get_gene_index
+
+
+def get_gene_ids(names):
+    """Given a list of systematic names, return a numpy array of gene ids in
+       the same order, from the GeneIndex of the process. Genes created since
+       it was read (without a new load generation) are found by reading it
+       again once.
+    """
+    try:
+        return get_gene_index().ids_for(names)
+    except KeyError:
+        return get_gene_index(refresh=True).ids_for(names)
+
+
+def get_name_ranks(names):
+    """Return the rank of each systematic name in sorted order. Comparing
+       ranks is equivalent to comparing the names themselves, which is how
+       the commands decide which pairs to write (gene1 < gene2).
+    """
+    order = numpy.argsort(numpy.array(names, dtype=str), kind="stable")
+    ranks = numpy.empty(len(names), dtype=numpy.int64)
+    ranks[order] = numpy.arange(len(names))
+    return ranks
+
+
+def get_diagonal(matrix, first=0, last=None):
+    """Return the score of the gene of each row first to last of a matrix
+       with itself, from the get_diagonal of the matrix if it has one (e.g.,
+       a SimilarityEngine, where genes without any variation are 0), and
+       otherwise 1.0.
+    """
+    last = len(matrix) if last is None else min(last, len(matrix))
+    if not hasattr(matrix, "get_diagonal"):
+        return numpy.ones(last - first)
+    return numpy.asarray(matrix.get_diagonal(first, last), dtype=numpy.float64)
+
+
+def iter_pair_blocks(
+    matrix, ids, ranks, block_size=250, start=0, stop=None, symmetric=False, top=None,
+):
+    """Yield (gene1_ids, gene2_ids, scores) for blocks of matrix rows. For
+       each row i we take the columns j where name i sorts before name j,
+       and emit the pair both ways with the score at [i, j], matching the
+       row ordering of the per-cell loops in the other commands. Use start
+       and stop to only generate a range of matrix rows. If symmetric, each
+       pair is emitted once, with gene1 the smaller id. Each block of rows
+       read is also given to top (a topk.TopSimilar) if set, so the top
+       similar genes are found during the load.
+    """
+    stop = len(ids) if stop is None else min(stop, len(ids))
+    for first in range(start, stop, block_size):
+        last = min(first + block_size, stop)
+        block = numpy.asarray(matrix[first:last])
+        if top is not None:
+            top.add(first, get_row_block(matrix, ranks, first, last, block))
+        mask = ranks[first:last, None] < ranks[None, :]
+        rows, cols = numpy.nonzero(mask)
+        scores = block[rows, cols]
+        rows += first
+        yield expand_pairs(ids[rows], ids[cols], scores, symmetric=symmetric)
+
+
+def count_rows(ranks, start=0, stop=None, symmetric=False):
+    """Return the number of similarity rows iter_text_chunks (and the other
+       chunk helpers) write for a range of matrix rows: a diagonal for each
+       row, and the pairs with every later name, both ways unless symmetric.
+    """
+    later = len(ranks) - 1 - ranks[start:stop]
+    pairs = int(later.sum())
+    return len(later) + (pairs if symmetric else 2 * pairs)
+
+
+def iter_added_pair_blocks(matrix, ids, ranks, added, block_size=250, symmetric=False):
+    """Like iter_pair_blocks, but only for the rows of genes that were added
+       to an existing matrix: row k of the matrix is for the gene at position
+       added[k]. Pairs with existing genes are always emitted (they are new),
+       and pairs between two added genes only when the name sorts first.
+    """
+    is_added = numpy.zeros(len(ids), dtype=bool)
+    is_added[added] = True
+    for first in range(0, len(added), block_size):
+        positions = added[first : first + block_size]
+        mask = ~is_added[None, :] | (ranks[positions, None] < ranks[None, :])
+        rows, cols = numpy.nonzero(mask)
+        scores = numpy.asarray(matrix[first : first + len(positions)])[rows, cols]
+        yield expand_pairs(ids[positions[rows]], ids[cols], scores, symmetric=symmetric)
+
+
+def expand_pairs(gene1, gene2, scores, symmetric=False):
+    """Given one (gene1, gene2, score) per pair, return the rows to write:
+       interleaved [gene1, gene2] and [gene2, gene1], or if symmetric one
+       row with gene1 as the smaller id.
+    """
+    if symmetric:
+        return numpy.minimum(gene1, gene2), numpy.maximum(gene1, gene2), scores
+
+    first = numpy.empty(gene1.size * 2, dtype=numpy.int64)
+    second = numpy.empty(gene1.size * 2, dtype=numpy.int64)
+    first[0::2] = gene1
+    first[1::2] = gene2
+    second[0::2] = gene2
+    second[1::2] = gene1
+    return first, second, numpy.repeat(scores, 2)
+
+
+def format_rows(gene1, gene2, scores, metric="cosine"):
+    """Format a block of similarity rows as tab separated text for COPY.
+       Formatting with %.3f rounds the same way as round(score, 3).
+    """
+    template = "%d\t%d\t" + metric + "\t%.3f\n"
+    return "".join(
+        map(template.__mod__, zip(gene1.tolist(), gene2.tolist(), scores.tolist()))
+    )
+
+
+def iter_text_chunks(
+    matrix,
+    ids,
+    ranks,
+    metric="cosine",
+    block_size=250,
+    start=0,
+    stop=None,
+    symmetric=False,
+    top=None,
+):
+    """Yield encoded COPY text chunks for a similarity matrix (or a range of
+       its rows): first the diagonal (see get_diagonal), and then one chunk
+       per block of matrix rows. See iter_pair_blocks for top.
+    """
+    diagonal = ids[start:stop]
+    scores = get_diagonal(matrix, start, stop)
+    yield format_rows(diagonal, diagonal, scores, metric).encode("utf-8")
+    for gene1, gene2, scores in iter_pair_blocks(
+        matrix,
+        ids,
+        ranks,
+        block_size=block_size,
+        start=start,
+        stop=stop,
+        symmetric=symmetric,
+        top=top,
+    ):
+        yield format_rows(gene1, gene2, scores, metric).encode("utf-8")
+
+
+def iter_row_blocks(matrix, ranks, block_size=250, start=0, stop=None):
+    """Yield (first, block) for blocks of entire rows of the similarity
+       matrix as the loaders define it: the score for a pair is taken from
+       the row of the gene whose name sorts first, and the diagonal is from
+       get_diagonal.
+       A symmetric matrix (e.g., a source.MatrixSource on disk) is only read
+       by rows, since reading columns would read the entire file each time.
+    """
+    total = len(ranks)
+    stop = total if stop is None else min(stop, total)
+    for first in range(start, stop, block_size):
+        last = min(first + block_size, stop)
+        yield first, get_row_block(matrix, ranks, first, last)
+
+
+def get_row_block(matrix, ranks, first, last, block=None):
+    """Return the entire rows first to last of the similarity matrix (see
+       iter_row_blocks), where block is matrix[first:last] if it was already
+       read.
+    """
+    block = numpy.asarray(matrix[first:last]) if block is None else block
+    if getattr(matrix, "symmetric", False):
+        block = numpy.array(block, dtype=numpy.float64)
+    else:
+        block = numpy.where(
+            ranks[first:last, None] < ranks[None, :],
+            block,
+            numpy.asarray(matrix[:, first:last]).T,
+        )
+    diagonal = get_diagonal(matrix, first, last)
+    block[numpy.arange(last - first), numpy.arange(first, last)] = diagonal
+    return block
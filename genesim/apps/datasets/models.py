@@ -1,9 +1,17 @@
 from __future__ import unicode_literals
 
+from django.conf import settings
 from django.core.exceptions import FieldError
-from django.db.models import Q
+from django.db.models import Case, F, Q, When
+from django.db.models.query import ModelIterable
 from django.db import models
 
+import copy
+from functools import lru_cache
+import time
+
+import numpy
+
 
 class Dataset(models.Model):
     name = models.CharField(max_length=500, null=True, blank=True, unique=True)
@@ -18,21 +26,152 @@ class Gene(models.Model):
     )
     common_name = models.CharField(max_length=50, null=True, blank=True)
 
-    def get_ranked_similar(self, reverse=False):
-        """Given a gene, get a sorted listed from the most to least similar
+    def get_ranked_similar(self, reverse=False, metric="cosine", limit=None):
+        """Given a gene, get a sorted listed from the most to least similar.
+           There is one similarity for each gene (including this one) with
+           gene1 as this gene, whether the matrix is stored symmetric or not.
+           Results are cached for the process until the next load (see
+           LoadGeneration), so a list is returned instead of a queryset,
+           with copies of the cached similarities that can be changed.
         """
-        if not reverse:
-            return GeneSimilarity.objects.filter(
-                Q(gene1=self) | Q(gene2=self)
-            ).order_by("-score")
-        return GeneSimilarity.objects.filter(Q(gene1=self) | Q(gene2=self)).order_by(
-            "score"
-        )
+        generation = LoadGeneration.get_recent_generation()
+        similar = get_cached_ranked_similar(self.id, metric, reverse, limit, generation)
+        return [copy.copy(similarity) for similarity in similar]
+
+    def get_similarity_vector(self, metric="cosine"):
+        """Return (gene ids, scores) for this gene from GeneSimilarityVector,
+           decoding the stored gene order and packed scores with numpy.
+        """
+        vector = GeneSimilarityVector.objects.get(gene=self, metric=metric)
+        order = GeneSimilarityOrder.objects.get(metric=metric)
+        return order.get_gene_ids(), vector.get_scores()
+
+    def get_ranked_similar_vector(self, reverse=False, metric="cosine", limit=None):
+        """Given a gene, rank the similarities in its packed vector with
+           argsort. Unsaved GeneSimilarity instances are returned so they can
+           be used like the rows from get_ranked_similar.
+        """
+        gene_ids, scores = self.get_similarity_vector(metric)
+        scores = numpy.round(scores.astype(numpy.float64), 3)
+        ordered = numpy.lexsort((gene_ids, scores if reverse else -scores))[:limit]
+        similar = []
+        for gene_id, score in zip(gene_ids[ordered].tolist(), scores[ordered].tolist()):
+            similarity = GeneSimilarity(
+                gene1_id=self.id, gene2_id=gene_id, metric=metric, score=score
+            )
+            similarity.other_id = gene_id
+            similar.append(similarity)
+        return similar
 
     def __str__(self):
         return "<%s>" % self.systematic_name
 
 
+def is_symmetric():
+    """Symmetric storage only keeps rows where gene1 <= gene2 (by id), and
+       is enabled with SYMMETRIC_SIMILARITY=true in the environment.
+    """
+    return getattr(settings, "SYMMETRIC_SIMILARITY", False)
+
+
+def uses_vectors():
+    """Serve ranked similarities from GeneSimilarityVector instead of one row
+       per cell, enabled with SIMILARITY_VECTORS=true in the environment.
+    """
+    return getattr(settings, "SIMILARITY_VECTORS", False)
+
+
+def read_ranked_similar(
+    gene_id, metric="cosine", reverse=False, limit=None, generation=None
+):
+    """Ranked similarities for a gene id, read from the database (without
+       the cache of get_cached_ranked_similar, the generation is only part
+       of its key). A limit up to the K of GeneTopSimilar is read from that
+       table.
+    """
+    # The top (or bottom) similar genes are precomputed for small limits
+    if limit is not None:
+        top = GeneTopSimilar.get_top(gene_id, metric, reverse, limit)
+        if len(top) == limit:
+            return tuple(top)
+
+    if uses_vectors():
+        gene = Gene(id=gene_id)
+        return tuple(gene.get_ranked_similar_vector(reverse, metric, limit))
+
+    similar = GeneSimilarity.objects.ranked(gene_id, metric=metric, reverse=reverse)
+    return tuple(similar[:limit])
+
+
+# Created on first use, so the size is read from the settings then
+_ranked_similar_cache = None
+
+
+def get_cached_ranked_similar(gene_id, metric, reverse, limit, generation):
+    """Ranked similarities for a gene id, cached (least recently used) in
+       this process, with RANKED_SIMILAR_CACHE_SIZE results. The load
+       generation is part of the key, so results from before the last load
+       are never returned, and just age out.
+    """
+    global _ranked_similar_cache
+    if _ranked_similar_cache is None:
+        maxsize = getattr(settings, "RANKED_SIMILAR_CACHE_SIZE", 1024)
+        _ranked_similar_cache = lru_cache(maxsize=maxsize)(read_ranked_similar)
+    return _ranked_similar_cache(gene_id, metric, reverse, limit, generation)
+
+
+class MirroredModelIterable(ModelIterable):
+    """Yield similarities with gene1 always being the gene the queryset was
+       made for, swapping gene1 and gene2 for rows stored the other way.
+    """
+
+    def __iter__(self):
+        gene_id = self.queryset._mirror_gene_id
+        for similarity in super().__iter__():
+            if similarity.gene2_id == gene_id:
+                similarity.gene1_id, similarity.gene2_id = (
+                    similarity.gene2_id,
+                    similarity.gene1_id,
+                )
+            yield similarity
+
+
+class GeneSimilarityQuerySet(models.QuerySet):
+    _mirror_gene_id = None
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._mirror_gene_id = self._mirror_gene_id
+        return clone
+
+    def for_gene(self, gene):
+        """Return the matrix row for a gene, annotated with other_id for the
+           other gene. With symmetric storage the row is split between rows
+           with the gene as gene1 or gene2, and model instances are mirrored
+           so gene1 is the gene (don't save mirrored instances).
+        """
+        if not is_symmetric():
+            return self.filter(gene1=gene).annotate(other_id=F("gene2"))
+
+        queryset = self.filter(Q(gene1=gene) | Q(gene2=gene)).annotate(
+            other_id=Case(When(gene1=gene, then=F("gene2")), default=F("gene1"))
+        )
+        queryset._mirror_gene_id = getattr(gene, "pk", gene)
+        queryset._iterable_class = MirroredModelIterable
+        return queryset
+
+    def ranked(self, gene, metric="cosine", reverse=False):
+        """Return the matrix row for a gene and metric from the most to least
+           similar (or the reverse), ties ordered by the other gene. Without
+           symmetric storage this only filters on gene1 and metric, so it is
+           read in order from the (gene1, metric, -score, gene2, id) index.
+        """
+        similar = self.for_gene(gene).filter(metric=metric)
+        if not reverse:
+            return similar.order_by("-score", "other_id")
+        return similar.order_by("score", "other_id")
+
+
 class GeneSimilarity(models.Model):
     """A gene similarity is a similarity metric calculated to compare genes
        based on datasets.
@@ -47,9 +186,245 @@ class GeneSimilarity(models.Model):
     metric = models.CharField(max_length=50)
     score = models.DecimalField(max_digits=10, decimal_places=3)
 
+    objects = GeneSimilarityQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (
+            "gene1",
+            "gene2",
+            "metric",
+        )
+        indexes = [
+            # Ranked reads for a gene are index only scans, already in order
+            models.Index(
+                fields=["gene1", "metric", "-score", "gene2", "id"],
+                name="genesimilarity_ranked_idx",
+            )
+        ]
+
+
+class GeneTopSimilar(models.Model):
+    """The K most (and with reverse, least) similar genes for a gene and
+       metric, in rank order. These are computed from the full rows of the
+       matrix while it is loaded, so the most common reads don't need to
+       touch (or sort) the GeneSimilarity table.
+    """
+
+    gene = models.ForeignKey(Gene, on_delete=models.CASCADE, related_name="top_similar")
+    other = models.ForeignKey(Gene, on_delete=models.CASCADE, related_name="+")
+    metric = models.CharField(max_length=50)
+    reverse = models.BooleanField(default=False)
+    rank = models.SmallIntegerField()
+    score = models.DecimalField(max_digits=10, decimal_places=3)
+
+    @classmethod
+    def get_top(cls, gene_id, metric="cosine", reverse=False, limit=None):
+        """The top (or bottom) similar genes of a gene in rank order, up to
+           limit, as unsaved GeneSimilarity instances.
+        """
+        top = cls.objects.filter(gene_id=gene_id, metric=metric, reverse=reverse)
+        return [similar.as_similarity() for similar in top.order_by("rank")[:limit]]
+
+    def as_similarity(self):
+        """An unsaved GeneSimilarity, like the rows from get_ranked_similar"""
+        similarity = GeneSimilarity(
+            gene1_id=self.gene_id,
+            gene2_id=self.other_id,
+            metric=self.metric,
+            score=self.score,
+        )
+        similarity.other_id = self.other_id
+        return similarity
+
+    class Meta:
+        unique_together = (
+            "gene",
+            "metric",
+            "reverse",
+            "rank",
+        )
+
+
+class LoadGeneration(models.Model):
+    """Single row counters: loaders increment the SIMILARITIES row whenever
+       they change the similarities, so processes know their cached ranked
+       similarities are stale (the generation is part of the cache key), and
+       the GENES row whenever genes are created or deleted, so processes know
+       their GeneIndex is stale.
+    """
+
+    SIMILARITIES = 1
+    GENES = 2
+
+    generation = models.PositiveIntegerField(default=0)
+
+    # The generation of each row this process read last, and when (see
+    # get_recent_generation)
+    _recent = {}
+
+    @classmethod
+    def get_generation(cls, counter=SIMILARITIES):
+        generation = cls.objects.filter(id=counter).values_list("generation", flat=True)
+        return generation.first() or 0
+
+    @classmethod
+    def get_recent_generation(cls, counter=SIMILARITIES):
+        """The generation, read at most every LOAD_GENERATION_MAX_AGE seconds
+           by this process, so cache hits don't cost a query. A bump by this
+           process is seen right away, and by others within the max age.
+        """
+        generation, read = cls._recent.get(counter, (None, 0))
+        max_age = getattr(settings, "LOAD_GENERATION_MAX_AGE", 1)
+        if generation is None or time.monotonic() - read >= max_age:
+            generation = cls.get_generation(counter)
+            cls._recent[counter] = (generation, time.monotonic())
+        return generation
+
+    @classmethod
+    def bump(cls, counter=SIMILARITIES):
+        """Increment the generation, creating the row the first time"""
+        if not cls.objects.filter(id=counter).update(generation=F("generation") + 1):
+            cls.objects.get_or_create(id=counter, defaults={"generation": 1})
+        cls._recent.pop(counter, None)
+
+
+class Metric(models.Model):
+    """A lookup for similarity metric names, so that compact similarities
+       can reference a metric with a smallint instead of repeating the name.
+    """
+
+    id = models.SmallAutoField(primary_key=True)
+    name = models.CharField(max_length=50, unique=True)
+
+    def __str__(self):
+        return "<%s>" % self.name
+
+
+class CompactGeneSimilarity(models.Model):
+    """The same similarity as GeneSimilarity, but with a smallint foreign key
+       to the Metric, and the score as an integer in thousandths (the three
+       decimal places of GeneSimilarity.score) instead of a numeric.
+    """
+
+    SCORE_SCALE = 1000
+
+    gene1 = models.ForeignKey(
+        Gene, on_delete=models.CASCADE, related_name="compact_similarity1"
+    )
+    gene2 = models.ForeignKey(
+        Gene, on_delete=models.CASCADE, related_name="compact_similarity2"
+    )
+    metric = models.ForeignKey(Metric, on_delete=models.CASCADE)
+    scaled_score = models.IntegerField()
+
+    @property
+    def score(self):
+        return self.scaled_score / self.SCORE_SCALE
+
     class Meta:
         unique_together = (
             "gene1",
             "gene2",
             "metric",
         )
+
+
+class GeneSimilarityOrder(models.Model):
+    """The order of genes for the scores in every GeneSimilarityVector of a
+       metric, stored as packed little endian int32 gene ids.
+    """
+
+    metric = models.CharField(max_length=50, unique=True)
+    genes = models.BinaryField()
+
+    def get_gene_ids(self):
+        return numpy.frombuffer(bytes(self.genes), dtype="<i4")
+
+
+class GeneSimilarityVector(models.Model):
+    """An entire row of the similarity matrix for one gene and metric, as
+       packed little endian float32 scores in the GeneSimilarityOrder of the
+       metric. This is one row per gene instead of one row per cell.
+    """
+
+    gene = models.ForeignKey(
+        Gene, on_delete=models.CASCADE, related_name="similarity_vectors"
+    )
+    metric = models.CharField(max_length=50)
+    scores = models.BinaryField()
+
+    def get_scores(self):
+        return numpy.frombuffer(bytes(self.scores), dtype="<f4")
+
+    class Meta:
+        unique_together = (
+            "gene",
+            "metric",
+        )
+
+
+class SimilarityLoadJob(models.Model):
+    """A load of the similarities for a metric, from a matrix (or expression
+       data) on disk, split into blocks of matrix rows. Workers (the
+       load_worker command) claim blocks with SELECT ... FOR UPDATE SKIP
+       LOCKED, so a job can be drained by several workers at once, and a
+       killed load resumes from the blocks that weren't checkpointed.
+    """
+
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [(PENDING, "pending"), (DONE, "done"), (FAILED, "failed")]
+
+    genes_json = models.CharField(max_length=500)
+    source = models.CharField(max_length=500)
+    expression = models.BooleanField(default=False)
+    metric = models.CharField(max_length=50, default="cosine")
+    symmetric = models.BooleanField(default=False)
+    block_size = models.PositiveIntegerField(default=250)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return "<SimilarityLoadJob %s %s>" % (self.id, self.status)
+
+
+class SimilarityLoadBlock(models.Model):
+    """A block of matrix rows (first to last) of a SimilarityLoadJob. A block
+       is loaded in the same transaction that marks it done, so it's either
+       loaded and checkpointed, or still pending.
+    """
+
+    job = models.ForeignKey(
+        SimilarityLoadJob, on_delete=models.CASCADE, related_name="blocks"
+    )
+    first = models.PositiveIntegerField()
+    last = models.PositiveIntegerField()
+    status = models.CharField(
+        max_length=10,
+        choices=SimilarityLoadJob.STATUS_CHOICES,
+        default=SimilarityLoadJob.PENDING,
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    worker = models.CharField(max_length=100, null=True, blank=True)
+    rows = models.PositiveIntegerField(null=True, blank=True)
+    seconds = models.FloatField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    completed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (
+            "job",
+            "first",
+        )
+        indexes = [
+            # Workers claim the first pending block of a job, retries last
+            models.Index(
+                fields=["job", "status", "attempts", "first"],
+                name="similarityloadblock_claim_idx",
+            )
+        ]
@@ -0,0 +1,134 @@
+from __future__ import unicode_literals
+
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
+import multiprocessing
+import os
+import time
+
+from django.db import connections
+
+from genesim.apps.datasets.matrix import count_rows, iter_text_chunks
+from genesim.apps.datasets.pgcopy import iter_binary_chunks
+from genesim.apps.datasets.stream import stream_copy
+from genesim.apps.datasets.topk import TopSimilar
+
+# Set in the parent before the pool forks, so workers inherit the matrix
+# without pickling it for every task
+_shared = {}
+
+
+def get_row_ranges(total, tasks):
+    """Split total matrix rows into (start, stop) ranges. A row only has
+       pairs for names sorting after it, so the work per range is uneven,
+       and we make more ranges than workers to let the pool balance it.
+    """
+    size = max(1, -(-total // tasks))
+    return [(start, min(start + size, total)) for start in range(0, total, size)]
+
+
+def load_rows(start, stop):
+    """Load similarities for one range of matrix rows with its own COPY. This
+       runs in a worker process, which opens its own database connection.
+       The top similar genes of the range are returned to the parent.
+    """
+    started = time.time()
+    top = None
+    if _shared["top_k"] != 0:
+        top = TopSimilar(_shared["ids"], k=_shared["top_k"], metric=_shared["metric"])
+    iter_chunks = iter_binary_chunks if _shared["binary"] else iter_text_chunks
+    chunks = iter_chunks(
+        _shared["matrix"],
+        _shared["ids"],
+        _shared["ranks"],
+        metric=_shared["metric"],
+        block_size=_shared["block_size"],
+        start=start,
+        stop=stop,
+        symmetric=_shared["symmetric"],
+        top=top,
+    )
+    bytes_sent = stream_copy(
+        chunks,
+        table="datasets_genesimilarity",
+        columns=("gene1_id", "gene2_id", "metric", "score"),
+        binary=_shared["binary"],
+    )
+
+    return {
+        "pid": os.getpid(),
+        "start": start,
+        "stop": stop,
+        "count": count_rows(
+            _shared["ranks"], start, stop, symmetric=_shared["symmetric"]
+        ),
+        "seconds": time.time() - started,
+        "bytes": bytes_sent,
+        "top": top.blocks if top is not None else [],
+    }
+
+
+def parallel_copy(
+    matrix,
+    ids,
+    ranks,
+    workers=4,
+    tasks_per_worker=4,
+    metric="cosine",
+    block_size=250,
+    binary=True,
+    symmetric=False,
+    top_k=0,
+):
+    """Load a similarity matrix by giving ranges of rows to a pool of worker
+       processes, each running COPY concurrently over its own connection.
+       Workers are forked (so this needs a platform that supports fork), and
+       the first error raised by a worker is raised here after the remaining
+       ranges are cancelled. Returns the result of each range. With top_k
+       (None for TOP_SIMILAR_K), each result has the blocks of a TopSimilar
+       for its range, to be saved by the parent.
+    """
+    _shared.update(
+        matrix=matrix,
+        ids=ids,
+        ranks=ranks,
+        metric=metric,
+        block_size=block_size,
+        binary=binary,
+        symmetric=symmetric,
+        top_k=top_k,
+    )
+
+    # Connections can't be shared across a fork, each worker opens its own
+    connections.close_all()
+    context = multiprocessing.get_context("fork")
+    ranges = get_row_ranges(len(ids), workers * tasks_per_worker)
+
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = [pool.submit(load_rows, start, stop) for start, stop in ranges]
+            done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in pending:
+                future.cancel()
+            for future in futures:
+                if future in done:
+                    results.append(future.result())
+    finally:
+        _shared.clear()
+    return results
+
+
+def summarize_workers(results):
+    """Given results of parallel_copy, sum seconds, similarities and bytes
+       for each worker process, in the order the ranges were submitted.
+    """
+    workers = {}
+    for result in results:
+        worker = workers.setdefault(
+            result["pid"], {"seconds": 0, "count": 0, "bytes": 0, "ranges": 0}
+        )
+        worker["seconds"] += result["seconds"]
+        worker["count"] += result["count"]
+        worker["bytes"] += result["bytes"]
+        worker["ranges"] += 1
+    return list(workers.values())
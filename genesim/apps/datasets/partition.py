@@ -0,0 +1,381 @@
+from __future__ import unicode_literals
+
+from contextlib import closing
+import itertools
+from queue import Empty, Queue
+import re
+import threading
+import time
+
+from django.db import connection, transaction
+
+import numpy
+
+from genesim.apps.datasets.deferred import get_constraints, get_indexes
+from genesim.apps.datasets.matrix import get_diagonal, iter_pair_blocks
+from genesim.apps.datasets.models import LoadGeneration
+from genesim.apps.datasets.pgcopy import HEADER, TRAILER, encode_rows
+from genesim.apps.datasets.stream import stream_copy
+
+# The similarity table is partitioned by LIST (metric), and each metric by
+# HASH (gene1_id), e.g., datasets_genesimilarity_cosine_0. Metrics without a
+# partition go to datasets_genesimilarity_default.
+ROOT = "datasets_genesimilarity"
+DEFAULT_PARTITION = f"{ROOT}_default"
+COLUMNS = ("gene1_id", "gene2_id", "metric", "score")
+
+# A partitioned table's primary key has to include the partition key
+PRIMARY_KEY = "PRIMARY KEY (id)"
+PARTITIONED_PRIMARY_KEY = "PRIMARY KEY (id, metric, gene1_id)"
+
+
+def is_partitioned(table=ROOT):
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table"
+            " WHERE partrelid = to_regclass(%s))",
+            [table],
+        )
+        return cursor.fetchone()[0]
+
+
+def get_metric_partition(metric):
+    """The name of the partition for a metric, checking it can be used in
+       DDL (and that the hash partitions being loaded still fit in a name).
+    """
+    table = f"{ROOT}_{metric}"
+    if not re.fullmatch(r"[a-z0-9_]+", metric) or metric == "default":
+        raise ValueError(f"{metric} can't be used as a partition name.")
+    if len(f"{table}_load_9999") > 63:
+        raise ValueError(f"The metric {metric} is too long for a partition name.")
+    return table
+
+
+def get_modulus(table):
+    """The number of hash partitions of a metric partition, or 0 if missing"""
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            "SELECT count(*) FROM pg_inherits WHERE inhparent = to_regclass(%s)",
+            [table],
+        )
+        return cursor.fetchone()[0]
+
+
+def create_metric_partition(metric, partitions=8):
+    """Create the (empty) partition for a metric, with hash partitions on
+       gene1_id. The indexes and constraints of the root are created on each.
+    """
+    table = get_metric_partition(metric)
+    with transaction.atomic(), closing(connection.cursor()) as cursor:
+        cursor.execute(
+            f"CREATE TABLE {table} PARTITION OF {ROOT}"
+            " FOR VALUES IN (%s) PARTITION BY HASH (gene1_id)",
+            [metric],
+        )
+        for remainder in range(partitions):
+            cursor.execute(
+                f"CREATE TABLE {table}_{remainder} PARTITION OF {table}"
+                f" FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+            )
+
+
+def drop_metric_partition(metric):
+    """Replace a DELETE of every similarity for a metric: the partition is
+       detached and dropped, along with its hash partitions. Returns the
+       number of hash partitions it had (0 if there was no partition).
+    """
+    table = get_metric_partition(metric)
+    partitions = get_modulus(table)
+    with transaction.atomic(), closing(connection.cursor()) as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [table])
+        if cursor.fetchone()[0] is None:
+            return 0
+        cursor.execute(f"ALTER TABLE {ROOT} DETACH PARTITION {table}")
+        cursor.execute(f"DROP TABLE {table}")
+    return partitions
+
+
+def clear_metric_partition(metric):
+    """Remove the similarities for a metric by dropping its partition and
+       creating it again empty. Returns False if it wasn't partitioned.
+    """
+    partitions = drop_metric_partition(metric)
+    if partitions:
+        create_metric_partition(metric, partitions)
+    return partitions > 0
+
+
+def partition_table(partitions=8, metrics=None):
+    """Convert datasets_genesimilarity to a partitioned table: a partition
+       for each metric (those in the table, and metrics), each with hash
+       partitions on gene1_id, and a default partition. The rows are moved
+       over and the constraints and indexes created again with the same
+       names, in one transaction.
+    """
+    old = f"{ROOT}_unpartitioned"
+    with transaction.atomic(), closing(connection.cursor()) as cursor:
+        constraints = get_constraints(ROOT, types=("p", "u", "f"))
+        indexes = get_indexes(ROOT)
+        cursor.execute("SELECT DISTINCT metric FROM %s" % ROOT)
+        metrics = sorted(set(metrics or []) | {row[0] for row in cursor.fetchall()})
+        for metric in metrics:
+            get_metric_partition(metric)
+
+        cursor.execute(f"ALTER TABLE {ROOT} RENAME TO {old}")
+        cursor.execute(
+            f"CREATE TABLE {ROOT} (LIKE {old} INCLUDING DEFAULTS)"
+            " PARTITION BY LIST (metric)"
+        )
+        cursor.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {ROOT} DEFAULT")
+        for metric in metrics:
+            create_metric_partition(metric, partitions)
+
+        move_table(
+            cursor, old, constraints, indexes, primary_key=PARTITIONED_PRIMARY_KEY
+        )
+
+
+def unpartition_table():
+    """Convert a partitioned datasets_genesimilarity back to a single table"""
+    old = f"{ROOT}_partitioned"
+    with transaction.atomic(), closing(connection.cursor()) as cursor:
+        constraints = get_constraints(ROOT, types=("p", "u", "f"))
+        indexes = [
+            (name, definition.replace(" ON ONLY ", " ON "))
+            for name, definition in get_indexes(ROOT)
+        ]
+        cursor.execute(f"ALTER TABLE {ROOT} RENAME TO {old}")
+        cursor.execute(f"CREATE TABLE {ROOT} (LIKE {old} INCLUDING DEFAULTS)")
+        move_table(cursor, old, constraints, indexes, primary_key=PRIMARY_KEY)
+
+
+def move_table(cursor, old, constraints, indexes, primary_key):
+    """Move the rows of the old (renamed) similarity table to the new one,
+       drop it, and add its constraints and indexes to the new table. The id
+       sequence is kept, so ids carry on.
+    """
+    quote_name = connection.ops.quote_name
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [old])
+    sequence = cursor.fetchone()[0]
+    cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {ROOT}.id")
+
+    cursor.execute(f"INSERT INTO {ROOT} SELECT * FROM {old}")
+    cursor.execute(f"DROP TABLE {old}")
+
+    for name, definition in constraints:
+        if definition.startswith("PRIMARY KEY"):
+            definition = primary_key
+        cursor.execute(
+            f"ALTER TABLE {ROOT} ADD CONSTRAINT {quote_name(name)} {definition}"
+        )
+    for name, definition in indexes:
+        cursor.execute(definition)
+
+
+def get_hash_remainders(table, partitions, ids):
+    """Return the hash partition (remainder) of each gene id for a table
+       partitioned by HASH (gene1_id), computed by the server so the rows of
+       a block can be routed to their partition before they are sent.
+    """
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            """SELECT g.id, r FROM unnest(%s::integer[]) AS g(id),
+               generate_series(0, %s - 1) AS r
+               WHERE satisfies_hash_partition(%s::regclass::oid, %s, r, g.id)""",
+            [ids.tolist(), partitions, table, partitions],
+        )
+        lookup = dict(cursor.fetchall())
+    return numpy.array([lookup[gene_id] for gene_id in ids.tolist()], numpy.int64)
+
+
+def build_partition(table):
+    """Add the constraints and indexes of the root to a standalone hash
+       partition, so attaching it only has to match them. The indexes are
+       named after the table (see rename_indexes), since the names Django
+       generated are too long to add a suffix to.
+    """
+    with closing(connection.cursor()) as cursor:
+        constraints = get_constraints(ROOT, types=("p", "u", "f"))
+        for i, (_, definition) in enumerate(constraints):
+            if definition.startswith("FOREIGN KEY"):
+                cursor.execute(f"ALTER TABLE {table} ADD {definition}")
+            else:
+                cursor.execute(
+                    f"ALTER TABLE {table} ADD CONSTRAINT {table}_key{i} {definition}"
+                )
+        for i, (_, definition) in enumerate(get_indexes(ROOT)):
+            cursor.execute(
+                re.sub(
+                    r"^CREATE (UNIQUE )?INDEX \S+ ON (ONLY )?\S+",
+                    lambda match: f"CREATE {match.group(1) or ''}INDEX {table}_idx{i} ON {table}",
+                    definition,
+                )
+            )
+
+
+def rename_indexes(cursor, table, old, new):
+    """Rename the indexes of a table (and the constraints they back) from
+       the old prefix to the new one, after the table itself was renamed.
+    """
+    cursor.execute(
+        """SELECT i.relname FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+           WHERE x.indrelid = %s::regclass""",
+        [table],
+    )
+    for (name,) in cursor.fetchall():
+        if name.startswith(old):
+            cursor.execute(f"ALTER INDEX {name} RENAME TO {new}{name[len(old):]}")
+
+
+class PartitionWriter(threading.Thread):
+    """Load the chunks put on its queue into one hash partition with its own
+       COPY (and connection), and then build the partition's indexes. On an
+       error the queue is drained and later chunks are dropped, so the
+       producer never blocks.
+    """
+
+    def __init__(self, table, maxsize=8):
+        super().__init__(daemon=True)
+        self.table = table
+        self.queue = Queue(maxsize=maxsize)
+        self.error = None
+        self.rows = 0
+        self.bytes_sent = 0
+        self.copy_seconds = None
+        self.index_seconds = None
+
+    def run(self):
+        try:
+            start = time.time()
+            self.bytes_sent = stream_copy(
+                iter(self.queue.get, None),
+                table=self.table,
+                columns=COLUMNS,
+                binary=True,
+            )
+            self.copy_seconds = time.time() - start
+
+            start = time.time()
+            build_partition(self.table)
+            self.index_seconds = time.time() - start
+        except Exception as exc:
+            self.error = exc
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except Empty:
+                pass
+        finally:
+            connection.close()
+
+    def put(self, chunk):
+        if self.error is None:
+            self.queue.put(chunk)
+
+    def put_rows(self, gene1, gene2, scores, metric):
+        self.rows += len(scores)
+        self.put(encode_rows(gene1, gene2, scores, metric))
+
+
+def partition_copy(
+    matrix,
+    ids,
+    ranks,
+    metric="cosine",
+    partitions=8,
+    block_size=250,
+    maxsize=8,
+    symmetric=False,
+    top=None,
+):
+    """Load (or replace) the similarities of a metric into its own partition:
+
+       1. create the hash partitions as standalone tables, without indexes
+       2. split each block of rows by the hash partition of gene1, and send
+          each part to the COPY of its partition, one thread per partition
+       3. each thread builds the indexes of its partition after its COPY
+       4. in one transaction, detach and drop the old partition of the metric
+          (if any), and attach the new partitions in its place
+
+       Reads see the old similarities until the new ones are attached. Returns
+       a list with the rows, bytes and seconds of each partition, and the
+       seconds it took to attach them. See matrix.iter_pair_blocks for top.
+    """
+    table = get_metric_partition(metric)
+    staging = f"{table}_load"
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+        cursor.execute(
+            f"CREATE TABLE {staging} (LIKE {ROOT} INCLUDING DEFAULTS)"
+            " PARTITION BY HASH (gene1_id)"
+        )
+        for remainder in range(partitions):
+            cursor.execute(f"DROP TABLE IF EXISTS {staging}_{remainder}")
+            cursor.execute(
+                f"CREATE TABLE {staging}_{remainder}"
+                f" (LIKE {ROOT} INCLUDING DEFAULTS)"
+            )
+
+    # Look up the partition of each gene1 by id
+    remainders = numpy.full(int(ids.max()) + 1 if len(ids) else 0, -1, numpy.int64)
+    remainders[ids] = get_hash_remainders(staging, partitions, ids)
+
+    writers = [PartitionWriter(f"{staging}_{r}", maxsize) for r in range(partitions)]
+    for writer in writers:
+        writer.start()
+        writer.put(HEADER)
+
+    try:
+        blocks = iter_pair_blocks(
+            matrix, ids, ranks, block_size=block_size, symmetric=symmetric, top=top,
+        )
+        diagonal = (ids, ids, get_diagonal(matrix, 0, len(ids)))
+        for gene1, gene2, scores in itertools.chain([diagonal], blocks):
+            partition = remainders[gene1]
+            for remainder, writer in enumerate(writers):
+                rows = partition == remainder
+                if rows.any():
+                    writer.put_rows(gene1[rows], gene2[rows], scores[rows], metric)
+    finally:
+        for writer in writers:
+            writer.put(TRAILER)
+            writer.put(None)
+        for writer in writers:
+            writer.join()
+
+    errors = [writer.error for writer in writers if writer.error is not None]
+    if errors:
+        raise errors[0]
+
+    # Swap the loaded partitions in for the metric
+    start = time.time()
+    with transaction.atomic(), closing(connection.cursor()) as cursor:
+        drop_metric_partition(metric)
+        cursor.execute(f"DELETE FROM {DEFAULT_PARTITION} WHERE metric = %s", [metric])
+        cursor.execute(f"ALTER TABLE {staging} RENAME TO {table}")
+        for remainder in range(partitions):
+            cursor.execute(
+                f"ALTER TABLE {staging}_{remainder} RENAME TO {table}_{remainder}"
+            )
+            rename_indexes(cursor, f"{table}_{remainder}", staging, table)
+            cursor.execute(
+                f"ALTER TABLE {table} ATTACH PARTITION {table}_{remainder}"
+                f" FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+            )
+        cursor.execute(
+            f"ALTER TABLE {ROOT} ATTACH PARTITION {table} FOR VALUES IN (%s)", [metric]
+        )
+        LoadGeneration.bump()
+    attach_seconds = time.time() - start
+
+    results = [
+        {
+            "partition": f"{table}_{remainder}",
+            "rows": writer.rows,
+            "bytes": writer.bytes_sent,
+            "copy_seconds": writer.copy_seconds,
+            "index_seconds": writer.index_seconds,
+        }
+        for remainder, writer in enumerate(writers)
+    ]
+    return results, attach_seconds
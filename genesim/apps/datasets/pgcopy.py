@@ -0,0 +1,243 @@
+from __future__ import unicode_literals
+
+import struct
+
+import numpy
+
+from genesim.apps.datasets.matrix import (
+    get_diagonal,
+    iter_added_pair_blocks,
+    iter_pair_blocks,
+    iter_row_blocks,
+)
+
+# Signature, flags field and header extension length
+HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+
+# A field count of -1 marks the end of the data
+TRAILER = struct.pack(">h", -1)
+
+# numeric is sent as base 10000 digits, with a sign word and display scale
+NUMERIC_POS = 0x0000
+NUMERIC_NEG = 0x4000
+NBASE = 10000
+
+
+def get_numeric_digits(scaled, decimal_places=3):
+    """Given the largest absolute value as an integer scaled by the decimal
+       places, return the number of base 10000 digits needed to hold it once
+       the fraction is aligned to a whole base 10000 digit.
+    """
+    fraction_digits = -(-decimal_places // 4)
+    value = int(scaled) * 10 ** (fraction_digits * 4 - decimal_places)
+    ndigits = fraction_digits + 1
+    while value >= NBASE ** ndigits:
+        ndigits += 1
+    return ndigits, fraction_digits
+
+
+def round_scaled(scores, decimal_places=3):
+    """Round scores to the decimal places as integers (e.g., thousandths).
+       Only products that land exactly on .5 can round differently from
+       round(score, 3) used by the text format, so those few are redone.
+       NaN and infinity have no integer, so they raise ValueError.
+    """
+    product = numpy.asarray(scores, dtype=numpy.float64) * 10 ** decimal_places
+    if not numpy.isfinite(product).all():
+        raise ValueError("Scores that are NaN or infinite can't be encoded.")
+    scaled = numpy.rint(product).astype(numpy.int64)
+    for i in numpy.flatnonzero(numpy.abs(product - numpy.trunc(product)) == 0.5):
+        scaled[i] = round(
+            round(float(scores[i]), decimal_places) * 10 ** decimal_places
+        )
+    return scaled
+
+
+def get_row_dtype(metric, ndigits):
+    """The binary layout of one GeneSimilarity tuple. Every value has a fixed
+       width (AutoField ids are 4 byte integers, the metric is the same for
+       the block, and numeric uses a fixed number of digits, leading zeros
+       are stripped by the server), so a block can be built as one array.
+    """
+    return numpy.dtype(
+        [
+            ("nfields", ">i2"),
+            ("gene1_length", ">i4"),
+            ("gene1", ">i4"),
+            ("gene2_length", ">i4"),
+            ("gene2", ">i4"),
+            ("metric_length", ">i4"),
+            ("metric", "S%s" % len(metric)),
+            ("score_length", ">i4"),
+            ("ndigits", ">i2"),
+            ("weight", ">i2"),
+            ("sign", ">u2"),
+            ("dscale", ">i2"),
+            ("digits", ">i2", (ndigits,)),
+        ]
+    )
+
+
+def encode_rows(gene1, gene2, scores, metric="cosine", decimal_places=3):
+    """Encode a block of (gene1_id, gene2_id, metric, score) rows as binary
+       COPY tuples. Scores are rounded to the decimal places of the score
+       field and written as numeric, so the server does no parsing.
+    """
+    metric = metric.encode("utf-8")
+    scaled = round_scaled(scores, decimal_places)
+    magnitude = numpy.abs(scaled)
+    largest = magnitude.max() if magnitude.size else 0
+    ndigits, fraction_digits = get_numeric_digits(largest, decimal_places)
+
+    rows = numpy.zeros(len(scaled), dtype=get_row_dtype(metric, ndigits))
+    rows["nfields"] = 4
+    rows["gene1_length"] = 4
+    rows["gene1"] = gene1
+    rows["gene2_length"] = 4
+    rows["gene2"] = gene2
+    rows["metric_length"] = len(metric)
+    rows["metric"] = metric
+    rows["score_length"] = 8 + 2 * ndigits
+    rows["ndigits"] = ndigits
+    rows["weight"] = ndigits - fraction_digits - 1
+    rows["sign"] = numpy.where(scaled < 0, NUMERIC_NEG, NUMERIC_POS)
+    rows["dscale"] = decimal_places
+
+    # Align the fraction to whole base 10000 digits, then split
+    magnitude *= 10 ** (fraction_digits * 4 - decimal_places)
+    for i in range(ndigits - 1, -1, -1):
+        rows["digits"][:, i] = magnitude % NBASE
+        magnitude //= NBASE
+    return rows.tobytes()
+
+
+def iter_binary_chunks(
+    matrix,
+    ids,
+    ranks,
+    metric="cosine",
+    block_size=250,
+    start=0,
+    stop=None,
+    symmetric=False,
+    top=None,
+):
+    """Yield binary COPY chunks for a similarity matrix (or a range of its
+       rows), in the same row order as matrix.iter_text_chunks, wrapped in
+       the header and trailer. See matrix.iter_pair_blocks for top.
+    """
+    diagonal = ids[start:stop]
+    scores = get_diagonal(matrix, start, stop)
+    yield HEADER + encode_rows(diagonal, diagonal, scores, metric)
+    for gene1, gene2, scores in iter_pair_blocks(
+        matrix,
+        ids,
+        ranks,
+        block_size=block_size,
+        start=start,
+        stop=stop,
+        symmetric=symmetric,
+        top=top,
+    ):
+        yield encode_rows(gene1, gene2, scores, metric)
+    yield TRAILER
+
+
+def iter_added_binary_chunks(
+    matrix, ids, ranks, added, metric="cosine", block_size=250, symmetric=False
+):
+    """Yield binary COPY chunks with only the similarities of genes added to
+       an existing matrix (their diagonal, and pairs from the rows in matrix),
+       see matrix.iter_added_pair_blocks.
+    """
+    diagonal = ids[added]
+    scores = get_diagonal(matrix, 0, len(added))
+    yield HEADER + encode_rows(diagonal, diagonal, scores, metric)
+    for gene1, gene2, scores in iter_added_pair_blocks(
+        matrix, ids, ranks, added, block_size=block_size, symmetric=symmetric
+    ):
+        yield encode_rows(gene1, gene2, scores, metric)
+    yield TRAILER
+
+
+def encode_compact_rows(gene1, gene2, scores, metric_id, decimal_places=3):
+    """Encode (gene1_id, gene2_id, metric_id, scaled_score) rows for
+       CompactGeneSimilarity, where the metric is a smallint and the score
+       is rounded to an integer number of thousandths.
+    """
+    rows = numpy.zeros(
+        len(gene1),
+        dtype=[
+            ("nfields", ">i2"),
+            ("gene1_length", ">i4"),
+            ("gene1", ">i4"),
+            ("gene2_length", ">i4"),
+            ("gene2", ">i4"),
+            ("metric_length", ">i4"),
+            ("metric", ">i2"),
+            ("score_length", ">i4"),
+            ("score", ">i4"),
+        ],
+    )
+    rows["nfields"] = 4
+    rows["gene1_length"] = 4
+    rows["gene1"] = gene1
+    rows["gene2_length"] = 4
+    rows["gene2"] = gene2
+    rows["metric_length"] = 2
+    rows["metric"] = metric_id
+    rows["score_length"] = 4
+    rows["score"] = round_scaled(scores, decimal_places)
+    return rows.tobytes()
+
+
+def iter_compact_chunks(matrix, ids, ranks, metric_id, block_size=250, symmetric=False):
+    """Yield binary COPY chunks for CompactGeneSimilarity, with the same rows
+       (and row order) as iter_binary_chunks.
+    """
+    scores = get_diagonal(matrix, 0, len(ids))
+    yield HEADER + encode_compact_rows(ids, ids, scores, metric_id)
+    for gene1, gene2, scores in iter_pair_blocks(
+        matrix, ids, ranks, block_size=block_size, symmetric=symmetric
+    ):
+        yield encode_compact_rows(gene1, gene2, scores, metric_id)
+    yield TRAILER
+
+
+def encode_vectors(gene_ids, vectors, metric="cosine"):
+    """Encode (gene_id, metric, scores) rows for GeneSimilarityVector, where
+       each row of vectors is packed as little endian float32 into a bytea.
+    """
+    metric = metric.encode("utf-8")
+    vectors = numpy.asarray(vectors)
+    size = vectors.shape[1]
+    rows = numpy.zeros(
+        len(gene_ids),
+        dtype=[
+            ("nfields", ">i2"),
+            ("gene_length", ">i4"),
+            ("gene", ">i4"),
+            ("metric_length", ">i4"),
+            ("metric", "S%s" % len(metric)),
+            ("scores_length", ">i4"),
+            ("scores", "<f4", (size,)),
+        ],
+    )
+    rows["nfields"] = 3
+    rows["gene_length"] = 4
+    rows["gene"] = gene_ids
+    rows["metric_length"] = len(metric)
+    rows["metric"] = metric
+    rows["scores_length"] = 4 * size
+    rows["scores"] = vectors
+    return rows.tobytes()
+
+
+def iter_vector_chunks(matrix, ids, ranks, metric="cosine", block_size=250):
+    """Yield binary COPY chunks with one GeneSimilarityVector row per gene,
+       with scores in the same order as ids.
+    """
+    yield HEADER
+    for first, block in iter_row_blocks(matrix, ranks, block_size=block_size):
+        yield encode_vectors(ids[first : first + len(block)], block, metric)
+    yield TRAILER
@@ -0,0 +1,248 @@
+from __future__ import unicode_literals
+
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import time
+import traceback
+
+from django.db import connection, connections
+
+import numpy
+
+from genesim.apps.datasets.engine import SimilarityEngine
+from genesim.apps.datasets.generate import generate_features
+from genesim.apps.datasets.index import get_gene_index
+from genesim.apps.datasets.matrix import get_name_ranks, iter_pair_blocks
+from genesim.apps.datasets.models import (
+    GeneTopSimilar,
+    read_ranked_similar,
+    is_symmetric,
+)
+from genesim.apps.datasets.pgcopy import HEADER, TRAILER, encode_rows
+from genesim.apps.datasets.reset import reset_genes
+from genesim.apps.datasets.stream import stream_copy
+from genesim.apps.datasets.views import get_pair_scores
+
+# Query shapes, each run as a single read by the app
+SHAPES = ("ranked", "top_k", "pairs")
+
+
+class ReadWorkload(object):
+    """A mix of the reads the app serves, for random genes: a whole ranked
+       row (get_ranked_similar), the top k similar genes (from GeneTopSimilar,
+       which has to be loaded with at least k per gene), and a batch of pair
+       lookups (the similarity_pairs view). Ranked reads skip the process
+       cache (LoadGeneration), so every read goes to the database.
+    """
+
+    def __init__(self, gene_ids, mix, metric="cosine", top_k=10, pair_batch=100):
+        unknown = [shape for shape in mix if shape not in SHAPES]
+        if unknown:
+            raise ValueError(f"Unknown query shapes {unknown}, choices are {SHAPES}")
+        self.gene_ids = numpy.asarray(gene_ids)
+        self.shapes = list(mix)
+        weights = numpy.array([mix[shape] for shape in self.shapes], dtype=float)
+        self.weights = weights / weights.sum()
+        self.metric = metric
+        self.top_k = top_k
+        self.pair_batch = pair_batch
+
+    def choose(self, random):
+        return self.shapes[random.choice(len(self.shapes), p=self.weights)]
+
+    def read(self, shape, random):
+        """Run one read of a shape, returning the number of rows read"""
+        if shape == "pairs":
+            pairs = random.choice(self.gene_ids, size=(self.pair_batch, 2)).tolist()
+            if is_symmetric():
+                pairs = [(min(pair), max(pair)) for pair in pairs]
+            return len(get_pair_scores(pairs, self.metric))
+
+        gene_id = int(random.choice(self.gene_ids))
+        if shape == "top_k":
+            top = GeneTopSimilar.get_top(gene_id, self.metric, limit=self.top_k)
+            if len(top) < self.top_k:
+                raise LookupError(
+                    f"GeneTopSimilar has {len(top)} of {self.top_k} genes for {gene_id}"
+                )
+            return len(top)
+        return len(read_ranked_similar(gene_id, self.metric))
+
+
+def read_worker(workload, seed, warmup, deadline):
+    """Run reads from one thread until the deadline, returning a list of
+       (shape, seconds, rows), the number of errors of each shape, and the
+       traceback of the first error (or None). Reads before warmup (a time)
+       aren't recorded. Each thread has its own connection.
+    """
+    random = numpy.random.RandomState(seed)
+    timings = []
+    errors = {}
+    first_error = None
+    try:
+        while time.time() < deadline:
+            shape = workload.choose(random)
+            start = time.time()
+            try:
+                rows = workload.read(shape, random)
+            except Exception:
+                errors[shape] = errors.get(shape, 0) + 1
+                if first_error is None:
+                    first_error = traceback.format_exc()
+                continue
+            if start >= warmup:
+                timings.append((shape, time.time() - start, rows))
+    finally:
+        connection.close()
+    return timings, errors, first_error
+
+
+def run_reads(workload, threads=8, duration=10, warmup=2, seed=0):
+    """Run the workload from a pool of threads for warmup and then duration
+       seconds, and return the timings of every (recorded) read, the errors
+       of each shape, the traceback of the first error (or None), and the
+       seconds they were recorded for.
+    """
+    started = time.time()
+    warmup = started + warmup
+    deadline = warmup + duration
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = [
+            pool.submit(read_worker, workload, [seed, thread], warmup, deadline)
+            for thread in range(threads)
+        ]
+        results = [future.result() for future in futures]
+    timings = [timing for thread_timings, _, _ in results for timing in thread_timings]
+    errors = {}
+    for _, thread_errors, _ in results:
+        for shape, count in thread_errors.items():
+            errors[shape] = errors.get(shape, 0) + count
+    first_errors = [error for _, _, error in results if error is not None]
+    return (
+        timings,
+        errors,
+        first_errors[0] if first_errors else None,
+        time.time() - warmup,
+    )
+
+
+def summarize_reads(timings, seconds, errors=None, **labels):
+    """One record per query shape with the QPS and latency percentiles (in
+       milliseconds) and its errors, plus the labels (e.g., the concurrent
+       load).
+    """
+    errors = errors or {}
+    results = []
+    for shape in SHAPES:
+        latencies = [latency for name, latency, _ in timings if name == shape]
+        if not latencies:
+            continue
+        milliseconds = numpy.array(latencies) * 1000
+        rows = [count for name, _, count in timings if name == shape]
+        results.append(
+            dict(
+                labels,
+                shape=shape,
+                queries=len(latencies),
+                errors=errors.get(shape, 0),
+                qps=len(latencies) / seconds,
+                p50_ms=float(numpy.percentile(milliseconds, 50)),
+                p95_ms=float(numpy.percentile(milliseconds, 95)),
+                p99_ms=float(numpy.percentile(milliseconds, 99)),
+                max_ms=float(milliseconds.max()),
+                mean_rows=float(numpy.mean(rows)),
+            )
+        )
+    return results
+
+
+class LoadStopped(Exception):
+    pass
+
+
+def iter_load_chunks(matrix, ids, ranks, metric, block_size, stop, loaded):
+    """Binary COPY chunks for a concurrent load, counting the rows sent in
+       loaded, and stopping the COPY (rolling it back) once stop is set.
+    """
+    yield HEADER + encode_rows(ids, ids, numpy.ones(len(ids)), metric)
+    for gene1, gene2, scores in iter_pair_blocks(
+        matrix, ids, ranks, block_size=block_size, symmetric=is_symmetric()
+    ):
+        if stop.is_set():
+            raise LoadStopped()
+        yield encode_rows(gene1, gene2, scores, metric)
+        with loaded.get_lock():
+            loaded.value += len(scores)
+    yield TRAILER
+
+
+def concurrent_load(stop, loaded, metric, block_size=250, seed=0):
+    """Load similarities for the genes (as another metric, so the reads
+       aren't changed) with binary COPY again and again until stop is set,
+       and remove them afterwards. This runs in its own process, so it
+       competes with the reads for the database but not for the GIL.
+    """
+    try:
+        index = get_gene_index()
+        ids = index.sorted_ids
+        ranks = get_name_ranks(index.sorted_names.tolist())
+        matrix = SimilarityEngine(generate_features(len(ids), seed=seed))
+        while not stop.is_set():
+            chunks = iter_load_chunks(
+                matrix, ids, ranks, metric, block_size, stop, loaded
+            )
+            stream_copy(
+                chunks,
+                table="datasets_genesimilarity",
+                columns=("gene1_id", "gene2_id", "metric", "score"),
+                binary=True,
+            )
+            reset_genes(metric=metric)
+    except LoadStopped:
+        pass
+    finally:
+        reset_genes(metric=metric)
+        connection.close()
+
+
+class ConcurrentLoad(object):
+    """Run concurrent_load in a forked process while reads are measured:
+
+       with ConcurrentLoad("benchmark_load") as load:
+           ...
+       load.rows  # rows sent to COPY meanwhile
+    """
+
+    def __init__(self, metric, block_size=250, seed=0):
+        self.metric = metric
+        self.block_size = block_size
+        self.seed = seed
+        self.rows = 0
+
+    def __enter__(self):
+        context = multiprocessing.get_context("fork")
+        self.stop = context.Event()
+        self.loaded = context.Value("q", 0)
+
+        # Connections can't be shared across a fork, the load opens its own
+        connections.close_all()
+        self.process = context.Process(
+            target=concurrent_load,
+            args=(self.stop, self.loaded, self.metric, self.block_size, self.seed),
+            daemon=True,
+        )
+        self.process.start()
+
+        # Measure while the load is running, not while it starts
+        while self.loaded.value == 0 and self.process.is_alive():
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.process.join()
+        self.rows = self.loaded.value
+        if self.process.exitcode != 0:
+            raise RuntimeError(
+                f"The concurrent load exited with {self.process.exitcode}"
+            )
@@ -0,0 +1,99 @@
+from __future__ import unicode_literals
+
+from contextlib import closing
+
+import time
+
+from django.db import connection, transaction
+
+from genesim.apps.datasets.models import LoadGeneration
+from genesim.apps.datasets.partition import ROOT, clear_metric_partition, is_partitioned
+
+# Tables that reference genes, they are cleared before the genes themselves
+SIMILARITY_TABLES = [
+    "datasets_genesimilarity",
+    "datasets_compactgenesimilarity",
+    "datasets_genesimilarityvector",
+    "datasets_genesimilarityorder",
+    "datasets_genetopsimilar",
+]
+
+# Tables derived from the similarities of a metric and its genes, which are
+# stale once genes are added or removed
+DERIVED_TABLES = SIMILARITY_TABLES[1:]
+
+# The columns of each table that reference a gene
+GENE_COLUMNS = {
+    "datasets_genesimilarity": ("gene1_id", "gene2_id"),
+    "datasets_compactgenesimilarity": ("gene1_id", "gene2_id"),
+    "datasets_genesimilarityvector": ("gene_id",),
+    "datasets_genetopsimilar": ("gene_id", "other_id"),
+}
+
+
+def reset_genes(keep_genes=False, metric=None, tables=None):
+    """Start fresh without Django's deletion collector, which would fetch and
+       cascade through every similarity in Python before deleting. PostgreSQL
+       uses TRUNCATE ... RESTART IDENTITY CASCADE, and other databases (SQLite)
+       a bulk DELETE per table. With keep_genes only the similarities are
+       cleared, and with a metric only the similarities for that metric
+       (genes are kept), and if datasets_genesimilarity is partitioned by
+       metric (see partition.py) its partition is replaced by an empty one
+       rather than deleted from. With a metric, tables (e.g., DERIVED_TABLES)
+       limits the tables that are cleared. Returns the number of seconds it
+       took.
+    """
+    start = time.time()
+    with transaction.atomic(), closing(connection.cursor()) as cursor:
+
+        # Only one metric, there is nothing to truncate
+        if metric is not None:
+            partitioned = connection.vendor == "postgresql" and is_partitioned()
+            for table in tables or SIMILARITY_TABLES:
+                if table == ROOT and partitioned and clear_metric_partition(metric):
+                    continue
+                elif table == "datasets_compactgenesimilarity":
+                    cursor.execute(
+                        f"""DELETE FROM {table} WHERE metric_id IN
+                            (SELECT id FROM datasets_metric WHERE name = %s)""",
+                        [metric],
+                    )
+                else:
+                    cursor.execute(f"DELETE FROM {table} WHERE metric = %s", [metric])
+
+        else:
+            tables = list(SIMILARITY_TABLES)
+            if not keep_genes:
+                tables.append("datasets_gene")
+
+            if connection.vendor == "postgresql":
+                cursor.execute(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY CASCADE")
+            else:
+                for table in tables:
+                    cursor.execute(f"DELETE FROM {table}")
+            if not keep_genes:
+                LoadGeneration.bump(LoadGeneration.GENES)
+
+        LoadGeneration.bump()
+
+    return time.time() - start
+
+
+def delete_genes(ids):
+    """Delete genes by id without Django's deletion collector (see
+       reset_genes): the rows that reference them are deleted with one
+       DELETE ... = ANY(%s) per table, and then the genes. Only available
+       with PostgreSQL. Returns the number of similarities deleted.
+    """
+    ids = list(ids)
+    deleted = 0
+    with transaction.atomic(), closing(connection.cursor()) as cursor:
+        for table, columns in GENE_COLUMNS.items():
+            where = " OR ".join(f"{column} = ANY(%s)" for column in columns)
+            cursor.execute(f"DELETE FROM {table} WHERE {where}", [ids] * len(columns))
+            if table == ROOT:
+                deleted = cursor.rowcount
+        cursor.execute("DELETE FROM datasets_gene WHERE id = ANY(%s)", [ids])
+        LoadGeneration.bump()
+        LoadGeneration.bump(LoadGeneration.GENES)
+    return deleted
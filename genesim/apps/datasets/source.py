@@ -0,0 +1,138 @@
+from __future__ import unicode_literals
+
+import json
+import os
+
+import numpy
+import tables
+
+from genesim.apps.datasets.engine import SimilarityEngine, read_expression
+
+
+class MatrixSource(object):
+    """A similarity matrix on disk, either the "similarities" dataset of an
+       HDF5 file (PyTables) or a memory mapped .npy, as written by the
+       export_similarities command. Only the rows that are sliced are read,
+       so a loader sees one block of rows at a time and never the whole
+       matrix. The file is opened again in a forked process (HDF5 handles
+       can't be shared across a fork).
+
+       If the matrix is symmetric, full rows are read as rows instead of
+       mirrored from columns (see matrix.iter_row_blocks). Pass symmetric if
+       it's known, otherwise it's checked on a sample of genes. Blocks with
+       scores that aren't finite are rejected when they're read.
+    """
+
+    def __init__(self, path, symmetric=None):
+        self.path = path
+        self.hdf5 = not path.endswith(".npy")
+        self._pid = None
+        self._file = None
+        self._matrix = None
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} does not exist.")
+        self.shape = self.matrix.shape
+        self.symmetric = self.check_symmetric() if symmetric is None else symmetric
+
+    @property
+    def matrix(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            if self.hdf5:
+                self._file = tables.open_file(self.path, mode="r")
+                self._matrix = self._file.root.similarities
+            else:
+                self._matrix = numpy.load(self.path, mmap_mode="r")
+        return self._matrix
+
+    def get_names(self):
+        """The gene names for the rows (and columns), the "genes" array of an
+           HDF5 file or the .genes.json next to a .npy, or None if missing.
+        """
+        if self.hdf5:
+            root = self.matrix._v_file.root
+            if "genes" not in root:
+                return None
+            return [name.decode("utf-8") for name in root.genes.read()]
+
+        names_json = f"{self.path}.genes.json"
+        if not os.path.exists(names_json):
+            return None
+        with open(names_json, "r") as fd:
+            return json.loads(fd.read())
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        block = numpy.asarray(self.matrix[key])
+        if not numpy.isfinite(block).all():
+            raise ValueError(f"{self.path} has scores that are NaN or infinite.")
+        return block
+
+    def get_diagonal(self, first=0, last=None):
+        """Return the score of each gene with itself for rows first to last,
+           one score read per row (PyTables arrays have no point selection).
+        """
+        last = len(self) if last is None else min(last, len(self))
+        diagonal = numpy.array(
+            [self.matrix[i, i] for i in range(first, last)], dtype=numpy.float64
+        )
+        if not numpy.isfinite(diagonal).all():
+            raise ValueError(f"{self.path} has scores that are NaN or infinite.")
+        return diagonal
+
+    def check_symmetric(self, samples=64, seed=0, decimal_places=3):
+        """Check the matrix is symmetric once rounded to thousandths (as the
+           scores are stored) for the rows and columns of a random sample of
+           genes, which only reads the rows of those genes.
+        """
+        random = numpy.random.RandomState(seed)
+        size = min(samples, len(self))
+        picked = numpy.sort(random.choice(len(self), size=size, replace=False))
+        tile = numpy.stack([self[int(i)] for i in picked])[:, picked]
+        tile = numpy.round(tile, decimal_places)
+        return bool(numpy.array_equal(tile, tile.T))
+
+    def iter_blocks(self, block_size=250, start=0, stop=None):
+        """Yield (first, block) for blocks of rows of the matrix"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for first in range(start, stop, block_size):
+            yield first, self[first : min(first + block_size, stop)]
+
+    def close(self):
+        if self._file is not None and self._pid == os.getpid():
+            self._file.close()
+        self._pid = self._file = self._matrix = None
+
+    def __del__(self):
+        self.close()
+
+
+def get_matrix(genes, path=None, create_sims=None, expression=None, metric="cosine"):
+    """Return the similarity matrix for a list of genes: the MatrixSource at
+       a path, checking it has a row for each gene in the same order, or a
+       SimilarityEngine computing a metric from an expression file (with the
+       rows in the order of genes), or else the values of create_sims(genes).
+    """
+    if expression is not None:
+        names, values = read_expression(expression)
+        positions = {name: i for i, name in enumerate(names)}
+        missing = [gene for gene in genes if gene not in positions]
+        if missing:
+            raise ValueError(
+                f"{expression} has no expression for {len(missing)} genes."
+            )
+        rows = [positions[gene] for gene in genes]
+        return SimilarityEngine(numpy.asarray(values)[rows], metric=metric)
+
+    if path is None:
+        return create_sims(genes).values
+
+    source = MatrixSource(path)
+    names = source.get_names()
+    if source.shape != (len(genes), len(genes)):
+        raise ValueError(f"{path} has {len(source)} rows for {len(genes)} genes.")
+    if names is not None and names != list(genes):
+        raise ValueError(f"The genes of {path} are not the genes (or gene order).")
+    return source
@@ -0,0 +1,132 @@
+from __future__ import unicode_literals
+
+from contextlib import closing, contextmanager
+import itertools
+import time
+
+from django.db import IntegrityError, connection, transaction
+
+import numpy
+
+from genesim.apps.datasets.matrix import get_diagonal, iter_pair_blocks
+from genesim.apps.datasets.models import LoadGeneration
+
+# Pragmas for a bulk load: the rollback journal is kept in memory, commits
+# don't wait for fsync, a 256MB page cache, and foreign keys are checked once
+# after the load instead of for every row
+LOAD_PRAGMAS = {
+    "journal_mode": "MEMORY",
+    "synchronous": "OFF",
+    "cache_size": -262144,
+    "temp_store": "MEMORY",
+    "foreign_keys": "OFF",
+}
+
+
+@contextmanager
+def sqlite_pragmas(cursor, pragmas):
+    """Set pragmas for a load, and restore the previous values afterwards.
+       journal_mode and foreign_keys can't be changed in a transaction, so
+       this is entered outside of one.
+    """
+    previous = {}
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name}")
+        previous[name] = cursor.fetchone()[0]
+        cursor.execute(f"PRAGMA {name} = {value}")
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+def get_sqlite_indexes(cursor, table):
+    """Return (name, sql) for the indexes Django created on a table. Indexes
+       for a UNIQUE constraint (sqlite_autoindex_*) have no SQL and can't be
+       dropped, so they are kept during a load.
+    """
+    cursor.execute(
+        """SELECT name, sql FROM sqlite_master
+           WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL
+           ORDER BY name""",
+        [table],
+    )
+    return cursor.fetchall()
+
+
+def iter_row_tuples(
+    matrix, ids, ranks, metric="cosine", block_size=250, symmetric=False
+):
+    """Yield an iterator of (gene1_id, gene2_id, metric, score) tuples for
+       the diagonal (see matrix.get_diagonal), and then for each block of
+       matrix rows. The
+       same rows as matrix.iter_text_chunks, as tuples for executemany.
+    """
+    diagonal = ids.tolist()
+    scores = numpy.round(get_diagonal(matrix, 0, len(ids)), 3).tolist()
+    yield zip(diagonal, diagonal, itertools.repeat(metric), scores)
+    for gene1, gene2, scores in iter_pair_blocks(
+        matrix, ids, ranks, block_size=block_size, symmetric=symmetric
+    ):
+        yield zip(
+            gene1.tolist(),
+            gene2.tolist(),
+            itertools.repeat(metric),
+            numpy.round(scores, 3).tolist(),
+        )
+
+
+def sqlite_load(blocks, table, columns, pragmas=None):
+    """Load blocks of row tuples into a SQLite table, without COPY:
+
+       1. set the load pragmas (LOAD_PRAGMAS by default)
+       2. drop the indexes of the table (see get_sqlite_indexes)
+       3. executemany each block, with one transaction per block
+       4. create each index, and check the foreign keys of the table once
+
+       Returns a list of (phase, seconds) like deferred.deferred_copy.
+    """
+    quote_name = connection.ops.quote_name
+    pragmas = LOAD_PRAGMAS if pragmas is None else pragmas
+    query = "INSERT INTO %s (%s) VALUES (%s)" % (
+        table,
+        ", ".join(columns),
+        ", ".join(["%s"] * len(columns)),
+    )
+    timings = []
+
+    with closing(connection.cursor()) as cursor, sqlite_pragmas(cursor, pragmas):
+        start = time.time()
+        indexes = get_sqlite_indexes(cursor, table)
+        with transaction.atomic():
+            for name, _ in indexes:
+                cursor.execute("DROP INDEX %s" % quote_name(name))
+        timings.append(("drop_indexes", time.time() - start))
+
+        try:
+            start = time.time()
+            for rows in blocks:
+                with transaction.atomic():
+                    cursor.executemany(query, rows)
+            timings.append(("executemany", time.time() - start))
+
+        # The indexes are added back even if the load failed
+        finally:
+            with transaction.atomic():
+                for name, definition in indexes:
+                    start = time.time()
+                    cursor.execute(definition)
+                    timings.append(("rebuild_%s" % name, time.time() - start))
+
+        start = time.time()
+        cursor.execute("PRAGMA foreign_key_check(%s)" % table)
+        violations = cursor.fetchall()
+        if violations:
+            raise IntegrityError(
+                f"{len(violations)} rows of {table} reference missing rows."
+            )
+        timings.append(("foreign_key_check", time.time() - start))
+
+    LoadGeneration.bump()
+    return timings
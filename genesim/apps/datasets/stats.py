@@ -0,0 +1,17 @@
+from __future__ import unicode_literals
+
+from contextlib import closing
+
+from django.db import connection
+
+
+def get_table_sizes(table):
+    """Return the size in bytes of a table (including toast) and of all of
+       its indexes, to compare storage between loaders and schemas.
+    """
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            "SELECT pg_table_size(%s::regclass), pg_indexes_size(%s::regclass)",
+            [table, table],
+        )
+        return cursor.fetchone()
@@ -0,0 +1,306 @@
+from __future__ import unicode_literals
+
+from contextlib import closing
+import os
+import tempfile
+
+from django.db import connection
+
+from genesim.apps.datasets.cells import (
+    SIMILARITY_COLUMNS,
+    bulk_create_diagonal,
+    bulk_create_genes,
+    bulk_create_similarities,
+    copy_diagonal,
+    copy_file,
+    copy_genes,
+    copy_similarities,
+    get_or_create_diagonal,
+    get_or_create_genes,
+    get_or_create_similarities,
+    write_similarities,
+)
+from genesim.apps.datasets.deferred import deferred_copy
+from genesim.apps.datasets.matrix import (
+    count_rows,
+    get_gene_ids,
+    get_name_ranks,
+    iter_text_chunks,
+)
+from genesim.apps.datasets.models import LoadGeneration, is_symmetric
+from genesim.apps.datasets.parallel import parallel_copy
+from genesim.apps.datasets.pgcopy import iter_binary_chunks
+from genesim.apps.datasets.sqlite import iter_row_tuples, sqlite_load
+from genesim.apps.datasets.stream import stream_copy
+
+# Load strategies by name, added with @register
+STRATEGIES = {}
+
+
+def register(cls):
+    """Register a LoadStrategy subclass under its name, so run_benchmarks can
+       run it. Strategies in other modules register the same way, and are
+       imported by listing them in BENCHMARK_STRATEGY_MODULES.
+    """
+    STRATEGIES[cls.name] = cls
+    return cls
+
+
+class LoadStrategy(object):
+    """A way to load genes, and then a similarity matrix for them (with rows
+       and columns in the order of the names). create_similarities returns
+       the number of similarities written, and sets bytes_sent when it
+       streams to COPY. The two are timed separately. vendors lists the
+       databases (connection.vendor) it runs on, or None for any. Like the
+       tests, strategies write half the matrix with symmetric storage.
+    """
+
+    name = None
+    vendors = None
+    bytes_sent = None
+
+    def __init__(self, metric="cosine", block_size=250, workers=4):
+        self.metric = metric
+        self.block_size = block_size
+        self.workers = workers
+        self.symmetric = is_symmetric()
+
+    def create_genes(self, names):
+        copy_genes(names)
+
+    def create_similarities(self, names, matrix):
+        raise NotImplementedError
+
+
+@register
+class BaselineStrategy(LoadStrategy):
+    """Django get_or_create for every gene and cell (test 1)"""
+
+    name = "baseline"
+
+    def create_genes(self, names):
+        get_or_create_genes(names)
+
+    def create_similarities(self, names, matrix):
+        rows = get_or_create_diagonal(names, metric=self.metric)
+        return rows + sum(
+            get_or_create_similarities(
+                names, matrix, metric=self.metric, symmetric=self.symmetric
+            )
+        )
+
+
+@register
+class BulkStrategy(LoadStrategy):
+    """Django bulk_create for the genes, and for each row of similarities
+       (test 2)
+    """
+
+    name = "bulk"
+
+    def create_genes(self, names):
+        bulk_create_genes(names)
+
+    def create_similarities(self, names, matrix):
+        rows = bulk_create_diagonal(names, metric=self.metric)
+        return rows + sum(
+            bulk_create_similarities(
+                names, matrix, metric=self.metric, symmetric=self.symmetric
+            )
+        )
+
+
+@register
+class CopyFromStrategy(LoadStrategy):
+    """COPY from a StringIO for each row of similarities, still looking up
+       each gene with a query (test 3)
+    """
+
+    name = "copyfrom"
+    vendors = ("postgresql",)
+
+    def create_similarities(self, names, matrix):
+        rows, self.bytes_sent = copy_diagonal(names, metric=self.metric)
+        for count, bytes_sent in copy_similarities(
+            names, matrix, metric=self.metric, symmetric=self.symmetric
+        ):
+            rows += count
+            self.bytes_sent += bytes_sent
+        return rows
+
+
+@register
+class CopyFromFileStrategy(LoadStrategy):
+    """Write every similarity to a file (looking up each gene with a query),
+       and then COPY from the file (test 4)
+    """
+
+    name = "copyfromfile"
+    vendors = ("postgresql",)
+
+    def create_similarities(self, names, matrix):
+        rows, self.bytes_sent = copy_diagonal(names, metric=self.metric)
+        _, tmpfile = tempfile.mkstemp()
+        rows += write_similarities(
+            tmpfile, names, matrix, metric=self.metric, symmetric=self.symmetric
+        )
+        copy_file(tmpfile)
+        self.bytes_sent += os.path.getsize(tmpfile)
+        os.remove(tmpfile)
+        return rows
+
+
+@register
+class VectorizedStrategy(LoadStrategy):
+    """Pairs for blocks of rows with numpy written to a file, and then COPY
+       from the file (test 5)
+    """
+
+    name = "vectorized"
+    vendors = ("postgresql",)
+
+    def create_similarities(self, names, matrix):
+        ids = get_gene_ids(names)
+        ranks = get_name_ranks(names)
+        _, tmpfile = tempfile.mkstemp()
+        with open(tmpfile, "wb") as csv_file:
+            for chunk in iter_text_chunks(
+                matrix,
+                ids,
+                ranks,
+                metric=self.metric,
+                block_size=self.block_size,
+                symmetric=self.symmetric,
+            ):
+                csv_file.write(chunk)
+
+        copy_file(tmpfile)
+        self.bytes_sent = os.path.getsize(tmpfile)
+        os.remove(tmpfile)
+        return count_rows(ranks, symmetric=self.symmetric)
+
+
+@register
+class StreamingStrategy(LoadStrategy):
+    """Text chunks generated in a thread while a single COPY consumes them
+       (test 6)
+    """
+
+    name = "streaming"
+    vendors = ("postgresql",)
+    binary = False
+
+    def get_chunks(self, matrix, ids, ranks):
+        return iter_text_chunks(
+            matrix,
+            ids,
+            ranks,
+            metric=self.metric,
+            block_size=self.block_size,
+            symmetric=self.symmetric,
+        )
+
+    def create_similarities(self, names, matrix):
+        ids = get_gene_ids(names)
+        ranks = get_name_ranks(names)
+        self.bytes_sent = stream_copy(
+            self.get_chunks(matrix, ids, ranks),
+            table="datasets_genesimilarity",
+            columns=SIMILARITY_COLUMNS,
+            binary=self.binary,
+        )
+        return count_rows(ranks, symmetric=self.symmetric)
+
+
+@register
+class BinaryStrategy(StreamingStrategy):
+    """Streaming with binary (PGCOPY) chunks encoded with numpy (test 7)"""
+
+    name = "binary"
+    binary = True
+
+    def get_chunks(self, matrix, ids, ranks):
+        return iter_binary_chunks(
+            matrix,
+            ids,
+            ranks,
+            metric=self.metric,
+            block_size=self.block_size,
+            symmetric=self.symmetric,
+        )
+
+
+@register
+class ParallelStrategy(LoadStrategy):
+    """Binary COPY of ranges of rows by a pool of worker processes (test 8)"""
+
+    name = "parallel"
+    vendors = ("postgresql",)
+
+    def create_similarities(self, names, matrix):
+        results = parallel_copy(
+            matrix,
+            get_gene_ids(names),
+            get_name_ranks(names),
+            workers=self.workers,
+            metric=self.metric,
+            block_size=self.block_size,
+            symmetric=self.symmetric,
+        )
+        self.bytes_sent = sum(result["bytes"] for result in results)
+        return sum(result["count"] for result in results)
+
+
+@register
+class DeferredStrategy(BinaryStrategy):
+    """Binary COPY into a staging table, and then moved over with indexes
+       and constraints rebuilt afterwards (test 9)
+    """
+
+    name = "deferred"
+
+    def create_similarities(self, names, matrix):
+        ids = get_gene_ids(names)
+        ranks = get_name_ranks(names)
+        deferred_copy(
+            self.get_chunks(matrix, ids, ranks),
+            table="datasets_genesimilarity",
+            columns=SIMILARITY_COLUMNS,
+        )
+        return count_rows(ranks, symmetric=self.symmetric)
+
+
+@register
+class SQLiteStrategy(LoadStrategy):
+    """executemany with load pragmas, one transaction per block of rows, and
+       indexes rebuilt afterwards, for SQLite (see sqlite.py)
+    """
+
+    name = "sqlite"
+    vendors = ("sqlite",)
+
+    def create_genes(self, names):
+        with closing(connection.cursor()) as cursor:
+            cursor.executemany(
+                "INSERT INTO datasets_gene (systematic_name, common_name)"
+                " VALUES (%s, %s)",
+                [(name, name) for name in names],
+            )
+        LoadGeneration.bump(LoadGeneration.GENES)
+
+    def create_similarities(self, names, matrix):
+        ids = get_gene_ids(names)
+        ranks = get_name_ranks(names)
+        sqlite_load(
+            iter_row_tuples(
+                matrix,
+                ids,
+                ranks,
+                metric=self.metric,
+                block_size=self.block_size,
+                symmetric=self.symmetric,
+            ),
+            table="datasets_genesimilarity",
+            columns=SIMILARITY_COLUMNS,
+        )
+        return count_rows(ranks, symmetric=self.symmetric)
@@ -0,0 +1,135 @@
+from __future__ import unicode_literals
+
+from contextlib import closing
+from queue import Empty, Queue
+import io
+import threading
+
+from django.db import connection
+
+from genesim.apps.datasets.models import LoadGeneration
+
+
+class IteratorFile(io.RawIOBase):
+    """A read only file-like object over an iterator of bytes chunks, so that
+       we can hand a generator to cursor.copy_expert without ever holding
+       more than one chunk in memory.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b""
+        self.position = 0
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size < 0 or size > 0:
+            if self.position >= len(self.chunk):
+                self.chunk = next(self.chunks, None)
+                self.position = 0
+                if self.chunk is None:
+                    self.chunk = b""
+                    break
+            end = len(self.chunk) if size < 0 else self.position + size
+            part = self.chunk[self.position : end]
+            self.position += len(part)
+            if size > 0:
+                size -= len(part)
+            parts.append(part)
+
+        chunk = b"".join(parts)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+class ProducerThread(threading.Thread):
+    """Run a generator of chunks in a background thread, putting each chunk
+       on a bounded queue. The queue size is what keeps memory flat: when the
+       consumer (COPY) falls behind, the producer blocks.
+    """
+
+    done = object()
+
+    def __init__(self, chunks, maxsize=8):
+        super().__init__(daemon=True)
+        self.chunks = chunks
+        self.queue = Queue(maxsize=maxsize)
+        self.error = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            for chunk in self.chunks:
+                if self.stopped.is_set():
+                    break
+                self.queue.put(chunk)
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.queue.put(self.done)
+
+    def stop(self):
+        """Ask the producer to stop, and drain the queue so it isn't blocked
+        """
+        self.stopped.set()
+        while self.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+    def __iter__(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is self.done:
+                break
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+
+def get_copy_query(table, columns, sep="\t", binary=False):
+    """Return the COPY ... FROM STDIN statement for text or binary format
+    """
+    query = "COPY %s (%s) FROM STDIN WITH " % (table, ", ".join(columns))
+    if binary:
+        return query + "(FORMAT binary)"
+    return query + "(FORMAT text, DELIMITER E'%s')" % sep.encode(
+        "unicode_escape"
+    ).decode("utf-8")
+
+
+def stream_copy(
+    chunks, table, columns, sep="\t", maxsize=8, size=262144, binary=False, bump=True,
+):
+    """Stream an iterator of encoded row chunks into a single COPY. Chunks are
+       generated in a producer thread while the database consumes them, and
+       the number of bytes sent is returned. With binary, the chunks must be
+       PGCOPY data (see pgcopy.py) including the header and trailer. The
+       load generation is bumped, so cached ranked similarities are stale (or
+       for datasets_gene the generation of the genes, so GeneIndexes are),
+       unless bump is False (e.g., the caller bumps it after committing).
+    """
+    producer = ProducerThread(chunks, maxsize=maxsize)
+    stream = IteratorFile(producer)
+    query = get_copy_query(table, columns, sep=sep, binary=binary)
+    producer.start()
+    try:
+        with closing(connection.cursor()) as cursor:
+            cursor.copy_expert(query, stream, size)
+    finally:
+        producer.stop()
+        producer.join()
+
+    # The producer error is the one worth showing, not the aborted COPY
+    if producer.error is not None:
+        raise producer.error
+    if bump and table == "datasets_gene":
+        LoadGeneration.bump(LoadGeneration.GENES)
+    elif bump:
+        LoadGeneration.bump()
+    return stream.bytes_read
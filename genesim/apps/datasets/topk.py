@@ -0,0 +1,122 @@
+from __future__ import unicode_literals
+
+from contextlib import closing
+
+from django.conf import settings
+from django.db import connection, transaction
+
+import numpy
+
+from genesim.apps.datasets.pgcopy import round_scaled
+from genesim.apps.datasets.stream import stream_copy
+
+
+def get_top_k():
+    """The number of most (and least) similar genes to keep for each gene,
+       set with TOP_SIMILAR_K in the environment.
+    """
+    return getattr(settings, "TOP_SIMILAR_K", 50)
+
+
+def get_id_ranks(ids):
+    """Return the rank of each gene id, used to break ties between equal
+       scores by gene id like the ranked query does.
+    """
+    id_ranks = numpy.empty(len(ids), dtype=numpy.int64)
+    id_ranks[numpy.argsort(ids, kind="stable")] = numpy.arange(len(ids))
+    return id_ranks
+
+
+def select_top(scaled, id_ranks, k, reverse=False):
+    """Given a block of full matrix rows as scaled integer scores, return the
+       columns of the k highest (or with reverse, lowest) scores for each row
+       in ranked order. Scores and id ranks are combined into one key, so
+       argpartition also settles ties at the k-th score by gene id.
+    """
+    keys = (scaled if reverse else -scaled) * len(id_ranks) + id_ranks
+    if k < keys.shape[1]:
+        top = numpy.argpartition(keys, k - 1, axis=1)[:, :k]
+    else:
+        top = numpy.broadcast_to(numpy.arange(keys.shape[1]), keys.shape)
+    order = numpy.argsort(numpy.take_along_axis(keys, top, axis=1), axis=1)
+    return numpy.take_along_axis(top, order, axis=1)
+
+
+def format_top_rows(gene, other, scaled, metric="cosine", reverse=False):
+    """Format (gene, other, rank, score) for a block of top similar genes as
+       tab separated text for COPY, with rows and ranks as the two axes.
+    """
+    template = "%d\t%d\t" + metric + ("\tt" if reverse else "\tf") + "\t%d\t%.3f\n"
+    rank = numpy.broadcast_to(numpy.arange(other.shape[1]), other.shape)
+    gene = numpy.broadcast_to(gene[:, None], other.shape)
+    rows = zip(
+        gene.ravel().tolist(),
+        other.ravel().tolist(),
+        rank.ravel().tolist(),
+        (scaled.ravel() / 1000).tolist(),
+    )
+    return "".join(map(template.__mod__, rows))
+
+
+class TopSimilar(object):
+    """Collects the top (and bottom) k similar genes of each gene from the
+       blocks of entire matrix rows a loader reads anyway (pass it as top to
+       the chunk helpers), so the matrix isn't read a second time. save
+       writes them after the load.
+    """
+
+    def __init__(self, ids, k=None, metric="cosine"):
+        self.ids = ids
+        self.k = get_top_k() if k is None else k
+        self.metric = metric
+        self.id_ranks = get_id_ranks(ids)
+        self.blocks = []
+
+    def add(self, first, block):
+        """Select the top genes for a block of full rows, starting at first"""
+        gene = self.ids[first : first + len(block)]
+        scaled = round_scaled(block.ravel()).reshape(block.shape)
+        for reverse in (False, True):
+            top = select_top(scaled, self.id_ranks, self.k, reverse=reverse)
+            self.blocks.append(
+                (
+                    gene,
+                    self.ids[top],
+                    numpy.take_along_axis(scaled, top, axis=1).astype(numpy.int32),
+                    reverse,
+                )
+            )
+
+    def __len__(self):
+        return sum(other.size for _, other, _, _ in self.blocks)
+
+    def iter_chunks(self):
+        """Yield encoded COPY text chunks of GeneTopSimilar rows"""
+        for gene, other, scaled, reverse in self.blocks:
+            yield format_top_rows(
+                gene, other, scaled, metric=self.metric, reverse=reverse
+            ).encode("utf-8")
+
+    def save(self):
+        """Replace the GeneTopSimilar rows for the metric with the ones
+           collected, returning the number of rows written.
+        """
+        with transaction.atomic():
+            clear_top_similar(self.metric)
+            stream_copy(
+                self.iter_chunks(),
+                table="datasets_genetopsimilar",
+                columns=("gene_id", "other_id", "metric", "reverse", "rank", "score"),
+            )
+        return len(self)
+
+
+def clear_top_similar(metric="cosine"):
+    """Delete the top similar genes for a metric, after its scores change
+       in a way that the loader didn't see (the reads fall back to the
+       similarity table).
+    """
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            "DELETE FROM datasets_genetopsimilar WHERE metric = %s", [metric]
+        )
@@ -0,0 +1,116 @@
+from __future__ import unicode_literals
+
+from contextlib import closing
+
+from django.db import connection, transaction
+
+import numpy
+
+from genesim.apps.datasets.models import GeneSimilarity, LoadGeneration
+from genesim.apps.datasets.pgcopy import HEADER, TRAILER, encode_rows
+from genesim.apps.datasets.stream import stream_copy
+from genesim.apps.datasets.topk import clear_top_similar
+
+# Each update also clears the top similar genes of its metric, in the same
+# transaction, and reads fall back to the similarity table until a reload
+
+
+def sample_similarities(fraction, metric="cosine", seed=0):
+    """Sample a fraction of the pairs in the similarity matrix for a metric,
+       and return (ids, gene1_ids, gene2_ids, pair index) for every row of
+       those pairs, both ways unless the matrix is stored symmetric. Rows
+       with the same pair index should get the same new score. The diagonal
+       is never sampled, a gene is always 1.0 similar to itself.
+    """
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            """SELECT s.id, s.gene1_id, s.gene2_id FROM datasets_genesimilarity s
+               TABLESAMPLE BERNOULLI (%s) REPEATABLE (%s)
+               WHERE s.metric = %s AND s.gene1_id < s.gene2_id""",
+            [fraction * 100, seed, metric],
+        )
+        pairs = numpy.array(cursor.fetchall(), dtype=numpy.int64).reshape(-1, 3)
+        rows = [pairs]
+
+        # The other half of each pair, found with one query by id
+        cursor.execute(
+            """SELECT m.id, m.gene1_id, m.gene2_id FROM datasets_genesimilarity m
+               JOIN unnest(%s::integer[], %s::integer[]) AS p(gene1_id, gene2_id)
+               ON m.gene1_id = p.gene2_id AND m.gene2_id = p.gene1_id
+               WHERE m.metric = %s AND m.gene1_id > m.gene2_id""",
+            [pairs[:, 1].tolist(), pairs[:, 2].tolist(), metric],
+        )
+        mirrored = numpy.array(cursor.fetchall(), dtype=numpy.int64).reshape(-1, 3)
+        rows.append(mirrored)
+
+    rows = numpy.concatenate(rows)
+    keys = numpy.minimum(rows[:, 1], rows[:, 2]), numpy.maximum(rows[:, 1], rows[:, 2])
+    _, pair_index = numpy.unique(numpy.stack(keys, axis=1), axis=0, return_inverse=True)
+    return rows[:, 0], rows[:, 1], rows[:, 2], pair_index.ravel()
+
+
+def bulk_update_scores(ids, scores, metric="cosine", batch_size=1000):
+    """Update scores with Django bulk_update, using instances with only the
+       primary key and score set (so nothing needs to be fetched first). The
+       ids are similarities for the metric.
+    """
+    similarities = [
+        GeneSimilarity(id=pk, score=round(score, 3))
+        for pk, score in zip(ids.tolist(), scores.tolist())
+    ]
+    with transaction.atomic():
+        GeneSimilarity.objects.bulk_update(
+            similarities, ["score"], batch_size=batch_size
+        )
+        clear_top_similar(metric)
+        LoadGeneration.bump()
+    return len(similarities)
+
+
+def copy_update_scores(gene1, gene2, scores, metric="cosine"):
+    """Binary COPY the new scores into a temporary table, and apply them with
+       a single UPDATE ... FROM joined on (gene1_id, gene2_id, metric).
+    """
+    chunks = [HEADER, encode_rows(gene1, gene2, scores, metric), TRAILER]
+    with transaction.atomic(), closing(connection.cursor()) as cursor:
+        cursor.execute(
+            """CREATE TEMPORARY TABLE similarity_updates
+               (gene1_id integer, gene2_id integer, metric varchar(50),
+               score numeric(10, 3)) ON COMMIT DROP"""
+        )
+        stream_copy(
+            chunks,
+            table="similarity_updates",
+            columns=("gene1_id", "gene2_id", "metric", "score"),
+            binary=True,
+        )
+        cursor.execute(
+            """UPDATE datasets_genesimilarity s SET score = u.score
+               FROM similarity_updates u WHERE s.gene1_id = u.gene1_id
+               AND s.gene2_id = u.gene2_id AND s.metric = u.metric"""
+        )
+        clear_top_similar(metric)
+        LoadGeneration.bump()
+        return cursor.rowcount
+
+
+def upsert_scores(gene1, gene2, scores, metric="cosine", page_size=1000):
+    """Write the new scores with INSERT ... ON CONFLICT DO UPDATE, sending
+       page_size rows per statement (like psycopg2's execute_values, but
+       through Django's cursor, so the queries are instrumented). Rows that
+       don't exist yet are created.
+    """
+    rows = list(zip(gene1.tolist(), gene2.tolist(), scores.round(3).tolist()))
+    with transaction.atomic(), closing(connection.cursor()) as cursor:
+        for first in range(0, len(rows), page_size):
+            page = rows[first : first + page_size]
+            cursor.execute(
+                """INSERT INTO datasets_genesimilarity (gene1_id, gene2_id, metric, score)
+                   VALUES %s ON CONFLICT (gene1_id, gene2_id, metric)
+                   DO UPDATE SET score = EXCLUDED.score"""
+                % ", ".join(["(%s, %s, %s, %s)"] * len(page)),
+                [value for g1, g2, score in page for value in (g1, g2, metric, score)],
+            )
+        clear_top_similar(metric)
+        LoadGeneration.bump()
+    return len(scores)
@@ -3,6 +3,11 @@ from . import views
 
 urlpatterns = [
     path("", views.gene_explorer, name="genes"),
+    path("genes/<str:name>/similar/", views.ranked_similar, name="ranked_similar"),
+    path(
+        "similarities/stream/", views.stream_similarities, name="stream_similarities",
+    ),
+    path("similarities/pairs/", views.similarity_pairs, name="similarity_pairs"),
 ]
 
 app_name = "datasets"
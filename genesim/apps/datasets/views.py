@@ -0,0 +1,272 @@
+from __future__ import unicode_literals
+
+from contextlib import closing
+from decimal import Decimal, InvalidOperation
+import json
+
+from django.db import connection
+from django.db.models import Q
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from genesim.apps.datasets.index import get_gene_index_for, get_gene_names
+from genesim.apps.datasets.models import (
+    Gene,
+    GeneSimilarity,
+    is_symmetric,
+    uses_vectors,
+)
+
+# Upper bounds for a single request, to stay within App Engine limits
+MAX_PAGE_SIZE = 1000
+MAX_STREAM_GENES = 1000
+MAX_PAIRS = 10000
+
+# Pairs looked up per query on databases without unnest (SQLite allows 999
+# parameters in older versions)
+PAIR_BATCH_SIZE = 250
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def get_int(request, name, default=None, maximum=None):
+    """Parse an integer query parameter, raising BadRequest if it's invalid"""
+    value = request.GET.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer")
+    if maximum is None and value < 0:
+        raise BadRequest(f"{name} must be at least 0")
+    if maximum is not None and not 0 <= value <= maximum:
+        raise BadRequest(f"{name} must be between 0 and {maximum}")
+    return value
+
+
+def bad_request(error):
+    return JsonResponse({"error": str(error)}, status=400)
+
+
+@require_GET
+def gene_explorer(request):
+    """List genes by id, a page at a time. The next page starts after the
+       last id of this one (keyset pagination), so it's as fast as the first.
+    """
+    try:
+        after = get_int(request, "after", default=0)
+        limit = get_int(request, "limit", default=100, maximum=MAX_PAGE_SIZE)
+    except BadRequest as exc:
+        return bad_request(exc)
+
+    genes = list(
+        Gene.objects.filter(id__gt=after)
+        .order_by("id")
+        .values_list("id", "systematic_name", "common_name")[:limit]
+    )
+    return JsonResponse(
+        {
+            "genes": [
+                {"id": gene_id, "systematic_name": name, "common_name": common}
+                for gene_id, name, common in genes
+            ],
+            "next": genes[-1][0] if len(genes) == limit and genes else None,
+        }
+    )
+
+
+@require_GET
+def ranked_similar(request, name):
+    """Similar genes for a gene from the most to least similar (or with
+       reverse=true, the least similar first). Pages are keyset paginated on
+       (score, gene id): pass the after_score and after_id of the last result
+       to get the next page, instead of an OFFSET that reads every skipped row.
+    """
+    gene_id = get_gene_index_for([name]).id_for(name)
+    if gene_id is None:
+        return JsonResponse({"error": f"There is no gene {name}"}, status=404)
+    gene = Gene(id=gene_id, systematic_name=name)
+    metric = request.GET.get("metric", "cosine")
+    reverse = request.GET.get("reverse") == "true"
+    try:
+        limit = get_int(request, "limit", default=50, maximum=MAX_PAGE_SIZE)
+        after_id = get_int(request, "after_id")
+        after_score = request.GET.get("after_score")
+        if after_score is not None:
+            after_score = Decimal(after_score)
+    except (BadRequest, InvalidOperation) as exc:
+        return bad_request(exc)
+    if (after_id is None) != (after_score is None):
+        return bad_request("after_id and after_score must be given together")
+
+    # The first page is cached, and read from GeneTopSimilar for a small limit
+    if after_id is None:
+        similar = [
+            (similarity.other_id, similarity.score)
+            for similarity in gene.get_ranked_similar(
+                reverse=reverse, metric=metric, limit=limit
+            )
+        ]
+
+    # Vectors are ranked whole (and cached), so the page is found in the list
+    elif uses_vectors():
+        after = (float(after_score), after_id)
+        similar = [
+            (similarity.other_id, similarity.score)
+            for similarity in gene.get_ranked_similar(reverse=reverse, metric=metric)
+        ]
+        similar = [
+            row
+            for row in similar
+            if (row[1] == after[0] and row[0] > after[1])
+            or (row[1] > after[0] if reverse else row[1] < after[0])
+        ][:limit]
+
+    else:
+        following = Q(score=after_score, other_id__gt=after_id)
+        if reverse:
+            following |= Q(score__gt=after_score)
+        else:
+            following |= Q(score__lt=after_score)
+        similar = list(
+            GeneSimilarity.objects.ranked(gene, metric=metric, reverse=reverse)
+            .filter(following)
+            .values_list("other_id", "score")[:limit]
+        )
+
+    names = get_gene_names([other_id for other_id, _ in similar])
+    last = similar[-1] if len(similar) == limit and similar else None
+    return JsonResponse(
+        {
+            "gene": gene.systematic_name,
+            "metric": metric,
+            "results": [
+                {"id": other_id, "systematic_name": name, "score": float(score)}
+                for (other_id, score), name in zip(similar, names)
+            ],
+            "next": {"after_score": str(last[1]), "after_id": last[0]}
+            if last
+            else None,
+        }
+    )
+
+
+def iter_matrix_rows(gene_ids, metric="cosine"):
+    """Yield the rows of the similarity matrix for genes as COPY text lines
+       (gene1_id, gene2_id, metric, score), one query and one row in memory
+       at a time, without creating model instances.
+    """
+    for gene_id in gene_ids:
+        row = (
+            GeneSimilarity.objects.for_gene(gene_id)
+            .filter(metric=metric)
+            .order_by("other_id")
+            .values_list("other_id", "score")
+        )
+        yield "".join(
+            f"{gene_id}\t{other_id}\t{metric}\t{score}\n" for other_id, score in row
+        )
+
+
+@require_GET
+def stream_similarities(request):
+    """Stream entire rows of the similarity matrix as tab separated text, for
+       one or more genes (?gene=<name>, repeated) or a block of genes by id
+       (?start=<id>&stop=<id>, stop not included).
+    """
+    metric = request.GET.get("metric", "cosine")
+    names = request.GET.getlist("gene")
+    try:
+        start = get_int(request, "start")
+        stop = get_int(request, "stop")
+    except BadRequest as exc:
+        return bad_request(exc)
+
+    if names:
+        index = get_gene_index_for(names)
+        gene_ids = sorted({index.id_for(name) for name in names if name in index})
+    elif start is not None and stop is not None:
+        genes = Gene.objects.filter(id__gte=start, id__lt=stop)
+        gene_ids = list(genes.order_by("id").values_list("id", flat=True))
+    else:
+        return bad_request("gene, or start and stop are required")
+
+    if len(gene_ids) > MAX_STREAM_GENES:
+        return bad_request(f"at most {MAX_STREAM_GENES} genes can be streamed")
+
+    return StreamingHttpResponse(
+        iter_matrix_rows(gene_ids, metric), content_type="text/tab-separated-values"
+    )
+
+
+def get_pair_scores(pairs, metric="cosine"):
+    """Return {(gene1_id, gene2_id): score} for pairs of gene ids with one
+       query (joined on unnest of the pairs), or on databases other than
+       PostgreSQL one query for each batch of pairs. With symmetric storage
+       the pairs must be (smaller, larger).
+    """
+    if connection.vendor != "postgresql":
+        scores = {}
+        for first in range(0, len(pairs), PAIR_BATCH_SIZE):
+            batch = Q()
+            for gene1, gene2 in pairs[first : first + PAIR_BATCH_SIZE]:
+                batch |= Q(gene1_id=gene1, gene2_id=gene2)
+            rows = GeneSimilarity.objects.filter(batch, metric=metric).values_list(
+                "gene1_id", "gene2_id", "score"
+            )
+            scores.update(
+                {(gene1, gene2): float(score) for gene1, gene2, score in rows}
+            )
+        return scores
+
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            """SELECT s.gene1_id, s.gene2_id, s.score FROM datasets_genesimilarity s
+               JOIN unnest(%s::integer[], %s::integer[]) AS p(gene1_id, gene2_id)
+               ON s.gene1_id = p.gene1_id AND s.gene2_id = p.gene2_id
+               WHERE s.metric = %s""",
+            [[pair[0] for pair in pairs], [pair[1] for pair in pairs], metric],
+        )
+        return {
+            (gene1, gene2): float(score) for gene1, gene2, score in cursor.fetchall()
+        }
+
+
+# A read-only JSON API for scripts, which don't have a session (or the CSRF
+# cookie to go with it): POST is only used for a body with many pairs
+@csrf_exempt
+@require_POST
+def similarity_pairs(request):
+    """Look up the scores for many pairs of genes with one query. The body
+       is JSON with "pairs", a list of [name1, name2], and optionally the
+       "metric". Scores are returned in the same order, null if missing.
+    """
+    try:
+        data = json.loads(request.body)
+        pairs = [(str(name1), str(name2)) for name1, name2 in data["pairs"]]
+        metric = str(data.get("metric", "cosine"))
+    except (KeyError, TypeError, ValueError):
+        return bad_request('the body must be JSON with "pairs": [[name1, name2], ...]')
+    if len(pairs) > MAX_PAIRS:
+        return bad_request(f"at most {MAX_PAIRS} pairs can be looked up")
+
+    ids = get_gene_index_for({name for pair in pairs for name in pair}).lookup
+    found = [(ids[a], ids[b]) for a, b in pairs if a in ids and b in ids]
+
+    # With symmetric storage, only (smaller id, larger id) is stored
+    if is_symmetric():
+        found = [(min(pair), max(pair)) for pair in found]
+
+    scores = get_pair_scores(found, metric)
+
+    results = []
+    for name1, name2 in pairs:
+        pair = (ids.get(name1), ids.get(name2))
+        if is_symmetric() and None not in pair:
+            pair = (min(pair), max(pair))
+        results.append({"gene1": name1, "gene2": name2, "score": scores.get(pair)})
+    return JsonResponse({"metric": metric, "results": results})
@@ -167,3 +167,28 @@ MEDIA_URL = "/data/"
 
 # On any admin or plugin login redirect to standard social-auth entry point for agreement to terms
 LOGIN_REDIRECT_URL = "/login"
+
+# Only store similarities where gene1 <= gene2, the other half is mirrored on read
+SYMMETRIC_SIMILARITY = os.getenv("SYMMETRIC_SIMILARITY") == "true"
+
+# Serve ranked similarities from packed per-gene vectors (GeneSimilarityVector)
+SIMILARITY_VECTORS = os.getenv("SIMILARITY_VECTORS") == "true"
+
+# Number of ranked similarity results (per gene, metric and limit) cached per process
+RANKED_SIMILAR_CACHE_SIZE = int(os.getenv("RANKED_SIMILAR_CACHE_SIZE", "1024"))
+
+# Seconds a process reuses the LoadGeneration it read, instead of a query per cached read
+LOAD_GENERATION_MAX_AGE = float(os.getenv("LOAD_GENERATION_MAX_AGE", "1"))
+
+# Number of most (and least) similar genes precomputed per gene while loading
+TOP_SIMILAR_K = int(os.getenv("TOP_SIMILAR_K", "50"))
+
+# Comma separated modules with more load strategies for run_benchmarks to import
+BENCHMARK_STRATEGY_MODULES = [
+    module
+    for module in os.getenv("BENCHMARK_STRATEGY_MODULES", "").split(",")
+    if module
+]
+
+# Trace Python allocations (tracemalloc) for the peak memory of benchmark phases
+BENCHMARK_TRACEMALLOC = os.getenv("BENCHMARK_TRACEMALLOC") == "true"